@@ -4,8 +4,7 @@ from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import csrf_exempt
 from social_django.views import complete as social_complete
 from social_django.utils import psa
-from django_redis import get_redis_connection
-from dashboard.api import CACHE_KEY_FAILURE_NUMS_BY_USER, FIELD_USER_ID_BASE_STR, CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE
+from dashboard.api import clear_cache_update_failures
 
 
 @never_cache
@@ -30,11 +29,8 @@ def complete(request, *args, **kwargs):
     # Continue with social_core pipeline
     social_complete_rtn = social_complete(request, *args, **kwargs)
 
-    # Update redis cache if user had invalid credentials
+    # Clear the cache update failures if user had invalid credentials
     if request.user.is_authenticated:
-        con = get_redis_connection("redis")
-        user_key = FIELD_USER_ID_BASE_STR.format(request.user.id)
-        con.hdel(CACHE_KEY_FAILURE_NUMS_BY_USER, user_key)
-        con.srem(CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE, request.user.id)
+        clear_cache_update_failures(request.user.id)
 
     return social_complete_rtn
@@ -9,6 +9,7 @@ from rest_framework.test import APITestCase
 
 from dashboard.factories import UserCacheRefreshTimeFactory
 from dashboard.api import CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE
+from dashboard.models import UserCacheUpdateFailure
 from micromasters.factories import SocialUserFactory
 from search.base import MockedESTestCase
 
@@ -41,7 +42,9 @@ class BackendViewTest(MockedESTestCase, APITestCase):
         con = get_redis_connection("redis")
         con.sadd(CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE, self.user.id)
         assert con.sismember(CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE, self.user.id) is True
+        UserCacheUpdateFailure.objects.create(user=self.user)
 
         self.client.get(self.url)
         assert mocked_complete.call_count == 1
         assert con.sismember(CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE, self.user.id) is False
+        assert UserCacheUpdateFailure.objects.filter(user=self.user).exists() is False
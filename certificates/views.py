@@ -223,7 +223,7 @@ class GradeRecordView(TemplateView):
             context['courses'].append({
                 "title": course.title,
                 "edx_course_key": best_grade.course_run.edx_course_key if best_grade else "",
-                "attempts": mmtrack.get_course_proctorate_exam_results(course).count(),
+                "attempts": len(mmtrack.get_course_proctorate_exam_results(course)),
                 "letter_grade": convert_to_letter(combined_grade.grade) if combined_grade else "",
                 "status": "Earned" if get_certificate_url(mmtrack, course) else "Not Earned",
                 "date_earned": combined_grade.created_on if combined_grade else "",
@@ -69,6 +69,8 @@ def settings_defaults(settings):
     Sets default settings to safe defaults
     """
     settings.FEATURES['OPEN_DISCUSSIONS_USER_SYNC'] = False
+    settings.SEARCH_INDEX_QUEUE_SYNC = True
+    settings.ELASTICSEARCH_ALIAS_CACHE_SECONDS = 0
 
 
 @pytest.fixture(scope='module')
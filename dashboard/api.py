@@ -10,6 +10,7 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ImproperlyConfigured
 from django.db import transaction
+from django.db.models import Q
 from django.urls import reverse
 from django_redis import get_redis_connection
 from edx_api.client import EdxApi
@@ -18,15 +19,19 @@ from backends.exceptions import InvalidCredentialStored
 from backends import utils
 from courses.models import Program, ElectiveCourse
 from courses.utils import format_season_year_for_course_run
-from dashboard.api_edx_cache import CachedEdxDataApi
+from dashboard.api_edx_cache import CachedEdxDataApi, UserCacheFreshness
+from dashboard.models import UserCacheUpdateFailure
+from dashboard.payload_cache import get_or_build_payload
+from dashboard.refresh_scheduler import prioritize_users_to_refresh, record_refresh_outcome
 from dashboard.utils import get_mmtrack
 from financialaid.serializers import FinancialAidDashboardSerializer
 from grades import api
 from grades.models import FinalGrade
 from grades.serializers import ProctoredExamGradeSerializer
 from exams.models import ExamAuthorization, ExamRun
-from micromasters.utils import now_in_utc
+from micromasters.utils import chunks, now_in_utc
 from profiles.api import get_social_auth
+from search.tasks import index_users
 
 # maximum number of exam attempts per payment
 ATTEMPTS_PER_PAID_RUN = 2
@@ -36,6 +41,8 @@ CACHE_KEY_FAILURE_NUMS_BY_USER = "update_cache_401_failure_numbers"
 # key that stores user ids to exclude from cache update
 CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE = "failed_cache_update_users_not_to_update"
 FIELD_USER_ID_BASE_STR = "user_{0}"
+# number of users to refresh fetched from the database at a time
+USERS_TO_REFRESH_BATCH_SIZE = 1000
 
 log = logging.getLogger(__name__)
 
@@ -151,28 +158,34 @@ def get_user_program_info(user, edx_client):
     Returns:
         list: Enrolled Program information
     """
+    # all the freshness checks are answered by a single snapshot of the refresh timestamps
+    freshness = UserCacheFreshness(user)
     # update cache
     # NOTE: this part can be moved to an asynchronous task
     if edx_client is not None:
         try:
-            for cache_type in CachedEdxDataApi.SUPPORTED_CACHES:
-                CachedEdxDataApi.update_cache_if_expired(user, edx_client, cache_type)
+            CachedEdxDataApi.update_expired_caches(user, edx_client, freshness)
         except InvalidCredentialStored:
             # this needs to raise in order to force the user re-login
             raise
         except:  # pylint: disable=bare-except
             log.exception('Impossible to refresh edX cache')
+        finally:
+            freshness.save()
 
     response_data = {
         "programs": [],
-        "is_edx_data_fresh": CachedEdxDataApi.are_all_caches_fresh(user)
+        "is_edx_data_fresh": freshness.are_all_fresh()
     }
     all_programs = (
         Program.objects.filter(live=True, programenrollment__user=user).prefetch_related('course_set__courserun_set')
     )
     for program in all_programs:
-        mmtrack_info = get_mmtrack(user, program)
-        response_data['programs'].append(get_info_for_program(mmtrack_info))
+        response_data['programs'].append(get_or_build_payload(
+            user.id,
+            program.id,
+            lambda program=program: get_info_for_program(get_mmtrack(user, program)),
+        ))
     return response_data
 
 
@@ -600,37 +613,75 @@ def get_certificate_url(mmtrack, course):
     return url
 
 
-def calculate_users_to_refresh_in_bulk():
+def get_users_refreshable_in_bulk():
     """
-    Calculate the set of user ids which would be updated when running a bulk update. This uses a 6 hour delta
-    because this is a bulk operation. For individual updates see CachedEdxDataApi.is_cache_fresh.
+    Returns the users whose edX data can be refreshed by a bulk update: active users with edX credentials
+    whose cache did not fail to update too many times
 
     Returns:
-        list of int: A list of user ids which need to be updated
+        QuerySet: a queryset of User objects
     """
-    refresh_time_limit = now_in_utc() - datetime.timedelta(hours=6)
+    # the filter on the failures is an anti-join on the indexed user column
+    return User.objects.filter(
+        is_active=True,
+        profile__fake_user=False,
+        usercacheupdatefailure__isnull=True,
+    ).exclude(social_auth=None)
 
-    all_users = User.objects.filter(is_active=True, profile__fake_user=False).exclude(social_auth=None)
 
-    con = get_redis_connection("redis")
-    user_ids_invalid_credentials = con.smembers(CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE)
+def iter_users_to_refresh_in_bulk(batch_size=USERS_TO_REFRESH_BATCH_SIZE):
+    """
+    Iterates over the user ids which would be updated when running a bulk update, one batch at a time.
+    This uses a 6 hour delta because this is a bulk operation. For individual updates see
+    CachedEdxDataApi.is_cache_fresh. If BATCH_UPDATE_PRIORITY_SCHEDULING is enabled the delta depends
+    on the priority tier of each user instead.
 
-    # If one of these fields is null in the database the gte expression will be false, so we will refresh those users
-    users_not_expired = all_users.filter(
-        usercacherefreshtime__enrollment__gte=refresh_time_limit,
-        usercacherefreshtime__certificate__gte=refresh_time_limit,
-        usercacherefreshtime__current_grade__gte=refresh_time_limit
-    )
+    Args:
+        batch_size (int): the maximum number of user ids in each batch
 
-    return list(
-        all_users
-        .exclude(id__in=users_not_expired.values_list("id", flat=True))
-        .exclude(id__in=user_ids_invalid_credentials)
-        .values_list("id", flat=True)
-    )
+    Yields:
+        list of int: user ids which need to be updated
+    """
+    users = get_users_refreshable_in_bulk()
+
+    if settings.BATCH_UPDATE_PRIORITY_SCHEDULING:
+        # the users are sorted by priority, so they can't be paginated by id
+        yield from chunks(prioritize_users_to_refresh(users), chunk_size=batch_size)
+        return
+
+    refresh_time_limit = now_in_utc() - datetime.timedelta(hours=6)
+    # A missing refresh time means that the user has never been refreshed
+    users_expired = users.filter(
+        Q(usercacherefreshtime__enrollment__isnull=True) |
+        Q(usercacherefreshtime__certificate__isnull=True) |
+        Q(usercacherefreshtime__current_grade__isnull=True) |
+        Q(usercacherefreshtime__enrollment__lt=refresh_time_limit) |
+        Q(usercacherefreshtime__certificate__lt=refresh_time_limit) |
+        Q(usercacherefreshtime__current_grade__lt=refresh_time_limit)
+    ).order_by('id').values_list('id', flat=True)
+
+    # keyset pagination, so every batch is an index range scan
+    last_user_id = 0
+    while True:
+        user_ids = list(users_expired.filter(id__gt=last_user_id)[:batch_size])
+        if not user_ids:
+            return
+        yield user_ids
+        last_user_id = user_ids[-1]
+
+
+def calculate_users_to_refresh_in_bulk():
+    """
+    Calculate the set of user ids which would be updated when running a bulk update.
+    See iter_users_to_refresh_in_bulk.
+
+    Returns:
+        list of int: A list of user ids which need to be updated
+    """
+    return [user_id for user_ids in iter_users_to_refresh_in_bulk() for user_id in user_ids]
 
 
-def refresh_user_data(user_id):
+def refresh_user_data(user_id, interactive=False):
     """
     Refresh the edx cache data for a user.
 
@@ -638,41 +689,69 @@ def refresh_user_data(user_id):
 
     Args:
         user_id (int): The user id
+        interactive (bool): True if the refresh was requested by the user opening the dashboard.
+            The failures of interactive refreshes are not counted by the batch update.
+
+    Returns:
+        bool: True if all the cache types have been refreshed without errors
+
+    Raises:
+        InvalidCredentialStored: During an interactive refresh, if the user has to log in again
     """
     # pylint: disable=bare-except
     try:
         user = User.objects.get(pk=user_id)
     except:
         log.exception('edX data refresh task: unable to get user "%s"', user_id)
-        return
+        return False
 
     # get the credentials for the current user for edX
     try:
         user_social = get_social_auth(user)
     except:
         log.exception('user "%s" does not have edX credentials', user.username)
-        return
+        return False
 
     try:
         utils.refresh_user_token(user_social)
-    except:
-        save_cache_update_failure(user_id)
+    except Exception as exc:  # pylint: disable=broad-except
+        if interactive and isinstance(exc, InvalidCredentialStored):
+            raise
+        if not interactive:
+            save_cache_update_failure(user_id)
         log.exception("Unable to refresh token for student %s", user.username)
-        return
+        return False
 
     try:
         edx_client = EdxApi(user_social.extra_data, settings.EDXORG_BASE_URL)
     except:
         log.exception("Unable to create an edX client object for student %s", user.username)
-        return
+        return False
 
+    freshness = UserCacheFreshness(user)
+    succeeded = True
+    changed = False
     for cache_type in CachedEdxDataApi.SUPPORTED_CACHES:
         try:
-            CachedEdxDataApi.update_cache_if_expired(user, edx_client, cache_type)
-        except:
-            save_cache_update_failure(user_id)
+            if CachedEdxDataApi.update_cache_if_expired(
+                    user, edx_client, cache_type, freshness=freshness, index_user=False
+            ):
+                changed = True
+        except Exception as exc:  # pylint: disable=broad-except
+            if interactive and isinstance(exc, InvalidCredentialStored):
+                raise
+            succeeded = False
+            if not interactive:
+                save_cache_update_failure(user_id)
             log.exception("Unable to refresh cache %s for student %s", cache_type, user.username)
             continue
+    freshness.save()
+    if changed:
+        # a single re-index for all the cache types, and only if something changed
+        index_users.delay([user.id], check_if_changed=True)
+    if settings.BATCH_UPDATE_PRIORITY_SCHEDULING and succeeded:
+        record_refresh_outcome(user_id, changed)
+    return succeeded
 
 
 def save_cache_update_failure(user_id):
@@ -687,3 +766,17 @@ def save_cache_update_failure(user_id):
     new_value = con.hincrby(CACHE_KEY_FAILURE_NUMS_BY_USER, user_key, 1)
     if int(new_value) >= 3:
         con.sadd(CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE, user_id)
+        UserCacheUpdateFailure.objects.get_or_create(user_id=user_id)
+
+
+def clear_cache_update_failures(user_id):
+    """
+    Reset the failures to update the cache of a user, so the user is updated again by the bulk update
+
+    Args:
+        user_id (int): The user id
+    """
+    con = get_redis_connection("redis")
+    con.hdel(CACHE_KEY_FAILURE_NUMS_BY_USER, FIELD_USER_ID_BASE_STR.format(user_id))
+    con.srem(CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE, user_id)
+    UserCacheUpdateFailure.objects.filter(user_id=user_id).delete()
@@ -4,8 +4,9 @@ APIs that deal with the edx cached data
 import datetime
 import logging
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
-from django.db import transaction
+from django.db import IntegrityError, transaction
 from django.conf import settings
 from requests.exceptions import HTTPError
 from edx_api.client import EdxApi
@@ -28,19 +29,53 @@ class CachedEdxUserData:
     """Represents all edX data related to a User"""
     # pylint: disable=too-many-instance-attributes
 
-    def __init__(self, user, program=None):
+    def __init__(self, user, program=None, enrollments=None, certificates=None, current_grades=None):
         """
         Fetches the given User's edx data and sets object properties
 
         Args:
             user (User): a User object
             program (Program): an optional Program to filter on
+            enrollments (Enrollments): optional enrollments already fetched for the User
+            certificates (Certificates): optional certificates already fetched for the User
+            current_grades (CurrentGrades): optional current grades already fetched for the User
         """
         self.user = user
         self.program = program
-        self.enrollments = models.CachedEnrollment.get_edx_data(self.user, program=self.program)
-        self.certificates = models.CachedCertificate.get_edx_data(self.user, program=self.program)
-        self.current_grades = models.CachedCurrentGrade.get_edx_data(self.user, program=self.program)
+        if enrollments is None:
+            enrollments = models.CachedEnrollment.get_edx_data(self.user, program=self.program)
+        if certificates is None:
+            certificates = models.CachedCertificate.get_edx_data(self.user, program=self.program)
+        if current_grades is None:
+            current_grades = models.CachedCurrentGrade.get_edx_data(self.user, program=self.program)
+        self.enrollments = enrollments
+        self.certificates = certificates
+        self.current_grades = current_grades
+
+    @classmethod
+    def for_users(cls, users, program=None):
+        """
+        Fetches the edx data of many Users with a single query for each cached model
+
+        Args:
+            users (list of User): the User objects
+            program (Program): an optional Program to filter on
+
+        Returns:
+            dict: a map of user ids to CachedEdxUserData objects
+        """
+        enrollments = models.CachedEnrollment.get_edx_data_for_users(users, program=program)
+        certificates = models.CachedCertificate.get_edx_data_for_users(users, program=program)
+        current_grades = models.CachedCurrentGrade.get_edx_data_for_users(users, program=program)
+        return {
+            user.id: cls(
+                user,
+                program=program,
+                enrollments=enrollments[user.id],
+                certificates=certificates[user.id],
+                current_grades=current_grades[user.id],
+            ) for user in users
+        }
 
     def get_run_data(self, course_id):
         """
@@ -60,6 +95,100 @@ class CachedEdxUserData:
         )
 
 
+class UserCacheFreshness:
+    """
+    Snapshot of the cache refresh timestamps of a User.
+
+    The UserCacheRefreshTime record is loaded once, all the freshness checks are answered
+    from memory and the refresh timestamps are written back with a single statement by save().
+    """
+
+    def __init__(self, user):
+        """
+        Loads the refresh timestamps for the given User
+
+        Args:
+            user (django.contrib.auth.models.User): A user
+        """
+        self.user = user
+        self.refresh_time = models.UserCacheRefreshTime.objects.filter(user=user).first()
+        self.updated_values = {}
+
+    def get_timestamp(self, cache_type):
+        """
+        Returns the last refresh timestamp for the cache type, including the ones not yet saved
+
+        Args:
+            cache_type (str): a string representing one of the cached data types
+        Returns:
+            datetime.datetime: the timestamp or None
+        """
+        if cache_type not in CachedEdxDataApi.SUPPORTED_CACHES:
+            raise ValueError("{} is an unsupported cache type".format(cache_type))
+        if cache_type in self.updated_values:
+            return self.updated_values[cache_type]
+        if self.refresh_time is None:
+            return None
+        return getattr(self.refresh_time, cache_type)
+
+    def is_fresh(self, cache_type):
+        """
+        Checks if the specified cache type is fresh.
+
+        Args:
+            cache_type (str): a string representing one of the cached data types
+        Returns:
+            bool
+        """
+        cache_timestamp = self.get_timestamp(cache_type)
+        return cache_timestamp is not None and cache_timestamp > (
+            now_in_utc() - CachedEdxDataApi.CACHE_EXPIRATION_DELTAS[cache_type]
+        )
+
+    def are_all_fresh(self):
+        """
+        Checks if all cache types are fresh.
+
+        Returns:
+            bool
+        """
+        return all(self.is_fresh(cache_type) for cache_type in CachedEdxDataApi.SUPPORTED_CACHES)
+
+    def mark_refreshed(self, cache_type, timestamp=None):
+        """
+        Records in memory the refresh timestamp for the cache type. Nothing is written until save() is called.
+
+        Args:
+            cache_type (str): a string representing one of the cached data types
+            timestamp (datetime.datetime): a timestamp
+        """
+        if cache_type not in CachedEdxDataApi.SUPPORTED_CACHES:
+            raise ValueError("{} is an unsupported cache type".format(cache_type))
+        self.updated_values[cache_type] = timestamp or now_in_utc()
+
+    def save(self):
+        """
+        Writes all the updated refresh timestamps in one statement
+        """
+        if not self.updated_values:
+            return
+        if self.refresh_time is not None:
+            models.UserCacheRefreshTime.objects.filter(id=self.refresh_time.id).update(**self.updated_values)
+            for cache_type, timestamp in self.updated_values.items():
+                setattr(self.refresh_time, cache_type, timestamp)
+        else:
+            try:
+                with transaction.atomic():
+                    self.refresh_time = models.UserCacheRefreshTime.objects.create(
+                        user=self.user, **self.updated_values
+                    )
+            except IntegrityError:
+                # the record has been created concurrently
+                models.UserCacheRefreshTime.objects.filter(user=self.user).update(**self.updated_values)
+                self.refresh_time = models.UserCacheRefreshTime.objects.get(user=self.user)
+        self.updated_values = {}
+
+
 class CachedEdxDataApi:
     """
     Class to handle the retrieval and update of the users' cached edX information
@@ -121,6 +250,23 @@ class CachedEdxDataApi:
         }
         models.UserCacheRefreshTime.objects.update_or_create(user=user, defaults=updated_values)
 
+    @classmethod
+    def _record_cache_refresh(cls, user, cache_type, freshness=None):
+        """
+        Updates the refresh timestamp for the cache type, either right away or in the freshness snapshot
+
+        Args:
+            user (django.contrib.auth.models.User): A user
+            cache_type (str): a string representing one of the cached data types
+            freshness (UserCacheFreshness): an optional snapshot that will write the timestamp later
+        Returns:
+            None
+        """
+        if freshness is not None:
+            freshness.mark_refreshed(cache_type)
+        else:
+            cls.update_cache_last_access(user, cache_type)
+
     @classmethod
     def is_cache_fresh(cls, user, cache_type):
         """
@@ -164,69 +310,130 @@ class CachedEdxDataApi:
             user (User): A user
             enrollment (Enrollment): An Enrollment object from edx_api_client
             course_id (str): A course key
-            index_user (bool): whether to force an user re-index.
+            index_user (bool): whether to re-index the user if the enrollment changed.
                 This is only necessary if this function is called from outside the general
                 global user enrollments refresh.
 
         Returns:
             None
         """
-        with transaction.atomic():
-            # get the enrollment data
-            enrollment_data = enrollment.json
-            course_run = CourseRun.objects.get(edx_course_key=course_id)
-            updated_values = {
-                'user': user,
-                'course_run': course_run,
-                'data': enrollment_data,
-            }
-            models.CachedEnrollment.objects.update_or_create(
-                user=user,
-                course_run=course_run,
-                defaults=updated_values
-            )
-        if index_user:
+        course_run = CourseRun.objects.get(edx_course_key=course_id)
+        changed = models.CachedEnrollment.bulk_upsert_user_data(user, {course_run: enrollment.json})
+        if index_user and changed:
             # submit a celery task to reindex the user
             tasks.index_users.delay([user.id], check_if_changed=True)
 
     @classmethod
-    def update_cached_enrollments(cls, user, edx_client):
+    def save_cached_enrollments(cls, user, enrollments, freshness=None):
         """
-        Updates cached enrollment data for an user.
+        Replaces the cached enrollment data for an user with the data fetched from edX.
 
         Args:
             user (django.contrib.auth.models.User): A user
-            edx_client (EdxApi): EdX client to retrieve enrollments
+            enrollments (Enrollments): the enrollments fetched from edX
+            freshness (UserCacheFreshness): an optional snapshot used to defer the refresh timestamp update
         Returns:
-            None
+            bool: whether the cached data changed
         """
-        # Fetch new data from edX.
-        enrollments = edx_client.enrollments.get_student_enrollments()
-
         # Make sure all cached enrollments are updated atomically
         with transaction.atomic():
             # update the current ones
             all_enrolled_course_ids = enrollments.get_enrolled_course_ids()
-            for course_run in CourseRun.objects.filter(edx_course_key__in=all_enrolled_course_ids):
-                enrollment = enrollments.get_enrollment_for_course(course_run.edx_course_key)
-                cls.update_cached_enrollment(user, enrollment, course_run.edx_course_key)
+            upserted = models.CachedEnrollment.bulk_upsert_user_data(user, {
+                course_run: enrollments.get_enrollment_for_course(course_run.edx_course_key).json
+                for course_run in CourseRun.objects.filter(edx_course_key__in=all_enrolled_course_ids)
+            })
             # delete anything is not in the current enrollments
-            models.CachedEnrollment.delete_all_but(user, all_enrolled_course_ids)
+            deleted = models.CachedEnrollment.delete_all_but(user, all_enrolled_course_ids)
+            # update the last refresh timestamp
+            cls._record_cache_refresh(user, cls.ENROLLMENT, freshness=freshness)
+        return bool(upserted) or deleted > 0
+
+    @classmethod
+    def save_cached_certificates(cls, user, certificates, freshness=None):
+        """
+        Replaces the cached certificate data for an user with the data fetched from edX.
+
+        Args:
+            user (django.contrib.auth.models.User): A user
+            certificates (Certificates): the certificates fetched from edX
+            freshness (UserCacheFreshness): an optional snapshot used to defer the refresh timestamp update
+        Returns:
+            bool: whether the cached data changed
+        """
+        # This must be done atomically
+        with transaction.atomic():
+            all_cert_course_ids = certificates.all_courses_verified_certs
+            upserted = models.CachedCertificate.bulk_upsert_user_data(user, {
+                course_run: certificates.get_verified_cert(course_run.edx_course_key).json
+                for course_run in CourseRun.objects.filter(edx_course_key__in=all_cert_course_ids)
+            })
+            # delete anything is not in the current certificates
+            deleted = models.CachedCertificate.delete_all_but(user, all_cert_course_ids)
+            # update the last refresh timestamp
+            cls._record_cache_refresh(user, cls.CERTIFICATE, freshness=freshness)
+        return bool(upserted) or deleted > 0
+
+    @classmethod
+    def save_cached_current_grades(cls, user, current_grades, freshness=None):
+        """
+        Replaces the cached current grade data for an user with the data fetched from edX.
+
+        Args:
+            user (django.contrib.auth.models.User): A user
+            current_grades (CurrentGrades): the current grades fetched from edX
+            freshness (UserCacheFreshness): an optional snapshot used to defer the refresh timestamp update
+        Returns:
+            bool: whether the cached data changed
+        """
+        # the update must be done atomically
+        with transaction.atomic():
+            all_grade_course_ids = current_grades.all_course_ids
+            upserted = models.CachedCurrentGrade.bulk_upsert_user_data(user, {
+                course_run: current_grades.get_current_grade(course_run.edx_course_key).json
+                for course_run in CourseRun.objects.filter(edx_course_key__in=all_grade_course_ids)
+            })
+            # delete anything is not in the current grades
+            deleted = models.CachedCurrentGrade.delete_all_but(user, all_grade_course_ids)
             # update the last refresh timestamp
-            cls.update_cache_last_access(user, cls.ENROLLMENT)
-        # submit a celery task to reindex the user
-        tasks.index_users.delay([user.id], check_if_changed=True)
+            cls._record_cache_refresh(user, cls.CURRENT_GRADE, freshness=freshness)
+        return bool(upserted) or deleted > 0
 
     @classmethod
-    def update_cached_certificates(cls, user, edx_client):
+    def update_cached_enrollments(cls, user, edx_client, freshness=None, index_user=True):
+        """
+        Updates cached enrollment data for an user.
+
+        Args:
+            user (django.contrib.auth.models.User): A user
+            edx_client (EdxApi): EdX client to retrieve enrollments
+            freshness (UserCacheFreshness): an optional snapshot used to defer the refresh timestamp update
+            index_user (bool): whether to re-index the user if the cached data changed.
+                Callers updating several cache types at once can index the user only once instead.
+        Returns:
+            bool: whether the cached data changed
+        """
+        # Fetch new data from edX.
+        enrollments = edx_client.enrollments.get_student_enrollments()
+        changed = cls.save_cached_enrollments(user, enrollments, freshness=freshness)
+        if index_user and changed:
+            # submit a celery task to reindex the user
+            tasks.index_users.delay([user.id], check_if_changed=True)
+        return changed
+
+    @classmethod
+    def update_cached_certificates(cls, user, edx_client, freshness=None, index_user=True):
         """
         Updates cached certificate data.
 
         Args:
             user (django.contrib.auth.models.User): A user
             edx_client (EdxApi): EdX client to retrieve enrollments
+            freshness (UserCacheFreshness): an optional snapshot used to defer the refresh timestamp update
+            index_user (bool): whether to re-index the user if the cached data changed.
+                Callers updating several cache types at once can index the user only once instead.
         Returns:
-            None
+            bool: whether the cached data changed
         """
         # the possible certificates can be only for courses where the user is enrolled
         course_ids = models.CachedEnrollment.active_course_ids(user)
@@ -234,39 +441,25 @@ class CachedEdxDataApi:
         # Certificates are out of date, so fetch new data from edX.
         certificates = edx_client.certificates.get_student_certificates(
             get_social_username(user), course_ids)
-
-        # This must be done atomically
-        with transaction.atomic():
-            all_cert_course_ids = certificates.all_courses_verified_certs
-            for course_run in CourseRun.objects.filter(edx_course_key__in=all_cert_course_ids):
-                certificate = certificates.get_verified_cert(course_run.edx_course_key)
-                updated_values = {
-                    'user': user,
-                    'course_run': course_run,
-                    'data': certificate.json,
-                }
-                models.CachedCertificate.objects.update_or_create(
-                    user=user,
-                    course_run=course_run,
-                    defaults=updated_values
-                )
-            # delete anything is not in the current certificates
-            models.CachedCertificate.delete_all_but(user, all_cert_course_ids)
-            # update the last refresh timestamp
-            cls.update_cache_last_access(user, cls.CERTIFICATE)
-        # submit a celery task to reindex the user
-        tasks.index_users.delay([user.id], check_if_changed=True)
+        changed = cls.save_cached_certificates(user, certificates, freshness=freshness)
+        if index_user and changed:
+            # submit a celery task to reindex the user
+            tasks.index_users.delay([user.id], check_if_changed=True)
+        return changed
 
     @classmethod
-    def update_cached_current_grades(cls, user, edx_client):
+    def update_cached_current_grades(cls, user, edx_client, freshness=None, index_user=True):
         """
         Updates cached current grade data.
 
         Args:
             user (django.contrib.auth.models.User): A user
             edx_client (EdxApi): EdX client to retrieve enrollments
+            freshness (UserCacheFreshness): an optional snapshot used to defer the refresh timestamp update
+            index_user (bool): whether to re-index the user if the cached data changed.
+                Callers updating several cache types at once can index the user only once instead.
         Returns:
-            None
+            bool: whether the cached data changed
         """
 
         course_ids = models.CachedEnrollment.active_course_ids(user)
@@ -274,31 +467,32 @@ class CachedEdxDataApi:
         # Current Grades are out of date, so fetch new data from edX.
         current_grades = edx_client.current_grades.get_student_current_grades(
             get_social_username(user), course_ids)
+        changed = cls.save_cached_current_grades(user, current_grades, freshness=freshness)
+        if index_user and changed:
+            # submit a celery task to reindex the user
+            tasks.index_users.delay([user.id], check_if_changed=True)
+        return changed
 
-        # the update must be done atomically
-        with transaction.atomic():
-            all_grade_course_ids = current_grades.all_course_ids
-            for course_run in CourseRun.objects.filter(edx_course_key__in=all_grade_course_ids):
-                current_grade = current_grades.get_current_grade(course_run.edx_course_key)
-                updated_values = {
-                    'user': user,
-                    'course_run': course_run,
-                    'data': current_grade.json,
-                }
-                models.CachedCurrentGrade.objects.update_or_create(
-                    user=user,
-                    course_run=course_run,
-                    defaults=updated_values
-                )
-            # delete anything is not in the current grades
-            models.CachedCurrentGrade.delete_all_but(user, all_grade_course_ids)
-            # update the last refresh timestamp
-            cls.update_cache_last_access(user, cls.CURRENT_GRADE)
-        # submit a celery task to reindex the user
-        tasks.index_users.delay([user.id], check_if_changed=True)
+    @staticmethod
+    def _convert_http_error(exc):
+        """
+        Converts an HTTPError from edX to InvalidCredentialStored if the status code means the token is not valid
+
+        Args:
+            exc (HTTPError): an error raised by the edX client
+        Returns:
+            Exception: the exception to be raised
+        """
+        if exc.response is not None and exc.response.status_code in (400, 401,):
+            return InvalidCredentialStored(
+                message='Received a {} status code from the server even'
+                ' if access token was supposed to be valid'.format(exc.response.status_code),
+                http_status_code=exc.response.status_code
+            )
+        return exc
 
     @classmethod
-    def update_cache_if_expired(cls, user, edx_client, cache_type):
+    def update_cache_if_expired(cls, user, edx_client, cache_type, freshness=None, index_user=True):
         """
         Checks if the specified cache type is expired and in case takes care to update it.
 
@@ -306,8 +500,11 @@ class CachedEdxDataApi:
             user (django.contrib.auth.models.User): A user
             edx_client (EdxApi): EdX client to retrieve enrollments
             cache_type (str): a string representing one of the cached data types
+            freshness (UserCacheFreshness): an optional snapshot used for the freshness check
+                and to defer the refresh timestamp update
+            index_user (bool): whether to re-index the user if the cached data changed
         Returns:
-            None
+            bool: whether the cached data changed, False if the cache was still fresh
         """
         cache_update_methods = {
             cls.ENROLLMENT: cls.update_cached_enrollments,
@@ -316,18 +513,93 @@ class CachedEdxDataApi:
         }
         if cache_type not in cls.SUPPORTED_CACHES:
             raise ValueError("{} is an unsupported cache type".format(cache_type))
-        if not cls.is_cache_fresh(user, cache_type):
-            update_func = cache_update_methods[cache_type]
+        is_fresh = (
+            freshness.is_fresh(cache_type) if freshness is not None else cls.is_cache_fresh(user, cache_type)
+        )
+        if is_fresh:
+            return False
+        update_func = cache_update_methods[cache_type]
+        try:
+            return update_func(user, edx_client, freshness=freshness, index_user=index_user)
+        except HTTPError as exc:
+            raise cls._convert_http_error(exc)
+
+    @classmethod
+    def update_expired_caches(cls, user, edx_client, freshness):
+        """
+        Updates all the expired cache types for a user.
+
+        Enrollments are fetched first because certificates and current grades can only be requested
+        for the enrolled course runs; certificates and current grades are then fetched concurrently.
+        All the database writes happen in a single transaction once every request has completed,
+        and the data that could be fetched is saved even if one of the requests failed.
+
+        Args:
+            user (django.contrib.auth.models.User): A user
+            edx_client (EdxApi): EdX client to retrieve the edX data
+            freshness (UserCacheFreshness): the snapshot used for the freshness checks and the refresh timestamps
+        Returns:
+            None
+        """
+        expired_types = [
+            cache_type for cache_type in cls.SUPPORTED_CACHES if not freshness.is_fresh(cache_type)
+        ]
+        if not expired_types:
+            return
+
+        fetched = {}
+        errors = []
+        if cls.ENROLLMENT in expired_types:
             try:
-                update_func(user, edx_client)
+                fetched[cls.ENROLLMENT] = edx_client.enrollments.get_student_enrollments()
             except HTTPError as exc:
-                if exc.response.status_code in (400, 401,):
-                    raise InvalidCredentialStored(
-                        message='Received a {} status code from the server even'
-                        ' if access token was supposed to be valid'.format(exc.response.status_code),
-                        http_status_code=exc.response.status_code
-                    )
-                raise
+                raise cls._convert_http_error(exc)
+            # the possible certificates and grades can be only for courses where the user is enrolled
+            course_ids = list(CourseRun.objects.filter(
+                edx_course_key__in=fetched[cls.ENROLLMENT].get_enrolled_course_ids()
+            ).values_list('edx_course_key', flat=True))
+        else:
+            course_ids = models.CachedEnrollment.active_course_ids(user)
+
+        # the edX username is looked up here because the worker threads must not use the database
+        username = get_social_username(user)
+        fetch_methods = {
+            cls.CERTIFICATE: lambda: edx_client.certificates.get_student_certificates(username, course_ids),
+            cls.CURRENT_GRADE: lambda: edx_client.current_grades.get_student_current_grades(username, course_ids),
+        }
+        to_fetch = [cache_type for cache_type in expired_types if cache_type in fetch_methods]
+        if to_fetch:
+            with ThreadPoolExecutor(max_workers=len(to_fetch)) as executor:
+                futures = {
+                    cache_type: executor.submit(fetch_methods[cache_type]) for cache_type in to_fetch
+                }
+            for cache_type, future in futures.items():
+                try:
+                    fetched[cache_type] = future.result()
+                except HTTPError as exc:
+                    errors.append(cls._convert_http_error(exc))
+                except Exception as exc:  # pylint: disable=broad-except
+                    errors.append(exc)
+
+        save_methods = {
+            cls.ENROLLMENT: cls.save_cached_enrollments,
+            cls.CERTIFICATE: cls.save_cached_certificates,
+            cls.CURRENT_GRADE: cls.save_cached_current_grades,
+        }
+        changed = False
+        if fetched:
+            with transaction.atomic():
+                for cache_type in cls.SUPPORTED_CACHES:
+                    if cache_type in fetched:
+                        if save_methods[cache_type](user, fetched[cache_type], freshness=freshness):
+                            changed = True
+        if changed:
+            # submit a single celery task to reindex the user for all the cache types
+            tasks.index_users.delay([user.id], check_if_changed=True)
+
+        if errors:
+            # an invalid credential must take precedence because it forces the user to log in again
+            raise next((exc for exc in errors if isinstance(exc, InvalidCredentialStored)), errors[0])
 
     @classmethod
     def update_all_cached_grade_data(cls, user):
@@ -345,5 +617,8 @@ class CachedEdxDataApi:
         utils.refresh_user_token(user_social)
         # create an instance of the client to query edX
         edx_client = EdxApi(user_social.extra_data, settings.EDXORG_BASE_URL)
-        cls.update_cached_certificates(user, edx_client)
-        cls.update_cached_current_grades(user, edx_client)
+        certificates_changed = cls.update_cached_certificates(user, edx_client, index_user=False)
+        current_grades_changed = cls.update_cached_current_grades(user, edx_client, index_user=False)
+        if certificates_changed or current_grades_changed:
+            # submit a celery task to reindex the user
+            tasks.index_users.delay([user.id], check_if_changed=True)
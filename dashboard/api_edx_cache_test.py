@@ -23,6 +23,7 @@ from dashboard.api_edx_cache import (
     CachedEdxUserData,
     CachedEdxDataApi,
     UserCachedRunData,
+    UserCacheFreshness,
 )
 from dashboard.factories import (
     CachedEnrollmentFactory,
@@ -267,6 +268,63 @@ class CachedEdxDataApiTests(MockedESTestCase):
         user_cache.save()
         assert CachedEdxDataApi.are_all_caches_fresh(self.user) is True
 
+    def test_freshness_snapshot(self):
+        """Test that UserCacheFreshness answers freshness checks from a single query"""
+        now = now_in_utc()
+        UserCacheRefreshTimeFactory.create(
+            user=self.user,
+            enrollment=now,
+            certificate=now - timedelta(days=1),
+            current_grade=None,
+        )
+        with self.assertNumQueries(1):
+            freshness = UserCacheFreshness(self.user)
+            assert freshness.is_fresh(CachedEdxDataApi.ENROLLMENT) is True
+            assert freshness.is_fresh(CachedEdxDataApi.CERTIFICATE) is False
+            assert freshness.is_fresh(CachedEdxDataApi.CURRENT_GRADE) is False
+            assert freshness.are_all_fresh() is False
+        with self.assertRaises(ValueError):
+            freshness.is_fresh('footype')
+
+        with self.assertNumQueries(0):
+            freshness.mark_refreshed(CachedEdxDataApi.CERTIFICATE)
+            freshness.mark_refreshed(CachedEdxDataApi.CURRENT_GRADE)
+            assert freshness.are_all_fresh() is True
+        with self.assertNumQueries(1):
+            freshness.save()
+        cache_time = UserCacheRefreshTime.objects.get(user=self.user)
+        assert cache_time.enrollment == now
+        assert cache_time.certificate > now
+        assert cache_time.current_grade > now
+
+    def test_freshness_snapshot_no_record(self):
+        """Test that UserCacheFreshness creates the UserCacheRefreshTime if needed"""
+        freshness = UserCacheFreshness(self.user)
+        for cache_type in CachedEdxDataApi.SUPPORTED_CACHES:
+            assert freshness.is_fresh(cache_type) is False
+        # nothing to save
+        with self.assertNumQueries(0):
+            freshness.save()
+        assert UserCacheRefreshTime.objects.filter(user=self.user).exists() is False
+
+        freshness.mark_refreshed(CachedEdxDataApi.ENROLLMENT)
+        freshness.save()
+        cache_time = UserCacheRefreshTime.objects.get(user=self.user)
+        assert cache_time.enrollment is not None
+        assert cache_time.certificate is None
+        assert cache_time.current_grade is None
+
+    @patch('search.tasks.index_users', autospec=True)
+    def test_update_cached_enrollments_with_freshness(self, mocked_index):  # pylint: disable=unused-argument
+        """Test that the refresh timestamp is deferred to the freshness snapshot when one is provided"""
+        freshness = UserCacheFreshness(self.user)
+        CachedEdxDataApi.update_cached_enrollments(self.user, self.edx_client, freshness=freshness)
+        self.assert_cache_in_db(enrollment_keys=self.enrollment_ids)
+        assert UserCacheRefreshTime.objects.filter(user=self.user).exists() is False
+        assert freshness.is_fresh(CachedEdxDataApi.ENROLLMENT) is True
+        freshness.save()
+        assert UserCacheRefreshTime.objects.get(user=self.user).enrollment is not None
+
     @patch('search.tasks.index_users', autospec=True)
     def test_update_cached_enrollment(self, mocked_index):
         """Test for update_cached_enrollment"""
@@ -317,6 +375,38 @@ class CachedEdxDataApiTests(MockedESTestCase):
         cache_time.refresh_from_db()
         assert cache_time.enrollment >= now
         mocked_index.delay.assert_called_once_with([self.user.id], check_if_changed=True)
+        mocked_index.reset_mock()
+
+        # nothing changed, so the user is not re-indexed
+        assert CachedEdxDataApi.update_cached_enrollments(self.user, self.edx_client) is False
+        assert mocked_index.delay.called is False
+
+    @ddt.data(
+        models.CachedEnrollment,
+        models.CachedCertificate,
+        models.CachedCurrentGrade,
+    )
+    def test_bulk_upsert_user_data(self, model_class):
+        """Test that bulk_upsert_user_data writes all the rows in one statement and skips unchanged ones"""
+        data_by_course_run = {
+            run: {'course_id': run.edx_course_key, 'value': 1} for run in self.all_runs
+        }
+        upserted = model_class.bulk_upsert_user_data(self.user, data_by_course_run)
+        assert len(upserted) == len(self.all_runs)
+        assert model_class.objects.filter(user=self.user).count() == len(self.all_runs)
+
+        # nothing changed, so nothing is written
+        with self.assertNumQueries(1):
+            assert model_class.bulk_upsert_user_data(self.user, data_by_course_run) == []
+
+        changed_run = self.all_runs[0]
+        data_by_course_run[changed_run] = {'course_id': changed_run.edx_course_key, 'value': 2}
+        upserted = model_class.bulk_upsert_user_data(self.user, data_by_course_run)
+        assert [record.course_run for record in upserted] == [changed_run]
+        assert model_class.objects.get(user=self.user, course_run=changed_run).data == data_by_course_run[changed_run]
+
+        with self.assertNumQueries(0):
+            assert model_class.bulk_upsert_user_data(self.user, {}) == []
 
     @patch('search.tasks.index_users', autospec=True)
     def test_update_cached_certificates(self, mocked_index):
@@ -428,16 +518,85 @@ class CachedEdxDataApiTests(MockedESTestCase):
             with self.assertRaises(HTTPError):
                 CachedEdxDataApi.update_cache_if_expired(self.user, self.edx_client, CachedEdxDataApi.ENROLLMENT)
 
+    @patch('search.tasks.index_users', autospec=True)
+    def test_update_expired_caches(self, mocked_index):
+        """Test that update_expired_caches fetches and saves all the expired caches"""
+        freshness = UserCacheFreshness(self.user)
+        CachedEdxDataApi.update_expired_caches(self.user, self.edx_client, freshness)
+        self.assert_cache_in_db(
+            enrollment_keys=self.enrollment_ids,
+            certificate_keys=self.verified_certificates_ids,
+            grades_keys=self.grades_ids,
+        )
+        # certificates and grades are requested for the enrolled course runs
+        enrolled_ids = sorted(self.enrollment_ids)
+        username = self.user.social_auth.get(provider=EdxOrgOAuth2.name).uid
+        args, _ = self.edx_client.certificates.get_student_certificates.call_args
+        assert args[0] == username
+        assert sorted(args[1]) == enrolled_ids
+        args, _ = self.edx_client.current_grades.get_student_current_grades.call_args
+        assert args[0] == username
+        assert sorted(args[1]) == enrolled_ids
+        mocked_index.delay.assert_called_once_with([self.user.id], check_if_changed=True)
+        assert freshness.are_all_fresh() is True
+
+        # once everything is fresh nothing is fetched
+        edx_client = MagicMock()
+        mocked_index.reset_mock()
+        CachedEdxDataApi.update_expired_caches(self.user, edx_client, freshness)
+        assert edx_client.enrollments.get_student_enrollments.called is False
+        assert edx_client.certificates.get_student_certificates.called is False
+        assert edx_client.current_grades.get_student_current_grades.called is False
+        assert mocked_index.delay.called is False
+
+    @patch('search.tasks.index_users', autospec=True)
+    def test_update_expired_caches_partial_failure(self, mocked_index):  # pylint: disable=unused-argument
+        """
+        Test that update_expired_caches saves the data that could be fetched
+        and raises InvalidCredentialStored for a 401
+        """
+        error = HTTPError()
+        error.response = MagicMock(status_code=401)
+        edx_client = MagicMock()
+        edx_client.enrollments.get_student_enrollments.return_value = self.enrollments
+        edx_client.certificates.get_student_certificates.side_effect = error
+        edx_client.current_grades.get_student_current_grades.return_value = self.current_grades
+
+        freshness = UserCacheFreshness(self.user)
+        with self.assertRaises(InvalidCredentialStored):
+            CachedEdxDataApi.update_expired_caches(self.user, edx_client, freshness)
+        self.assert_cache_in_db(enrollment_keys=self.enrollment_ids, grades_keys=self.grades_ids)
+        assert freshness.is_fresh(CachedEdxDataApi.ENROLLMENT) is True
+        assert freshness.is_fresh(CachedEdxDataApi.CERTIFICATE) is False
+        assert freshness.is_fresh(CachedEdxDataApi.CURRENT_GRADE) is True
+
+    @patch('search.tasks.index_users', autospec=True)
     @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_cached_current_grades')
     @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_cached_certificates')
     @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_cached_enrollments')
     @patch('backends.utils.refresh_user_token', autospec=True)
-    def test_update_all_cached_grade_data(self, mock_refr, mock_enr, mock_cert, mock_grade):
+    @ddt.data(
+        (True, True, True),
+        (True, False, True),
+        (False, True, True),
+        (False, False, False),
+    )
+    @ddt.unpack
+    def test_update_all_cached_grade_data(
+            self, certificates_changed, grades_changed, indexed, mock_refr, mock_enr, mock_cert, mock_grade,
+            mocked_index
+    ):  # pylint: disable=too-many-arguments
         """Test for update_all_cached_grade_data"""
+        mock_cert.return_value = certificates_changed
+        mock_grade.return_value = grades_changed
         for mock_func in (mock_refr, mock_enr, mock_cert, mock_grade, ):
             assert mock_func.called is False
         CachedEdxDataApi.update_all_cached_grade_data(self.user)
         assert mock_enr.called is False
         mock_refr.assert_called_once_with(self.user.social_auth.get(provider=EdxOrgOAuth2.name))
         for mock_func in (mock_cert, mock_grade, ):
-            mock_func.assert_called_once_with(self.user, ANY)
+            mock_func.assert_called_once_with(self.user, ANY, index_user=False)
+        if indexed:
+            mocked_index.delay.assert_called_once_with([self.user.id], check_if_changed=True)
+        else:
+            assert mocked_index.delay.called is False
@@ -3,6 +3,7 @@ Tests for the dashboard api functions
 """
 from datetime import timedelta
 from unittest.mock import (
+    ANY,
     MagicMock,
     Mock,
     PropertyMock,
@@ -35,7 +36,7 @@ from dashboard.api import save_cache_update_failure, FIELD_USER_ID_BASE_STR
 from dashboard.api_edx_cache import CachedEdxDataApi
 from dashboard.factories import CachedEnrollmentFactory, CachedCurrentGradeFactory, UserCacheRefreshTimeFactory, \
     ProgramEnrollmentFactory
-from dashboard.models import CachedCertificate
+from dashboard.models import CachedCertificate, UserCacheUpdateFailure
 from dashboard.utils import MMTrack
 from exams.models import ExamAuthorization, ExamProfile
 from exams.factories import ExamRunFactory, ExamAuthorizationFactory
@@ -1524,14 +1525,12 @@ class UserProgramInfoIntegrationTest(MockedESTestCase):
         self.expected_programs = [self.program_non_fin_aid, self.program_fin_aid]
         self.edx_client = MagicMock()
 
-    @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_cache_if_expired', new_callable=MagicMock)
+    @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_expired_caches', new_callable=MagicMock)
     def test_format(self, mock_cache_refresh):
         """Test that get_user_program_info fetches edx data and returns a list of Program data"""
         result = api.get_user_program_info(self.user, self.edx_client)
 
-        assert mock_cache_refresh.call_count == len(CachedEdxDataApi.SUPPORTED_CACHES)
-        for cache_type in CachedEdxDataApi.SUPPORTED_CACHES:
-            mock_cache_refresh.assert_any_call(self.user, self.edx_client, cache_type)
+        mock_cache_refresh.assert_called_once_with(self.user, self.edx_client, ANY)
 
         assert isinstance(result, dict)
         assert 'is_edx_data_fresh' in result
@@ -1547,7 +1546,7 @@ class UserProgramInfoIntegrationTest(MockedESTestCase):
             }
             assert is_subset_dict(expected, result['programs'][i])
 
-    @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_cache_if_expired', new_callable=MagicMock)
+    @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_expired_caches', new_callable=MagicMock)
     def test_when_edx_client_is_none(self, mock_cache_refresh):
         """Test that the edx data is not refreshed"""
         api.get_user_program_info(self.user, None)
@@ -1723,14 +1722,14 @@ class UserProgramInfoIntegrationTest(MockedESTestCase):
         # assert that future run is first on run list
         assert result['programs'][0]['courses'][0]['runs'][0]['status'] == api.CourseRunStatus.WILL_ATTEND
 
-    @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_cache_if_expired', new_callable=MagicMock)
+    @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_expired_caches', new_callable=MagicMock)
     def test_exception_in_refresh_cache_1(self, mock_cache_refresh):
         """Test in case the backend refresh cache raises a InvalidCredentialStored exception"""
         mock_cache_refresh.side_effect = InvalidCredentialStored('error', http_status.HTTP_400_BAD_REQUEST)
         with self.assertRaises(InvalidCredentialStored):
             api.get_user_program_info(self.user, self.edx_client)
 
-    @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_cache_if_expired', new_callable=MagicMock)
+    @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_expired_caches', new_callable=MagicMock)
     def test_exception_in_refresh_cache_2(self, mock_cache_refresh):
         """Test in case the backend refresh cache raises any other exception"""
         mock_cache_refresh.side_effect = ZeroDivisionError
@@ -2234,12 +2233,23 @@ def test_calculate_exclude_users(users_without_with_cache, patched_redis_keys):
     """
     needs_update, _ = users_without_with_cache
     expected = needs_update[1:]
-    con = get_redis_connection('redis')
-    con.sadd(TEST_CACHE_KEY_USER_IDS_NOT_TO_UPDATE, needs_update[0].id)
+    UserCacheUpdateFailure.objects.create(user=needs_update[0])
 
     assert sorted(api.calculate_users_to_refresh_in_bulk()) == sorted([user.id for user in expected])
 
 
+@pytest.mark.parametrize("batch_size", [1, 2, 5, 10])
+def test_iter_users_to_refresh_in_bulk(users_without_with_cache, batch_size):
+    """
+    iter_users_to_refresh_in_bulk should yield the user ids to update in batches sorted by id
+    """
+    needs_update, _ = users_without_with_cache
+    batches = list(api.iter_users_to_refresh_in_bulk(batch_size=batch_size))
+
+    assert all(len(batch) <= batch_size for batch in batches)
+    assert [user_id for batch in batches for user_id in batch] == sorted([user.id for user in needs_update])
+
+
 def test_refresh_user_data(db, mocker):
     """refresh_user_data should refresh the cache on all cache types"""
     user = _make_fake_real_user()
@@ -2247,14 +2257,49 @@ def test_refresh_user_data(db, mocker):
     refresh_user_token_mock = mocker.patch('dashboard.api.utils.refresh_user_token', autospec=True)
     edx_api = mocker.Mock()
     edx_api_init = mocker.patch('dashboard.api.EdxApi', autospec=True, return_value=edx_api)
-    update_cache_mock = mocker.patch('dashboard.api.CachedEdxDataApi.update_cache_if_expired')
+    update_cache_mock = mocker.patch('dashboard.api.CachedEdxDataApi.update_cache_if_expired', return_value=True)
+    index_mock = mocker.patch('dashboard.api.index_users', autospec=True)
 
     api.refresh_user_data(user.id)
 
     refresh_user_token_mock.assert_called_once_with(user_social)
     edx_api_init.assert_called_once_with(user_social.extra_data, settings.EDXORG_BASE_URL)
     for cache_type in CachedEdxDataApi.SUPPORTED_CACHES:
-        update_cache_mock.assert_any_call(user, edx_api, cache_type)
+        update_cache_mock.assert_any_call(user, edx_api, cache_type, freshness=ANY, index_user=False)
+    # the user is indexed once for all the cache types
+    index_mock.delay.assert_called_once_with([user.id], check_if_changed=True)
+
+
+def test_refresh_user_data_unchanged(db, mocker):
+    """refresh_user_data should not re-index the user if no cache changed"""
+    user = _make_fake_real_user()
+    mocker.patch('dashboard.api.utils.refresh_user_token', autospec=True)
+    mocker.patch('dashboard.api.EdxApi', autospec=True)
+    mocker.patch('dashboard.api.CachedEdxDataApi.update_cache_if_expired', return_value=False)
+    index_mock = mocker.patch('dashboard.api.index_users', autospec=True)
+
+    assert api.refresh_user_data(user.id) is True
+    assert index_mock.delay.called is False
+
+
+@pytest.mark.parametrize("priority_scheduling", [True, False])
+@pytest.mark.parametrize("changed", [True, False])
+def test_refresh_user_data_records_outcome(db, mocker, settings, priority_scheduling, changed):
+    """refresh_user_data should keep track of whether the refresh changed the cache if the scheduler is enabled"""
+    settings.BATCH_UPDATE_PRIORITY_SCHEDULING = priority_scheduling
+    user = _make_fake_real_user()
+    mocker.patch('dashboard.api.utils.refresh_user_token', autospec=True)
+    mocker.patch('dashboard.api.EdxApi', autospec=True)
+    mocker.patch('dashboard.api.CachedEdxDataApi.update_cache_if_expired', return_value=changed)
+    mocker.patch('dashboard.api.index_users', autospec=True)
+    record_outcome_mock = mocker.patch('dashboard.api.record_refresh_outcome', autospec=True)
+
+    assert api.refresh_user_data(user.id) is True
+
+    if priority_scheduling:
+        record_outcome_mock.assert_called_once_with(user.id, changed)
+    else:
+        assert record_outcome_mock.called is False
 
 
 def test_refresh_missing_user(db, mocker):
@@ -2264,7 +2309,7 @@ def test_refresh_missing_user(db, mocker):
     edx_api_init = mocker.patch('dashboard.api.EdxApi', autospec=True, return_value=edx_api)
     update_cache_mock = mocker.patch('dashboard.api.CachedEdxDataApi.update_cache_if_expired')
 
-    api.refresh_user_data(999)
+    assert api.refresh_user_data(999) is False
 
     assert refresh_user_token_mock.called is False
     assert edx_api_init.called is False
@@ -2307,6 +2352,35 @@ def test_refresh_failed_oauth_update(db, mocker):
     assert save_failure_mock.called is True
 
 
+@pytest.mark.parametrize("fail_token_refresh", [True, False])
+def test_refresh_interactive_invalid_credential(db, mocker, fail_token_refresh):
+    """An interactive refresh should raise an invalid credential instead of counting it as a failure"""
+    user = _make_fake_real_user()
+    exc = InvalidCredentialStored('invalid token', 401)
+    mocker.patch(
+        'dashboard.api.utils.refresh_user_token', autospec=True, side_effect=exc if fail_token_refresh else None,
+    )
+    mocker.patch('dashboard.api.EdxApi', autospec=True)
+    mocker.patch('dashboard.api.CachedEdxDataApi.update_cache_if_expired', side_effect=exc)
+    save_failure_mock = mocker.patch('dashboard.api.save_cache_update_failure', autospec=True)
+
+    with pytest.raises(InvalidCredentialStored):
+        api.refresh_user_data(user.id, interactive=True)
+    assert save_failure_mock.called is False
+
+
+def test_refresh_interactive_failure(db, mocker):
+    """The failures of an interactive refresh should not be counted by the batch update"""
+    user = _make_fake_real_user()
+    mocker.patch('dashboard.api.utils.refresh_user_token', autospec=True)
+    mocker.patch('dashboard.api.EdxApi', autospec=True)
+    mocker.patch('dashboard.api.CachedEdxDataApi.update_cache_if_expired', side_effect=KeyError)
+    save_failure_mock = mocker.patch('dashboard.api.save_cache_update_failure', autospec=True)
+
+    assert api.refresh_user_data(user.id, interactive=True) is False
+    assert save_failure_mock.called is False
+
+
 def test_refresh_failed_edx_client(db, mocker):
     """If we fail to create the edx client, we should skip the edx refresh"""
     user = _make_fake_real_user()
@@ -2335,7 +2409,8 @@ def test_refresh_update_cache(db, mocker, failed_cache_type):
     edx_api = mocker.Mock()
     edx_api_init = mocker.patch('dashboard.api.EdxApi', autospec=True, return_value=edx_api)
 
-    def _update_cache(user, edx_client, cache_type):
+    # pylint: disable=unused-argument
+    def _update_cache(user, edx_client, cache_type, freshness=None, index_user=True):
         """Fail updating the cache for only the given cache type"""
         if cache_type == failed_cache_type:
             raise KeyError()
@@ -2345,13 +2420,13 @@ def test_refresh_update_cache(db, mocker, failed_cache_type):
     )
     save_failure_mock = mocker.patch('dashboard.api.save_cache_update_failure', autospec=True)
 
-    api.refresh_user_data(user.id)
+    assert api.refresh_user_data(user.id) is False
 
     refresh_user_token_mock.assert_called_once_with(user_social)
     edx_api_init.assert_called_once_with(user_social.extra_data, settings.EDXORG_BASE_URL)
     assert save_failure_mock.call_count == 1
     for cache_type in CachedEdxDataApi.SUPPORTED_CACHES:
-        update_cache_mock.assert_any_call(user, edx_api, cache_type)
+        update_cache_mock.assert_any_call(user, edx_api, cache_type, freshness=ANY, index_user=False)
 
 
 def test_save_cache_update_failures(db, patched_redis_keys):
@@ -2365,7 +2440,25 @@ def test_save_cache_update_failures(db, patched_redis_keys):
 
     save_cache_update_failure(user.id)
     assert int(con.hget(TEST_CACHE_KEY_FAILURES_BY_USER, user_key)) == 2
+    assert UserCacheUpdateFailure.objects.filter(user=user).exists() is False
 
     save_cache_update_failure(user.id)
     assert int(con.hget(TEST_CACHE_KEY_FAILURES_BY_USER, user_key)) == 3
     assert con.sismember(TEST_CACHE_KEY_USER_IDS_NOT_TO_UPDATE, user.id) is True
+    assert UserCacheUpdateFailure.objects.filter(user=user).exists() is True
+
+    save_cache_update_failure(user.id)
+    assert UserCacheUpdateFailure.objects.filter(user=user).count() == 1
+
+
+def test_clear_cache_update_failures(db, patched_redis_keys):
+    """Clearing the failures should let the bulk update refresh the user again"""
+    user = _make_fake_real_user()
+    con = get_redis_connection("redis")
+    for _ in range(3):
+        save_cache_update_failure(user.id)
+
+    api.clear_cache_update_failures(user.id)
+    assert con.hget(TEST_CACHE_KEY_FAILURES_BY_USER, FIELD_USER_ID_BASE_STR.format(user.id)) is None
+    assert con.sismember(TEST_CACHE_KEY_USER_IDS_NOT_TO_UPDATE, user.id) is False
+    assert UserCacheUpdateFailure.objects.filter(user=user).exists() is False
@@ -0,0 +1,32 @@
+"""
+Backfills the users whose edX cache failed to update too many times
+"""
+from django.contrib.auth.models import User
+from django.core.management import BaseCommand
+from django_redis import get_redis_connection
+
+from dashboard.api import CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE
+from dashboard.models import UserCacheUpdateFailure
+
+
+class Command(BaseCommand):
+    """
+    Copies the users in the redis set of users not to update to the UserCacheUpdateFailure table
+    """
+    help = "Copies the users in the redis set of users not to update to the UserCacheUpdateFailure table"
+
+    def handle(self, *args, **kwargs):  # pylint: disable=unused-argument
+        con = get_redis_connection("redis")
+        user_ids = [int(user_id) for user_id in con.smembers(CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE)]
+        UserCacheUpdateFailure.objects.bulk_create(
+            [
+                UserCacheUpdateFailure(user_id=user_id)
+                for user_id in User.objects.filter(id__in=user_ids).values_list('id', flat=True)
+            ],
+            ignore_conflicts=True,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            'Backfilled {0} users whose cache failed to update'.format(
+                UserCacheUpdateFailure.objects.filter(user_id__in=user_ids).count()
+            )
+        ))
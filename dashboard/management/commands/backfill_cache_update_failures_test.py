@@ -0,0 +1,32 @@
+"""Tests for the backfill_cache_update_failures command"""
+from django_redis import get_redis_connection
+
+from dashboard.api import CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE
+from dashboard.management.commands import backfill_cache_update_failures
+from dashboard.models import UserCacheUpdateFailure
+from micromasters.factories import UserFactory
+from search.base import MockedESTestCase
+
+
+class BackfillCacheUpdateFailuresTests(MockedESTestCase):
+    """Tests for the backfill_cache_update_failures command"""
+
+    def setUp(self):
+        super().setUp()
+        self.con = get_redis_connection("redis")
+        self.con.delete(CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE)
+        self.addCleanup(self.con.delete, CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE)
+
+    def test_backfill(self):
+        """The users in the redis set should be copied to the table, skipping the deleted and existing ones"""
+        failed_users = UserFactory.create_batch(3)
+        UserFactory.create()
+        UserCacheUpdateFailure.objects.create(user=failed_users[0])
+        self.con.sadd(CACHE_KEY_FAILED_USERS_NOT_TO_UPDATE, *[user.id for user in failed_users], 999999)
+
+        backfill_cache_update_failures.Command().handle()
+        backfill_cache_update_failures.Command().handle()
+
+        assert sorted(UserCacheUpdateFailure.objects.values_list('user_id', flat=True)) == sorted(
+            user.id for user in failed_users
+        )
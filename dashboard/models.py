@@ -4,6 +4,7 @@ Models for dashboard
 
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import JSONField
+from django.db import connection
 from django.db.models import (
     CASCADE,
     DateTimeField,
@@ -12,6 +13,7 @@ from django.db.models import (
     OneToOneField,
     CharField,
 )
+from django.db.models.signals import post_save
 from edx_api.certificates import (
     Certificate,
     Certificates,
@@ -106,9 +108,56 @@ class CachedEdxInfoModel(Model):
             course_ids_list (list): a list of course IDs to NOT be deleted
 
         Returns:
-            None
+            int: the number of deleted records
         """
-        cls.user_qset(user).exclude(course_run__edx_course_key__in=course_ids_list).delete()
+        deleted, _ = cls.user_qset(user).exclude(course_run__edx_course_key__in=course_ids_list).delete()
+        return deleted
+
+    @classmethod
+    def bulk_upsert_user_data(cls, user, data_by_course_run):
+        """
+        Inserts or updates all the cached records for a User with a single INSERT ... ON CONFLICT statement.
+        Records whose data did not change are left untouched.
+
+        Since the rows are not saved through the ORM, post_save is sent explicitly
+        for every record that has actually been created or updated.
+
+        Args:
+            user (User): an User object
+            data_by_course_run (dict): a map of CourseRun objects to the raw edX data to cache
+
+        Returns:
+            list: the records that have been created or updated
+        """
+        if not data_by_course_run:
+            return []
+        course_runs = {course_run.id: course_run for course_run in data_by_course_run}
+        data_field = cls._meta.get_field('data')
+        placeholders = []
+        params = []
+        for course_run, data in data_by_course_run.items():
+            placeholders.append('(%s, %s, %s)')
+            params.extend([user.id, course_run.id, data_field.get_db_prep_save(data, connection)])
+        sql = (
+            'INSERT INTO {table} (user_id, course_run_id, data) VALUES {values} '
+            'ON CONFLICT (user_id, course_run_id) DO UPDATE SET data = EXCLUDED.data '
+            'WHERE {table}.data IS DISTINCT FROM EXCLUDED.data '
+            'RETURNING id, course_run_id, (xmax = 0) AS created'
+        ).format(
+            table=connection.ops.quote_name(cls._meta.db_table),
+            values=', '.join(placeholders),
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+
+        upserted = []
+        for record_id, course_run_id, created in rows:
+            course_run = course_runs[course_run_id]
+            instance = cls(id=record_id, user=user, course_run=course_run, data=data_by_course_run[course_run])
+            post_save.send(sender=cls, instance=instance, created=created, update_fields=None, raw=False)
+            upserted.append(instance)
+        return upserted
 
     @staticmethod
     def deserialize_edx_data(data_iter):
@@ -125,6 +174,27 @@ class CachedEdxInfoModel(Model):
         """
         return cls.deserialize_edx_data(cls.data_qset(user, program=program))
 
+    @classmethod
+    def get_edx_data_for_users(cls, users, program=None):
+        """
+        Retrieves the cached data of many users with a single query and encapsulates it
+        in specific edx-api-client classes.
+
+        Args:
+            users (iterable of User): the users to fetch the cached data for
+            program (Program): optional Program to filter on
+
+        Returns:
+            dict: a map of user ids to edx-api-client objects
+        """
+        data_by_user = {user.id: [] for user in users}
+        query_params = dict(user_id__in=list(data_by_user))
+        if program is not None:
+            query_params.update(dict(course_run__course__program=program))
+        for user_id, data in cls.objects.filter(**query_params).values_list('user_id', 'data'):
+            data_by_user[user_id].append(data)
+        return {user_id: cls.deserialize_edx_data(data) for user_id, data in data_by_user.items()}
+
     @classmethod
     def get_cached_users(cls, course_run):
         """
@@ -213,6 +283,21 @@ class UserCacheRefreshTime(Model):
         return 'user "{0}"'.format(self.user.username)
 
 
+class UserCacheUpdateFailure(Model):
+    """
+    Model to store the users whose edX cache failed to update too many times, for example because of
+    invalid credentials. These users are skipped by the bulk update until they log in again.
+    """
+    user = OneToOneField(User, on_delete=CASCADE)
+    created_on = DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        """
+        String representation of the model object
+        """
+        return 'user "{0}"'.format(self.user.username)
+
+
 class ProgramEnrollment(Model):
     """
     Model for student enrollments in Programs
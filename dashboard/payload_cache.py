@@ -0,0 +1,117 @@
+"""
+Cache of the precomputed dashboard payload for a user and a program
+"""
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django_redis import get_redis_connection
+
+log = logging.getLogger(__name__)
+
+# change this every time the format of the program payload changes to invalidate all the cached payloads
+PAYLOAD_FORMAT_VERSION = 1
+
+USER_VERSION_KEY = 'dashboard_payload_user_version_{user_id}'
+PROGRAM_VERSION_KEY = 'dashboard_payload_program_version_{program_id}'
+PAYLOAD_KEY = 'dashboard_payload_{format_version}_{user_id}_{program_id}_{user_version}_{program_version}'
+
+
+def get_payload_cache_key(user_id, program_id):
+    """
+    Returns the key of the dashboard payload for the current versions of the user and of the program
+
+    Args:
+        user_id (int): the id of a User
+        program_id (int): the id of a Program
+
+    Returns:
+        str: the cache key of the payload
+    """
+    con = get_redis_connection("redis")
+    user_version, program_version = con.mget([
+        USER_VERSION_KEY.format(user_id=user_id),
+        PROGRAM_VERSION_KEY.format(program_id=program_id),
+    ])
+    return PAYLOAD_KEY.format(
+        format_version=PAYLOAD_FORMAT_VERSION,
+        user_id=user_id,
+        program_id=program_id,
+        user_version=int(user_version or 0),
+        program_version=int(program_version or 0),
+    )
+
+
+def get_or_build_payload(user_id, program_id, build_func):
+    """
+    Returns the cached dashboard payload for a user and a program, building and caching it if needed
+
+    Args:
+        user_id (int): the id of a User
+        program_id (int): the id of a Program
+        build_func (callable): a function without arguments returning the payload
+
+    Returns:
+        dict: the dashboard payload for the program
+    """
+    if not settings.DASHBOARD_PAYLOAD_CACHE_ENABLED:
+        return build_func()
+    # the key is computed before building the payload: if any version is bumped in the meantime,
+    # the payload is stored under a key which will not be read anymore
+    key = get_payload_cache_key(user_id, program_id)
+    cache = caches['redis']
+    payload = cache.get(key)
+    if payload is None:
+        payload = build_func()
+        cache.set(key, payload, timeout=settings.DASHBOARD_PAYLOAD_CACHE_SECONDS)
+    return payload
+
+
+def _incr_on_commit(keys):
+    """
+    Increments version keys once the current transaction has been committed,
+    so the new versions are never used to cache a payload built from data not yet committed
+
+    Args:
+        keys (list of str): the version keys
+    """
+    def _incr():
+        """Increment the versions"""
+        pipeline = get_redis_connection("redis").pipeline()
+        for key in keys:
+            pipeline.incr(key)
+        pipeline.execute()
+    transaction.on_commit(_incr)
+
+
+def bump_user_version(user_id):
+    """
+    Invalidates all the cached dashboard payloads of a user
+
+    Args:
+        user_id (int): the id of a User
+    """
+    _incr_on_commit([USER_VERSION_KEY.format(user_id=user_id)])
+
+
+def bump_user_versions(user_ids):
+    """
+    Invalidates all the cached dashboard payloads of many users, i.e. after a queryset update
+
+    Args:
+        user_ids (iterable of int): the ids of the Users
+    """
+    keys = [USER_VERSION_KEY.format(user_id=user_id) for user_id in sorted(set(user_ids))]
+    if keys:
+        _incr_on_commit(keys)
+
+
+def bump_program_version(program_id):
+    """
+    Invalidates all the cached dashboard payloads of a program
+
+    Args:
+        program_id (int): the id of a Program
+    """
+    _incr_on_commit([PROGRAM_VERSION_KEY.format(program_id=program_id)])
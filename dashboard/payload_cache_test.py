@@ -0,0 +1,173 @@
+"""
+Tests for the dashboard payload cache
+"""
+from unittest.mock import Mock
+
+from django.db.models.signals import post_save
+from django_redis import get_redis_connection
+from factory.django import mute_signals
+import pytest
+
+from courses.factories import CourseFactory, CourseRunFactory, ProgramFactory
+from courses.models import ElectiveCourse, ElectivesSet
+from dashboard.payload_cache import (
+    PROGRAM_VERSION_KEY,
+    USER_VERSION_KEY,
+    bump_program_version,
+    bump_user_version,
+    bump_user_versions,
+    get_or_build_payload,
+    get_payload_cache_key,
+)
+from exams.api import update_authorizations_for_exam_run
+from exams.factories import ExamAuthorizationFactory, ExamProfileFactory, ExamRunFactory
+from exams.models import ExamAuthorization
+from exams.signals import update_exam_profile
+from financialaid.factories import TierProgramFactory
+from grades.factories import FinalGradeFactory
+from micromasters.factories import UserFactory
+
+# pylint: disable=unused-argument,redefined-outer-name
+
+USER_ID = 987654
+PROGRAM_ID = 876543
+
+
+@pytest.fixture
+def clean_versions(settings):
+    """Enables the payload cache and cleans up the version keys used by the tests"""
+    settings.DASHBOARD_PAYLOAD_CACHE_ENABLED = True
+    yield
+    con = get_redis_connection("redis")
+    con.delete(USER_VERSION_KEY.format(user_id=USER_ID), PROGRAM_VERSION_KEY.format(program_id=PROGRAM_ID))
+
+
+@pytest.fixture
+def assert_rebuilt(settings, mocked_on_commit):
+    """
+    Returns a function which caches the payload of a user and a program, applies a change
+    and asserts that the payload is built again
+    """
+    settings.DASHBOARD_PAYLOAD_CACHE_ENABLED = True
+    keys = []
+
+    def _assert_rebuilt(user_id, program_id, change_func):
+        """Assert that change_func invalidates the cached payload"""
+        keys.extend([USER_VERSION_KEY.format(user_id=user_id), PROGRAM_VERSION_KEY.format(program_id=program_id)])
+        build_func = Mock(return_value={'id': program_id})
+        get_or_build_payload(user_id, program_id, build_func)
+        get_or_build_payload(user_id, program_id, build_func)
+        assert build_func.call_count == 1
+        change_func()
+        get_or_build_payload(user_id, program_id, build_func)
+        assert build_func.call_count == 2
+
+    yield _assert_rebuilt
+    if keys:
+        get_redis_connection("redis").delete(*keys)
+
+
+def test_payload_cache_disabled(settings):
+    """If the cache is disabled the payload is built every time"""
+    settings.DASHBOARD_PAYLOAD_CACHE_ENABLED = False
+    build_func = Mock(return_value={'id': PROGRAM_ID})
+    assert get_or_build_payload(USER_ID, PROGRAM_ID, build_func) == {'id': PROGRAM_ID}
+    assert get_or_build_payload(USER_ID, PROGRAM_ID, build_func) == {'id': PROGRAM_ID}
+    assert build_func.call_count == 2
+
+
+@pytest.mark.parametrize("bump_func, object_id", [
+    [bump_user_version, USER_ID],
+    [bump_program_version, PROGRAM_ID],
+])
+def test_payload_cache(clean_versions, mocked_on_commit, bump_func, object_id):
+    """The payload is built once and rebuilt after the user or program version is bumped"""
+    build_func = Mock(return_value={'id': PROGRAM_ID})
+    key = get_payload_cache_key(USER_ID, PROGRAM_ID)
+    assert get_or_build_payload(USER_ID, PROGRAM_ID, build_func) == {'id': PROGRAM_ID}
+    assert get_or_build_payload(USER_ID, PROGRAM_ID, build_func) == {'id': PROGRAM_ID}
+    assert build_func.call_count == 1
+
+    bump_func(object_id)
+    assert get_payload_cache_key(USER_ID, PROGRAM_ID) != key
+    build_func.return_value = {'id': PROGRAM_ID, 'changed': True}
+    assert get_or_build_payload(USER_ID, PROGRAM_ID, build_func) == {'id': PROGRAM_ID, 'changed': True}
+    assert build_func.call_count == 2
+
+
+def test_bump_waits_for_commit(clean_versions, mocker):
+    """The version is bumped only when the transaction commits"""
+    on_commit_mock = mocker.patch('django.db.transaction.on_commit', autospec=True)
+    key = get_payload_cache_key(USER_ID, PROGRAM_ID)
+    bump_user_version(USER_ID)
+    assert get_payload_cache_key(USER_ID, PROGRAM_ID) == key
+    on_commit_mock.call_args[0][0]()
+    assert get_payload_cache_key(USER_ID, PROGRAM_ID) != key
+
+
+def test_user_data_signal(db, mocker):
+    """Saving a FinalGrade invalidates the payloads of the user"""
+    bump_mock = mocker.patch('dashboard.signals.bump_user_version', autospec=True)
+    user = UserFactory.create()
+    FinalGradeFactory.create(user=user)
+    bump_mock.assert_any_call(user.id)
+
+
+def test_course_run_signal(db, mocker):
+    """Saving a CourseRun invalidates the payloads of the program"""
+    course_run = CourseRunFactory.create()
+    bump_mock = mocker.patch('dashboard.signals.bump_program_version', autospec=True)
+    course_run.save()
+    bump_mock.assert_called_once_with(course_run.course.program_id)
+
+
+def test_bump_user_versions(assert_rebuilt):
+    """Bumping the versions of many users invalidates the payloads of each of them"""
+    assert_rebuilt(USER_ID, PROGRAM_ID, lambda: bump_user_versions([USER_ID + 1, USER_ID, USER_ID]))
+
+
+def test_exam_profile_reset(db, assert_rebuilt):
+    """Resetting the ExamProfile of a profile which changed invalidates the payloads of the user"""
+    with mute_signals(post_save):
+        exam_profile = ExamProfileFactory.create()
+    profile = exam_profile.profile
+    assert_rebuilt(profile.user_id, PROGRAM_ID, lambda: update_exam_profile(type(profile), profile))
+
+
+def test_update_authorizations_for_exam_run(db, assert_rebuilt):
+    """Resetting the authorizations of an exam run invalidates the payloads of its program"""
+    with mute_signals(post_save):
+        exam_run = ExamRunFactory.create()
+        exam_auth = ExamAuthorizationFactory.create(exam_run=exam_run, status=ExamAuthorization.STATUS_SUCCESS)
+    assert_rebuilt(exam_auth.user_id, exam_run.course.program_id, lambda: update_authorizations_for_exam_run(exam_run))
+
+
+def test_electives_signals(db, assert_rebuilt):
+    """Editing the electives of a program invalidates the payloads of the program"""
+    program = ProgramFactory.create()
+    course = CourseFactory.create(program=program)
+    electives_set = ElectivesSet.objects.create(program=program, required_number=1, title='electives')
+
+    def _update_electives_set():
+        """Change the number of required electives"""
+        electives_set.required_number = 2
+        electives_set.save()
+
+    assert_rebuilt(USER_ID, program.id, _update_electives_set)
+    assert_rebuilt(
+        USER_ID, program.id, lambda: ElectiveCourse.objects.create(course=course, electives_set=electives_set)
+    )
+    assert_rebuilt(USER_ID, program.id, electives_set.delete)
+
+
+def test_tier_program_signal(db, assert_rebuilt):
+    """Editing the financial aid tiers of a program invalidates the payloads of the program"""
+    tier_program = TierProgramFactory.create()
+
+    def _update_tier_program():
+        """Change the discount of the tier"""
+        tier_program.discount_amount += 10
+        tier_program.save()
+
+    assert_rebuilt(USER_ID, tier_program.program_id, _update_tier_program)
+    assert_rebuilt(USER_ID, tier_program.program_id, tier_program.delete)
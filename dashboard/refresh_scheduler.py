@@ -0,0 +1,234 @@
+"""
+Priority-aware scheduling for the bulk refresh of the users' edX data
+"""
+import datetime
+import logging
+
+from django.conf import settings
+from django.db.models import (
+    DateTimeField,
+    Exists,
+    OuterRef,
+    Q,
+    Value,
+)
+from django.db.models.functions import Coalesce, Least
+from django_redis import get_redis_connection
+import pytz
+
+from dashboard.models import CachedEnrollment
+from micromasters.utils import chunks, now_in_utc
+
+
+log = logging.getLogger(__name__)
+
+# Users whose edX data is likely to change: enrolled in a live course run or in one about to freeze the
+# final grades, or recently logged in
+HOT = 'hot'
+# Users enrolled in a course run which has recently ended or which is about to start
+WARM = 'warm'
+# Everybody else
+DORMANT = 'dormant'
+# the tiers from the most to the least important
+TIERS = (HOT, WARM, DORMANT)
+
+RECENT_LOGIN_DELTA = datetime.timedelta(days=7)
+UPCOMING_FREEZE_DELTA = datetime.timedelta(days=14)
+RECENT_RUN_DELTA = datetime.timedelta(days=90)
+UPCOMING_RUN_DELTA = datetime.timedelta(days=30)
+
+CACHE_KEY_UNCHANGED_REFRESHES_BY_USER = "batch_update_unchanged_refreshes"
+CACHE_KEY_REFRESH_STATS = "batch_update_refresh_stats"
+CACHE_KEY_DISPATCH_RATE = "batch_update_dispatch_rate"
+
+NEVER_REFRESHED = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def get_refresh_intervals():
+    """
+    Returns how often the edX data of the users is refreshed for each tier
+
+    Returns:
+        dict: a map of tiers to timedelta objects
+    """
+    return {
+        HOT: datetime.timedelta(hours=settings.BATCH_UPDATE_HOT_REFRESH_HOURS),
+        WARM: datetime.timedelta(hours=settings.BATCH_UPDATE_WARM_REFRESH_HOURS),
+        DORMANT: datetime.timedelta(hours=settings.BATCH_UPDATE_DORMANT_REFRESH_HOURS),
+    }
+
+
+def _demote(tier):
+    """
+    Returns the tier right below the given one
+    """
+    return TIERS[min(TIERS.index(tier) + 1, len(TIERS) - 1)]
+
+
+def prioritize_users_to_refresh(users):
+    """
+    Selects the users whose edX data is due for a refresh according to their tier,
+    sorted from the most to the least important ones.
+
+    The tiers are calculated by the database. Users whose refreshes did not change anything
+    for a while are then demoted by one tier.
+
+    Args:
+        users (QuerySet): a queryset of the User objects which can be refreshed
+
+    Returns:
+        list of int: the ids of the users to refresh
+    """
+    now = now_in_utc()
+    intervals = get_refresh_intervals()
+    limits = {tier: now - interval for tier, interval in intervals.items()}
+    enrollments = CachedEnrollment.objects.filter(user=OuterRef('pk'))
+    never_refreshed = Value(NEVER_REFRESHED, output_field=DateTimeField())
+
+    candidates = users.annotate(
+        has_active_run=Exists(enrollments.filter(
+            Q(course_run__start_date__lte=now) &
+            (Q(course_run__end_date__isnull=True) | Q(course_run__end_date__gte=now))
+        )),
+        has_upcoming_freeze=Exists(enrollments.filter(
+            course_run__freeze_grade_date__gte=now,
+            course_run__freeze_grade_date__lte=now + UPCOMING_FREEZE_DELTA,
+        )),
+        has_recent_run=Exists(enrollments.filter(
+            Q(course_run__end_date__gte=now - RECENT_RUN_DELTA) |
+            Q(course_run__start_date__lte=now + UPCOMING_RUN_DELTA, course_run__start_date__gte=now)
+        )),
+        # a missing refresh time means that the cache type has never been refreshed
+        last_refresh=Least(
+            Coalesce('usercacherefreshtime__enrollment', never_refreshed),
+            Coalesce('usercacherefreshtime__certificate', never_refreshed),
+            Coalesce('usercacherefreshtime__current_grade', never_refreshed),
+        ),
+    ).filter(
+        Q(has_active_run=True, last_refresh__lt=limits[HOT]) |
+        Q(has_upcoming_freeze=True, last_refresh__lt=limits[HOT]) |
+        Q(last_login__gte=now - RECENT_LOGIN_DELTA, last_refresh__lt=limits[HOT]) |
+        Q(has_recent_run=True, last_refresh__lt=limits[WARM]) |
+        Q(last_refresh__lt=limits[DORMANT])
+    ).values_list(
+        'id', 'has_active_run', 'has_upcoming_freeze', 'has_recent_run', 'last_login', 'last_refresh',
+    )
+
+    user_tiers = {}
+    user_last_refresh = {}
+    for user_id, has_active_run, has_upcoming_freeze, has_recent_run, last_login, last_refresh in candidates:
+        logged_in_recently = last_login is not None and last_login >= now - RECENT_LOGIN_DELTA
+        if has_active_run or has_upcoming_freeze or logged_in_recently:
+            user_tiers[user_id] = HOT
+        elif has_recent_run:
+            user_tiers[user_id] = WARM
+        else:
+            user_tiers[user_id] = DORMANT
+        user_last_refresh[user_id] = last_refresh
+
+    unchanged_refreshes = get_unchanged_refreshes(list(user_tiers))
+    threshold = settings.BATCH_UPDATE_UNCHANGED_REFRESHES_TO_DEMOTE
+    for user_id, count in unchanged_refreshes.items():
+        if count >= threshold:
+            tier = _demote(user_tiers[user_id])
+            if user_last_refresh[user_id] < limits[tier]:
+                user_tiers[user_id] = tier
+            else:
+                # not due yet in the lower tier
+                del user_tiers[user_id]
+
+    return sorted(user_tiers, key=lambda user_id: (TIERS.index(user_tiers[user_id]), user_last_refresh[user_id]))
+
+
+def get_unchanged_refreshes(user_ids):
+    """
+    Returns the number of consecutive refreshes which did not change the edX data of each user
+
+    Args:
+        user_ids (list of int): the user ids
+
+    Returns:
+        dict: a map of user ids to the number of unchanged refreshes, users without any are omitted
+    """
+    con = get_redis_connection("redis")
+    unchanged_refreshes = {}
+    for user_ids_chunk in chunks(user_ids, chunk_size=1000):
+        counts = con.hmget(CACHE_KEY_UNCHANGED_REFRESHES_BY_USER, user_ids_chunk)
+        for user_id, count in zip(user_ids_chunk, counts):
+            if count is not None:
+                unchanged_refreshes[user_id] = int(count)
+    return unchanged_refreshes
+
+
+def record_refresh_outcome(user_id, changed):
+    """
+    Keeps track of how often a refresh changes the edX data of a user
+
+    Args:
+        user_id (int): The user id
+        changed (bool): whether the refresh changed the cached edX data
+    """
+    con = get_redis_connection("redis")
+    if changed:
+        con.hdel(CACHE_KEY_UNCHANGED_REFRESHES_BY_USER, user_id)
+    else:
+        con.hincrby(CACHE_KEY_UNCHANGED_REFRESHES_BY_USER, user_id, 1)
+
+
+def record_refresh_stats(duration, failed):
+    """
+    Stores the latency and the result of a refresh, used to adjust the pace of the next batch update
+
+    Args:
+        duration (float): the number of seconds the refresh took
+        failed (bool): whether the refresh failed
+    """
+    con = get_redis_connection("redis")
+    pipe = con.pipeline()
+    pipe.hincrby(CACHE_KEY_REFRESH_STATS, 'count', 1)
+    pipe.hincrbyfloat(CACHE_KEY_REFRESH_STATS, 'duration', duration)
+    if failed:
+        pipe.hincrby(CACHE_KEY_REFRESH_STATS, 'errors', 1)
+    pipe.execute()
+
+
+def calculate_dispatch_rate():
+    """
+    Calculates how many users per minute the next batch update should refresh.
+
+    The rate grows additively while edX answers quickly and without errors
+    and is halved when the latency or the error rate of the previous batch was too high.
+    The collected statistics are reset.
+
+    Returns:
+        float: the number of users to refresh per minute
+    """
+    min_rate = settings.BATCH_UPDATE_MIN_USERS_PER_MINUTE
+    max_rate = settings.BATCH_UPDATE_MAX_USERS_PER_MINUTE
+    con = get_redis_connection("redis")
+    pipe = con.pipeline()
+    pipe.get(CACHE_KEY_DISPATCH_RATE)
+    pipe.hgetall(CACHE_KEY_REFRESH_STATS)
+    pipe.delete(CACHE_KEY_REFRESH_STATS)
+    rate, stats, _ = pipe.execute()
+    rate = float(rate) if rate is not None else float(max_rate)
+
+    count = int(stats.get(b'count', 0))
+    if count > 0:
+        error_percent = 100 * int(stats.get(b'errors', 0)) / count
+        latency = float(stats.get(b'duration', 0)) / count
+        if (
+                error_percent > settings.BATCH_UPDATE_MAX_ERROR_PERCENT or
+                latency > settings.BATCH_UPDATE_TARGET_LATENCY_SECONDS
+        ):
+            rate = rate / 2
+        else:
+            rate = rate + max_rate / 10
+        log.info(
+            "Batch update stats: %d refreshes, %.1f%% errors, %.2fs average latency; next rate %.1f users/minute",
+            count, error_percent, latency, min(max(rate, min_rate), max_rate)
+        )
+
+    rate = min(max(rate, min_rate), max_rate)
+    con.set(CACHE_KEY_DISPATCH_RATE, rate)
+    return rate
@@ -0,0 +1,158 @@
+"""
+Tests for the priority-aware scheduling of the batch update
+"""
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django_redis import get_redis_connection
+import pytest
+
+from courses.factories import CourseRunFactory
+from dashboard import refresh_scheduler
+from dashboard.factories import CachedEnrollmentFactory, UserCacheRefreshTimeFactory
+from dashboard.refresh_scheduler import (
+    calculate_dispatch_rate,
+    get_unchanged_refreshes,
+    prioritize_users_to_refresh,
+    record_refresh_outcome,
+    record_refresh_stats,
+)
+from micromasters.factories import UserFactory
+from micromasters.utils import now_in_utc
+
+# pylint: disable=unused-argument,redefined-outer-name
+
+TEST_CACHE_KEY_UNCHANGED_REFRESHES = "test_batch_update_unchanged_refreshes"
+TEST_CACHE_KEY_REFRESH_STATS = "test_batch_update_refresh_stats"
+TEST_CACHE_KEY_DISPATCH_RATE = "test_batch_update_dispatch_rate"
+
+
+@pytest.fixture
+def patched_redis_keys(mocker, settings):
+    """Patch the redis keys used by the scheduler and sets the scheduler settings"""
+    settings.BATCH_UPDATE_HOT_REFRESH_HOURS = 6
+    settings.BATCH_UPDATE_WARM_REFRESH_HOURS = 24
+    settings.BATCH_UPDATE_DORMANT_REFRESH_HOURS = 24 * 7
+    settings.BATCH_UPDATE_UNCHANGED_REFRESHES_TO_DEMOTE = 2
+    settings.BATCH_UPDATE_MIN_USERS_PER_MINUTE = 10
+    settings.BATCH_UPDATE_MAX_USERS_PER_MINUTE = 100
+    settings.BATCH_UPDATE_TARGET_LATENCY_SECONDS = 5
+    settings.BATCH_UPDATE_MAX_ERROR_PERCENT = 5
+    mocker.patch.object(
+        refresh_scheduler, "CACHE_KEY_UNCHANGED_REFRESHES_BY_USER", TEST_CACHE_KEY_UNCHANGED_REFRESHES
+    )
+    mocker.patch.object(refresh_scheduler, "CACHE_KEY_REFRESH_STATS", TEST_CACHE_KEY_REFRESH_STATS)
+    mocker.patch.object(refresh_scheduler, "CACHE_KEY_DISPATCH_RATE", TEST_CACHE_KEY_DISPATCH_RATE)
+    yield
+    con = get_redis_connection("redis")
+    con.delete(TEST_CACHE_KEY_UNCHANGED_REFRESHES, TEST_CACHE_KEY_REFRESH_STATS, TEST_CACHE_KEY_DISPATCH_RATE)
+
+
+def _make_user(hours_since_refresh, course_run=None, last_login=None):
+    """Creates a user refreshed some hours ago and optionally enrolled in a course run"""
+    user = UserFactory.create(last_login=last_login)
+    if hours_since_refresh is not None:
+        refreshed_on = now_in_utc() - timedelta(hours=hours_since_refresh)
+        UserCacheRefreshTimeFactory.create(
+            user=user, enrollment=refreshed_on, certificate=refreshed_on, current_grade=refreshed_on
+        )
+    if course_run is not None:
+        CachedEnrollmentFactory.create(user=user, course_run=course_run)
+    return user
+
+
+@pytest.fixture
+def users_by_tier(db):
+    """Creates users in all the tiers, some of them due for a refresh"""
+    now = now_in_utc()
+    live_run = CourseRunFactory.create(start_date=now - timedelta(days=10), end_date=now + timedelta(days=10))
+    freezing_run = CourseRunFactory.create(
+        start_date=now - timedelta(days=100),
+        end_date=now - timedelta(days=95),
+        freeze_grade_date=now + timedelta(days=3),
+    )
+    ended_run = CourseRunFactory.create(start_date=now - timedelta(days=60), end_date=now - timedelta(days=30))
+    old_run = CourseRunFactory.create(start_date=now - timedelta(days=800), end_date=now - timedelta(days=700))
+    return {
+        'hot_due': _make_user(8, course_run=live_run),
+        'hot_freeze_due': _make_user(7, course_run=freezing_run),
+        'hot_login_due': _make_user(9, last_login=now - timedelta(days=1)),
+        'hot_not_due': _make_user(1, course_run=live_run),
+        'warm_due': _make_user(30, course_run=ended_run),
+        'warm_not_due': _make_user(8, course_run=ended_run),
+        'dormant_due': _make_user(24 * 8, course_run=old_run),
+        'dormant_never_refreshed': _make_user(None),
+        'dormant_not_due': _make_user(30, course_run=old_run),
+    }
+
+
+def test_prioritize_users_to_refresh(patched_redis_keys, users_by_tier):
+    """Users should be selected according to the refresh interval of their tier and sorted by priority"""
+    users = User.objects.filter(id__in=[user.id for user in users_by_tier.values()])
+    assert prioritize_users_to_refresh(users) == [
+        users_by_tier[name].id for name in [
+            'hot_login_due',
+            'hot_due',
+            'hot_freeze_due',
+            'warm_due',
+            'dormant_never_refreshed',
+            'dormant_due',
+        ]
+    ]
+
+
+def test_prioritize_demotes_unchanged_users(patched_redis_keys, users_by_tier):
+    """Users whose last refreshes did not change anything should be refreshed as if they were in the tier below"""
+    for name in ('hot_due', 'warm_due', 'dormant_due'):
+        for _ in range(2):
+            record_refresh_outcome(users_by_tier[name].id, changed=False)
+    users = User.objects.filter(id__in=[user.id for user in users_by_tier.values()])
+    # hot_due is not due as warm user and warm_due becomes dormant, which is not due either
+    assert prioritize_users_to_refresh(users) == [
+        users_by_tier[name].id for name in [
+            'hot_login_due',
+            'hot_freeze_due',
+            'dormant_never_refreshed',
+            'dormant_due',
+        ]
+    ]
+
+    record_refresh_outcome(users_by_tier['hot_due'].id, changed=True)
+    assert users_by_tier['hot_due'].id in prioritize_users_to_refresh(users)
+
+
+def test_record_refresh_outcome(patched_redis_keys):
+    """The unchanged refreshes should be counted until a refresh changes something"""
+    record_refresh_outcome(1, changed=False)
+    record_refresh_outcome(1, changed=False)
+    record_refresh_outcome(2, changed=False)
+    assert get_unchanged_refreshes([1, 2, 3]) == {1: 2, 2: 1}
+    record_refresh_outcome(1, changed=True)
+    assert get_unchanged_refreshes([1, 2, 3]) == {2: 1}
+
+
+@pytest.mark.parametrize("durations, failures, expected_rate", [
+    [[], 0, 100],
+    [[1, 2, 3], 0, 100],
+    [[1, 2, 30], 0, 50],
+    [[1] * 10, 1, 50],
+])
+def test_calculate_dispatch_rate(patched_redis_keys, durations, failures, expected_rate):
+    """The rate should be halved when edX is slow or failing and should never exceed the bounds"""
+    for index, duration in enumerate(durations):
+        record_refresh_stats(duration, failed=index < failures)
+    assert calculate_dispatch_rate() == expected_rate
+
+
+def test_calculate_dispatch_rate_recovers(patched_redis_keys):
+    """The rate should grow additively while edX is healthy and the statistics should be reset"""
+    record_refresh_stats(60, failed=True)
+    assert calculate_dispatch_rate() == 50
+    # no refreshes since the last calculation
+    assert calculate_dispatch_rate() == 50
+    record_refresh_stats(1, failed=False)
+    assert calculate_dispatch_rate() == 60
+    for _ in range(5):
+        record_refresh_stats(60, failed=True)
+        calculate_dispatch_rate()
+    assert calculate_dispatch_rate() == 10
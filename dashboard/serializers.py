@@ -49,7 +49,8 @@ class UserProgramSearchSerializer:
         has_paid = mmtrack.has_paid(course_run.edx_course_key)
         payment_status = cls.PAID_STATUS if has_paid else cls.UNPAID_STATUS
 
-        final_grade = mmtrack.get_final_grades_for_course(course_run.course).first()
+        final_grades = mmtrack.get_final_grades_for_course(course_run.course)
+        final_grade = final_grades[0] if final_grades else None
         semester = cls.serialize_semester(course_run)
         return {
             'final_grade': final_grade.grade_percent if final_grade else None,
@@ -93,7 +94,8 @@ class UserProgramSearchSerializer:
         has_paid = mmtrack.has_paid(course_run.edx_course_key)
         payment_status = cls.PAID_STATUS if has_paid else cls.UNPAID_STATUS
 
-        final_grade = mmtrack.get_final_grades_for_course(course_run.course).first()
+        final_grades = mmtrack.get_final_grades_for_course(course_run.course)
+        final_grade = final_grades[0] if final_grades else None
         return {
             'final_grade': final_grade.grade_percent if final_grade else None,
             'course_title': course_title,
@@ -130,13 +132,26 @@ class UserProgramSearchSerializer:
         return None
 
     @classmethod
-    def serialize(cls, program_enrollment):
+    def serialize(cls, program_enrollment, mmtrack=None, learner=None, total_courses=None):
         """
         Serializes a ProgramEnrollment object
+
+        Args:
+            program_enrollment (ProgramEnrollment): the ProgramEnrollment to serialize
+            mmtrack (MMTrack): optional MMTrack of the user in the program, i.e. one built by a MMTrackBatch
+            learner (bool): optional precomputed result of is_learner for the user in the program
+            total_courses (int): optional precomputed number of courses in the program
+        Returns:
+            dict: the serialized ProgramEnrollment
         """
         user = program_enrollment.user
         program = program_enrollment.program
-        mmtrack = get_mmtrack(user, program)
+        if mmtrack is None:
+            mmtrack = get_mmtrack(user, program)
+        if learner is None:
+            learner = is_learner(user, program)
+        if total_courses is None:
+            total_courses = program.course_set.count()
 
         return {
             'id': program.id,
@@ -144,9 +159,9 @@ class UserProgramSearchSerializer:
             'courses': cls.serialize_course_enrollments(mmtrack),
             'course_runs': cls.serialize_course_runs_enrolled(mmtrack),
             'grade_average': mmtrack.calculate_final_grade_average(),
-            'is_learner': is_learner(user, program),
+            'is_learner': learner,
             'num_courses_passed': mmtrack.count_courses_passed(),
-            'total_courses': program.course_set.count()
+            'total_courses': total_courses
         }
 
 
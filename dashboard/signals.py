@@ -2,10 +2,34 @@
 Signals for user profiles
 """
 from django.db import transaction
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 
-from dashboard.models import ProgramEnrollment
+from courses.models import (
+    Course,
+    CourseRun,
+    ElectiveCourse,
+    ElectivesSet,
+    Program,
+)
+from dashboard.models import (
+    CachedCertificate,
+    CachedCurrentGrade,
+    CachedEnrollment,
+    ProgramEnrollment,
+)
+from dashboard.payload_cache import bump_program_version, bump_user_version
+from ecommerce.models import Order
+from exams.models import ExamAuthorization, ExamProfile, ExamRun
+from financialaid.models import FinancialAid, TierProgram
+from grades.models import (
+    CombinedFinalGrade,
+    FinalGrade,
+    MicromastersCourseCertificate,
+    MicromastersProgramCertificate,
+    MicromastersProgramCommendation,
+    ProctoredExamGrade,
+)
 from search.tasks import index_program_enrolled_users, remove_program_enrolled_user
 
 
@@ -24,3 +48,87 @@ def handle_delete_programenrollment(sender, instance, **kwargs):  # pylint: disa
     """
     enrollment_id = instance.id  # this is modified in-place on delete, so store it on a local
     transaction.on_commit(lambda: remove_program_enrolled_user.delay(enrollment_id))
+
+
+@receiver(post_save, sender=CachedEnrollment, dispatch_uid="cachedenrollment_post_save_payload")
+@receiver(post_delete, sender=CachedEnrollment, dispatch_uid="cachedenrollment_post_delete_payload")
+@receiver(post_save, sender=CachedCertificate, dispatch_uid="cachedcertificate_post_save_payload")
+@receiver(post_delete, sender=CachedCertificate, dispatch_uid="cachedcertificate_post_delete_payload")
+@receiver(post_save, sender=CachedCurrentGrade, dispatch_uid="cachedcurrentgrade_post_save_payload")
+@receiver(post_delete, sender=CachedCurrentGrade, dispatch_uid="cachedcurrentgrade_post_delete_payload")
+@receiver(post_save, sender=FinalGrade, dispatch_uid="finalgrade_post_save_payload")
+@receiver(post_save, sender=ProctoredExamGrade, dispatch_uid="proctoredexamgrade_post_save_payload")
+@receiver(post_save, sender=CombinedFinalGrade, dispatch_uid="combinedfinalgrade_post_save_payload")
+@receiver(post_save, sender=Order, dispatch_uid="order_post_save_payload")
+@receiver(post_save, sender=FinancialAid, dispatch_uid="financialaid_post_save_payload")
+@receiver(post_save, sender=ExamAuthorization, dispatch_uid="examauthorization_post_save_payload")
+@receiver(post_save, sender=MicromastersCourseCertificate, dispatch_uid="coursecertificate_post_save_payload")
+@receiver(post_save, sender=MicromastersProgramCertificate, dispatch_uid="programcertificate_post_save_payload")
+@receiver(post_save, sender=MicromastersProgramCommendation, dispatch_uid="commendation_post_save_payload")
+def handle_user_dashboard_data_change(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    When some data about a user changes, invalidate the cached dashboard payloads of the user
+    """
+    if instance.user_id is not None:
+        bump_user_version(instance.user_id)
+
+
+@receiver(post_save, sender=ExamProfile, dispatch_uid="examprofile_post_save_payload")
+def handle_exam_profile_change(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    When an ExamProfile changes, invalidate the cached dashboard payloads of the user
+    """
+    bump_user_version(instance.profile.user_id)
+
+
+@receiver(post_save, sender=Program, dispatch_uid="program_post_save_payload")
+def handle_program_change(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    When a Program is edited, invalidate all its cached dashboard payloads
+    """
+    bump_program_version(instance.id)
+
+
+@receiver(post_save, sender=ElectivesSet, dispatch_uid="electivesset_post_save_payload")
+@receiver(post_delete, sender=ElectivesSet, dispatch_uid="electivesset_post_delete_payload")
+@receiver(post_save, sender=TierProgram, dispatch_uid="tierprogram_post_save_payload")
+@receiver(post_delete, sender=TierProgram, dispatch_uid="tierprogram_post_delete_payload")
+def handle_program_settings_change(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    When the electives or the financial aid tiers of a program are edited, invalidate all its cached
+    dashboard payloads
+    """
+    bump_program_version(instance.program_id)
+
+
+@receiver(post_save, sender=ElectiveCourse, dispatch_uid="electivecourse_post_save_payload")
+@receiver(post_delete, sender=ElectiveCourse, dispatch_uid="electivecourse_post_delete_payload")
+def handle_elective_course_change(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    When an ElectiveCourse is edited, invalidate all the cached dashboard payloads of its program
+    """
+    program_id = Course.objects.filter(id=instance.course_id).values_list('program_id', flat=True).first()
+    if program_id is not None:
+        bump_program_version(program_id)
+
+
+@receiver(post_save, sender=Course, dispatch_uid="course_post_save_payload")
+@receiver(post_delete, sender=Course, dispatch_uid="course_post_delete_payload")
+def handle_course_change(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    When a Course is edited, invalidate all the cached dashboard payloads of its program
+    """
+    bump_program_version(instance.program_id)
+
+
+@receiver(post_save, sender=CourseRun, dispatch_uid="courserun_post_save_payload")
+@receiver(post_delete, sender=CourseRun, dispatch_uid="courserun_post_delete_payload")
+@receiver(post_save, sender=ExamRun, dispatch_uid="examrun_post_save_payload")
+@receiver(post_delete, sender=ExamRun, dispatch_uid="examrun_post_delete_payload")
+def handle_course_run_change(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    """
+    When a CourseRun or an ExamRun is edited, invalidate all the cached dashboard payloads of its program
+    """
+    program_id = Course.objects.filter(id=instance.course_id).values_list('program_id', flat=True).first()
+    if program_id is not None:
+        bump_program_version(program_id)
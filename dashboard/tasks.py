@@ -5,19 +5,29 @@ from datetime import (
     datetime,
     timedelta,
 )
+import json
 import logging
+import time
 
 from celery import group
 from django.conf import settings
+from django_redis import get_redis_connection
 import pytz
 
+from backends.exceptions import InvalidCredentialStored
 from dashboard.api import (
-    calculate_users_to_refresh_in_bulk,
+    USERS_TO_REFRESH_BATCH_SIZE,
+    iter_users_to_refresh_in_bulk,
     refresh_user_data,
 )
+from dashboard.refresh_scheduler import (
+    calculate_dispatch_rate,
+    record_refresh_stats,
+)
 from micromasters.celery import app
 from micromasters.locks import (
     Lock,
+    is_locked,
     release_lock,
 )
 from micromasters.utils import (
@@ -30,16 +40,31 @@ log = logging.getLogger(__name__)
 
 
 LOCK_ID = 'batch_update_user_data_lock'
+# number of batches of users dispatched by batch_update_user_data which are not done yet
+CACHE_KEY_PENDING_BATCHES = 'batch_update_user_data_pending_{}'
+BATCH_UPDATE_CHUNK_SIZE = 20
+# the paced subtasks are all due this long before the broker would deliver them again
+VISIBILITY_TIMEOUT_MARGIN_SECONDS = 10 * 60
+USER_REFRESH_LOCK_ID = 'refresh_user_data_lock_{}'
+# the invalid edX credential found by the refresh of a user, until the dashboard tells the user to log in again
+USER_CREDENTIAL_ERROR_KEY = 'refresh_user_data_credential_error_{}'
+USER_CREDENTIAL_ERROR_SECONDS = 24 * 60 * 60
 
 
 @app.task
 def release_batch_update_user_data_lock(*args, token):  # pylint: disable=unused-argument
     """
-    Task which releases the lock acquired in batch_update_user_data
+    Task which marks a batch of users dispatched by batch_update_user_data as done
+    and releases the lock acquired in batch_update_user_data after the last one
 
     Args:
         token (str): The token used with the lock
     """
+    con = get_redis_connection("redis")
+    pending_key = CACHE_KEY_PENDING_BATCHES.format(token)
+    if con.decr(pending_key) > 0:
+        return
+    con.delete(pending_key)
     release_lock(LOCK_ID, token.encode())
     log.info("Released batch_update_user_data lock")
 
@@ -60,20 +85,78 @@ def batch_update_user_data():
         log.error("Unable to acquire lock for batch_update_user_data")
         return
 
-    users_to_refresh = calculate_users_to_refresh_in_bulk()
-
-    jobs = release_batch_update_user_data_lock.s(token=lock.token.decode())
+    token = lock.token.decode()
+    con = get_redis_connection("redis")
+    # the dispatch itself counts as a pending batch, so the lock can't be released before it is done
+    con.set(CACHE_KEY_PENDING_BATCHES.format(token), 1, ex=int((expiration - now_in_utc()).total_seconds()))
     try:
-        if len(users_to_refresh) > 0:
-            user_id_chunks = chunks(users_to_refresh)
-
-            job = group(
-                batch_update_user_data_subtasks.s(user_id_chunk, expiration.timestamp())
-                for user_id_chunk in user_id_chunks
-            )
-            jobs = job | jobs
+        # the users are dispatched as soon as each batch is read from the database
+        for subtasks in _iter_subtask_batches(expiration):
+            con.incr(CACHE_KEY_PENDING_BATCHES.format(token))
+            (group(subtasks) | release_batch_update_user_data_lock.s(token=token)).delay()
     finally:
-        jobs.delay()
+        release_batch_update_user_data_lock.delay(token=token)
+
+
+def _iter_subtask_batches(expiration):
+    """
+    Iterates over the subtasks refreshing the users which need to be updated, one batch of users at a time
+
+    Args:
+        expiration (datetime.datetime): when the batch update should stop processing
+
+    Yields:
+        list of celery.Signature: the subtasks for a batch of users
+    """
+    if settings.BATCH_UPDATE_PRIORITY_SCHEDULING:
+        users_to_refresh = [
+            user_id for user_ids in iter_users_to_refresh_in_bulk() for user_id in user_ids
+        ]
+        yield from chunks(
+            _paced_subtasks(users_to_refresh, expiration),
+            chunk_size=USERS_TO_REFRESH_BATCH_SIZE // BATCH_UPDATE_CHUNK_SIZE,
+        )
+        return
+
+    for user_ids in iter_users_to_refresh_in_bulk():
+        yield [
+            batch_update_user_data_subtasks.s(user_id_chunk, expiration.timestamp())
+            for user_id_chunk in chunks(user_ids, chunk_size=BATCH_UPDATE_CHUNK_SIZE)
+        ]
+
+
+def _paced_subtasks(users_to_refresh, expiration):
+    """
+    Creates the subtasks for the users to refresh, spread over time at the rate calculated
+    from the performance of the previous batch updates. The users which would not be refreshed
+    before the expiration, or before the broker delivers again the tasks waiting for their countdown,
+    are left for the next batch update.
+
+    Args:
+        users_to_refresh (list of int): user ids sorted from the most to the least important
+        expiration (datetime.datetime): when the batch update should stop processing
+
+    Returns:
+        list of celery.Signature: the subtasks to run
+    """
+    users_per_minute = calculate_dispatch_rate()
+    max_countdown = settings.CELERY_BROKER_TRANSPORT_OPTIONS['visibility_timeout'] - VISIBILITY_TIMEOUT_MARGIN_SECONDS
+    dispatch_seconds = min((expiration - now_in_utc()).total_seconds(), max_countdown)
+    max_users = int(users_per_minute * dispatch_seconds / 60)
+    if len(users_to_refresh) > max_users:
+        log.info(
+            "Batch update will refresh %d of %d users, the others are left for the next run",
+            max_users, len(users_to_refresh)
+        )
+    seconds_per_chunk = BATCH_UPDATE_CHUNK_SIZE * 60 / users_per_minute
+    return [
+        batch_update_user_data_subtasks.s(user_id_chunk, expiration.timestamp()).set(
+            countdown=round(index * seconds_per_chunk)
+        )
+        for index, user_id_chunk in enumerate(
+            chunks(users_to_refresh[:max_users], chunk_size=BATCH_UPDATE_CHUNK_SIZE)
+        )
+    ]
 
 
 @app.task(rate_limit=settings.BATCH_UPDATE_RATE_LIMIT)
@@ -89,4 +172,92 @@ def batch_update_user_data_subtasks(students, expiration_timestamp):
     for user_id in students:
         # if we are past the expiration time we should stop any extra work
         if expiration > now_in_utc():
-            refresh_user_data(user_id)
+            start = time.monotonic()
+            succeeded = refresh_user_data(user_id)
+            if settings.BATCH_UPDATE_PRIORITY_SCHEDULING:
+                record_refresh_stats(time.monotonic() - start, failed=not succeeded)
+
+
+def _user_refresh_lock_id(user_id):
+    """
+    Returns the name of the lock which deduplicates the dashboard refreshes for a user
+
+    Args:
+        user_id (int): The user id
+    """
+    return USER_REFRESH_LOCK_ID.format(user_id)
+
+
+def schedule_user_data_refresh(user_id):
+    """
+    Enqueues a refresh of the edX data for a user, unless one is already scheduled or running
+
+    Args:
+        user_id (int): The user id
+
+    Returns:
+        bool: True if a new refresh has been enqueued
+    """
+    expiration = now_in_utc() + timedelta(seconds=settings.DASHBOARD_REFRESH_LOCK_SECONDS)
+    lock = Lock(_user_refresh_lock_id(user_id), expiration)
+    if not lock.acquire():
+        return False
+    refresh_user_data_async.delay(user_id, token=lock.token.decode())
+    return True
+
+
+def is_user_data_refresh_scheduled(user_id):
+    """
+    Checks if a refresh of the edX data for a user is scheduled or running
+
+    Args:
+        user_id (int): The user id
+
+    Returns:
+        bool: True if the refresh lock is held
+    """
+    return is_locked(_user_refresh_lock_id(user_id))
+
+
+@app.task
+def refresh_user_data_async(user_id, *, token):
+    """
+    Refreshes the edX data for a user and releases the lock acquired in schedule_user_data_refresh
+
+    Args:
+        user_id (int): The user id
+        token (str): The token used with the lock
+    """
+    try:
+        refresh_user_data(user_id, interactive=True)
+    except InvalidCredentialStored as exc:
+        log.exception('Access token for user %s is fresh but invalid; forcing login.', user_id)
+        get_redis_connection("redis").set(
+            USER_CREDENTIAL_ERROR_KEY.format(user_id),
+            json.dumps({'error': str(exc), 'http_status_code': exc.http_status_code}),
+            ex=USER_CREDENTIAL_ERROR_SECONDS,
+        )
+    finally:
+        release_lock(_user_refresh_lock_id(user_id), token.encode())
+
+
+def pop_user_credential_error(user_id):
+    """
+    Returns and forgets the invalid edX credential found by the last refresh of a user, if any
+
+    Args:
+        user_id (int): The user id
+
+    Returns:
+        InvalidCredentialStored: The error, or None if the credential of the user was valid
+    """
+    con = get_redis_connection("redis")
+    key = USER_CREDENTIAL_ERROR_KEY.format(user_id)
+    pipeline = con.pipeline()
+    pipeline.get(key)
+    pipeline.delete(key)
+    value, _ = pipeline.execute()
+    if value is None:
+        return None
+    error = json.loads(value)
+    return InvalidCredentialStored(error['error'], error['http_status_code'])
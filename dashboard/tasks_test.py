@@ -3,19 +3,33 @@ Tests for tasks
 """
 from datetime import timedelta
 
+from django_redis import get_redis_connection
+
+from backends.exceptions import InvalidCredentialStored
 from dashboard.tasks import (
+    _paced_subtasks,
     batch_update_user_data,
+    is_user_data_refresh_scheduled,
+    pop_user_credential_error,
+    refresh_user_data_async,
+    schedule_user_data_refresh,
+    BATCH_UPDATE_CHUNK_SIZE,
+    CACHE_KEY_PENDING_BATCHES,
     LOCK_ID,
+    VISIBILITY_TIMEOUT_MARGIN_SECONDS,
 )
 from micromasters.factories import SocialUserFactory
-from micromasters.utils import is_near_now
+from micromasters.utils import (
+    is_near_now,
+    now_in_utc,
+)
 
 
 def test_nothing_to_do(mocker):
     """
     If there's nothing to update batch_update_user_date should only acquire and release the lock
     """
-    calc_mock = mocker.patch('dashboard.tasks.calculate_users_to_refresh_in_bulk', autospec=True, return_value=[])
+    calc_mock = mocker.patch('dashboard.tasks.iter_users_to_refresh_in_bulk', autospec=True, return_value=[])
     lock_mock_init = mocker.patch('dashboard.tasks.Lock', autospec=True)
     lock_mock = lock_mock_init.return_value
     token = b'token'
@@ -40,8 +54,8 @@ def test_batch_update(mocker, db):  # pylint: disable=unused-argument
     batch_update_user_data should create a group of tasks operating on chunks of users to refresh their caches
     """
     users = SocialUserFactory.create_batch(25)
-    calc_mock = mocker.patch('dashboard.tasks.calculate_users_to_refresh_in_bulk', autospec=True, return_value=[
-        user.id for user in users
+    calc_mock = mocker.patch('dashboard.tasks.iter_users_to_refresh_in_bulk', autospec=True, return_value=[
+        [user.id for user in users]
     ])
     lock_mock_init = mocker.patch('dashboard.tasks.Lock', autospec=True)
     lock_mock = lock_mock_init.return_value
@@ -63,11 +77,84 @@ def test_batch_update(mocker, db):  # pylint: disable=unused-argument
     release_mock.assert_called_once_with(LOCK_ID, token)
 
 
+def test_batch_update_streams_batches(mocker, db):  # pylint: disable=unused-argument
+    """
+    batch_update_user_data should dispatch each batch of users separately and release the lock after the last one
+    """
+    users = SocialUserFactory.create_batch(25)
+    mocker.patch('dashboard.tasks.iter_users_to_refresh_in_bulk', autospec=True, return_value=iter([
+        [user.id for user in users[:10]],
+        [user.id for user in users[10:]],
+    ]))
+    lock_mock_init = mocker.patch('dashboard.tasks.Lock', autospec=True)
+    lock_mock = lock_mock_init.return_value
+    token = b'token'
+    lock_mock.token = token
+    lock_mock.acquire.return_value = True
+    refresh_mock = mocker.patch('dashboard.tasks.refresh_user_data', autospec=True)
+    release_mock = mocker.patch('dashboard.tasks.release_lock', autospec=True)
+
+    batch_update_user_data()
+
+    assert [call[0][0] for call in refresh_mock.call_args_list] == [user.id for user in users]
+    release_mock.assert_called_once_with(LOCK_ID, token)
+    assert get_redis_connection("redis").exists(CACHE_KEY_PENDING_BATCHES.format(token.decode())) == 0
+
+
+def test_batch_update_priority_scheduling(mocker, db, settings):  # pylint: disable=unused-argument
+    """
+    With the priority scheduling batch_update_user_data should refresh only as many users as the dispatch rate allows
+    and keep track of the result of each refresh
+    """
+    settings.BATCH_UPDATE_PRIORITY_SCHEDULING = True
+    users = SocialUserFactory.create_batch(25)
+    mocker.patch('dashboard.tasks.iter_users_to_refresh_in_bulk', autospec=True, return_value=[
+        [user.id for user in users]
+    ])
+    # a bit less than 15 users in the 5 hours before the lock expires
+    mocker.patch('dashboard.tasks.calculate_dispatch_rate', autospec=True, return_value=0.05)
+    lock_mock_init = mocker.patch('dashboard.tasks.Lock', autospec=True)
+    lock_mock = lock_mock_init.return_value
+    lock_mock.token = b'token'
+    lock_mock.acquire.return_value = True
+    refresh_mock = mocker.patch('dashboard.tasks.refresh_user_data', autospec=True, return_value=True)
+    record_stats_mock = mocker.patch('dashboard.tasks.record_refresh_stats', autospec=True)
+    mocker.patch('dashboard.tasks.release_lock', autospec=True)
+
+    batch_update_user_data()
+
+    # the first users are the most important ones
+    assert [call[0][0] for call in refresh_mock.call_args_list] == [user.id for user in users[:14]]
+    assert record_stats_mock.call_count == 14
+    for call in record_stats_mock.call_args_list:
+        assert call[1] == {'failed': False}
+
+
+def test_paced_subtasks_visibility_timeout(mocker, settings):
+    """
+    The countdowns of the paced subtasks should stay below the visibility timeout of the broker,
+    the remaining users are left for the next batch update
+    """
+    settings.CELERY_BROKER_TRANSPORT_OPTIONS = {
+        'visibility_timeout': 2 * 60 * 60 + VISIBILITY_TIMEOUT_MARGIN_SECONDS,
+    }
+    # one chunk of users per minute
+    mocker.patch('dashboard.tasks.calculate_dispatch_rate', autospec=True, return_value=BATCH_UPDATE_CHUNK_SIZE)
+    users_to_refresh = list(range(10000))
+
+    subtasks = _paced_subtasks(users_to_refresh, now_in_utc() + timedelta(hours=5))
+
+    assert len(subtasks) == 2 * 60
+    dispatched_users = [user_id for subtask in subtasks for user_id in subtask.args[0]]
+    assert dispatched_users == users_to_refresh[:2 * 60 * BATCH_UPDATE_CHUNK_SIZE]
+    assert max(subtask.options['countdown'] for subtask in subtasks) < 2 * 60 * 60
+
+
 def test_failed_to_acquire(mocker):
     """
     If the lock is held there should be nothing else done
     """
-    calc_mock = mocker.patch('dashboard.tasks.calculate_users_to_refresh_in_bulk', autospec=True, return_value=[])
+    calc_mock = mocker.patch('dashboard.tasks.iter_users_to_refresh_in_bulk', autospec=True, return_value=[])
     lock_mock_init = mocker.patch('dashboard.tasks.Lock', autospec=True)
     lock_mock = lock_mock_init.return_value
     lock_mock.acquire.return_value = False
@@ -82,3 +169,52 @@ def test_failed_to_acquire(mocker):
     lock_mock.acquire.assert_called_once_with()
     assert refresh_mock.called is False
     assert release_mock.called is False
+
+
+def test_schedule_user_data_refresh(mocker, settings):
+    """
+    schedule_user_data_refresh should enqueue only one refresh per user until the lock is released
+    """
+    settings.DASHBOARD_REFRESH_LOCK_SECONDS = 60
+    task_mock = mocker.patch('dashboard.tasks.refresh_user_data_async', autospec=True)
+    user_id = 123456
+
+    assert is_user_data_refresh_scheduled(user_id) is False
+    assert schedule_user_data_refresh(user_id) is True
+    assert is_user_data_refresh_scheduled(user_id) is True
+    assert task_mock.delay.call_count == 1
+    assert task_mock.delay.call_args[0] == (user_id, )
+    token = task_mock.delay.call_args[1]['token']
+
+    # a second request does not enqueue anything
+    assert schedule_user_data_refresh(user_id) is False
+    assert task_mock.delay.call_count == 1
+
+    refresh_mock = mocker.patch('dashboard.tasks.refresh_user_data', autospec=True)
+    refresh_user_data_async(user_id, token=token)
+    refresh_mock.assert_called_once_with(user_id, interactive=True)
+    assert is_user_data_refresh_scheduled(user_id) is False
+
+
+def test_refresh_user_data_async_invalid_credential(mocker, settings):
+    """
+    If the background refresh finds an invalid edX credential, the error should be kept for the dashboard
+    """
+    settings.DASHBOARD_REFRESH_LOCK_SECONDS = 60
+    mocker.patch('dashboard.tasks.refresh_user_data_async.delay', autospec=True)
+    user_id = 234567
+    assert schedule_user_data_refresh(user_id) is True
+    token = refresh_user_data_async.delay.call_args[1]['token']
+    mocker.patch(
+        'dashboard.tasks.refresh_user_data', autospec=True,
+        side_effect=InvalidCredentialStored('invalid token', 401),
+    )
+
+    assert pop_user_credential_error(user_id) is None
+    refresh_user_data_async(user_id, token=token)
+    assert is_user_data_refresh_scheduled(user_id) is False
+    exc = pop_user_credential_error(user_id)
+    assert str(exc) == 'invalid token'
+    assert exc.http_status_code == 401
+    # the error is reported only once
+    assert pop_user_credential_error(user_id) is None
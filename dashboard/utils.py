@@ -2,6 +2,7 @@
 Utility functions and classes for the dashboard
 """
 import logging
+from collections import defaultdict, namedtuple
 from decimal import Decimal
 
 from django.conf import settings
@@ -9,7 +10,7 @@ from django.db import transaction
 from django.db.models import Q, Count
 from django.urls import reverse
 
-from courses.models import CourseRun, Course
+from courses.models import CourseRun
 from dashboard.api_edx_cache import CachedEdxUserData
 from dashboard.models import ProgramEnrollment
 from ecommerce.models import Order, Line
@@ -32,6 +33,84 @@ from micromasters.utils import now_in_utc
 log = logging.getLogger(__name__)
 
 
+# In-memory indexes of the data of a user in a program, fetched in bulk by MMTrackBatch
+MMTrackPrefetchedData = namedtuple('MMTrackPrefetchedData', [
+    'final_grade_index',
+    'paid_order_ids_by_key',
+    'combined_final_grades_by_course',
+    'proctored_exam_grades_by_course',
+])
+
+
+class FinalGradeIndex:
+    """
+    In-memory index of the completed FinalGrades of a user in a program
+    """
+
+    def __init__(self, final_grades):
+        """
+        Args:
+            final_grades (iterable of grades.models.FinalGrade): final grades with their course run already joined
+        """
+        # Maps a CourseRun's edx_course_key to its FinalGrade
+        self.by_course_run_key = {}
+        # Maps a Course id to the FinalGrades of its CourseRuns, the best grade first
+        self.by_course_id = defaultdict(list)
+        for final_grade in final_grades:
+            self.by_course_run_key[final_grade.course_run.edx_course_key] = final_grade
+            self.by_course_id[final_grade.course_run.course_id].append(final_grade)
+        for course_final_grades in self.by_course_id.values():
+            # same order as the database, which sorts NULL values first for descending orderings
+            course_final_grades.sort(
+                key=lambda final_grade: (final_grade.grade is not None, -(final_grade.grade or 0))
+            )
+
+
+class MMTrackProgramData:
+    """
+    Program level data needed by MMTrack, which is the same for all the users enrolled in the program
+    """
+
+    def __init__(self, program, prefetch_course_runs=False):
+        """
+        Args:
+            program (programs.models.Program): a program
+            prefetch_course_runs (bool): if true, also load the CourseRuns of the program with their Course
+        """
+        self.program = program
+        self.edx_course_keys_no_exam = set()
+        self.courses = []
+        # CourseRuns of the program in the default ordering, only loaded when prefetch_course_runs is true
+        self.course_runs = None
+
+        with transaction.atomic():
+            # Maps a CourseRun's edx_course_key to its parent Course id
+            self.edx_key_course_map = dict(
+                CourseRun.objects.filter(course__program=program).exclude(
+                    Q(edx_course_key__isnull=True) | Q(edx_course_key__exact='')
+                ).values_list("edx_course_key", "course__id")
+            )
+
+            if program.financial_aid_availability:
+                # edx course keys for courses with no exam
+                self.edx_course_keys_no_exam = set(CourseRun.objects.filter(
+                    course__program=program, course__exam_runs__isnull=True
+                ).values_list("edx_course_key", flat=True))
+                self.courses = list(program.course_set.all())
+
+            if prefetch_course_runs:
+                self.course_runs = list(
+                    CourseRun.objects.filter(course__program=program).exclude(
+                        Q(edx_course_key__isnull=True) | Q(edx_course_key__exact='')
+                    ).select_related('course')
+                )
+
+        # Maps a Course id to the edx_course_keys of its CourseRuns
+        self.course_edx_keys = defaultdict(set)
+        for edx_course_key, course_id in self.edx_key_course_map.items():
+            self.course_edx_keys[course_id].add(edx_course_key)
+
+
 class MMTrack:
     """
     Abstraction around the user status in courses.
@@ -49,12 +128,14 @@ class MMTrack:
     edx_course_keys_no_exam = set()  # Course keys for courses that don't have exams
     exam_card_status = None
 
-    def __init__(self, user, program, edx_user_data):
+    def __init__(self, user, program, edx_user_data, program_data=None, prefetched_data=None):
         """
         Args:
             user (User): a Django user
             program (programs.models.Program): program where the user is enrolled
             edx_user_data (dashboard.api_edx_cache.CachedEdxUserData): A CachedEdxUserData object
+            program_data (MMTrackProgramData): optional program level data shared with other users
+            prefetched_data (MMTrackPrefetchedData): optional user data fetched in bulk for the program
         """
         self.now = now_in_utc()
         self.user = user
@@ -64,24 +145,20 @@ class MMTrack:
         self.certificates = edx_user_data.certificates
         self.financial_aid_available = program.financial_aid_availability
         self.paid_course_fa = {}  # courses_id -> payment number association for financial aid courses
+        self.prefetched_data = prefetched_data
+        self._final_grade_index = prefetched_data.final_grade_index if prefetched_data is not None else None
 
-        with transaction.atomic():
-            # Maps a CourseRun's edx_course_key to its parent Course id
-            self.edx_key_course_map = dict(
-                CourseRun.objects.filter(course__program=program).exclude(
-                    Q(edx_course_key__isnull=True) | Q(edx_course_key__exact='')
-                ).values_list("edx_course_key", "course__id")
-            )
-            self.edx_course_keys = set(self.edx_key_course_map.keys())
+        if program_data is None:
+            program_data = MMTrackProgramData(program)
+        self.edx_key_course_map = program_data.edx_key_course_map
+        self.edx_course_keys = set(self.edx_key_course_map.keys())
+        self.edx_course_keys_no_exam = program_data.edx_course_keys_no_exam
+        self.course_edx_keys = program_data.course_edx_keys
+        self._course_runs = program_data.course_runs
 
-            if self.financial_aid_available:
-                # edx course keys for courses with no exam
-                self.edx_course_keys_no_exam = set(CourseRun.objects.filter(
-                    course__program=program, course__exam_runs__isnull=True
-                ).values_list("edx_course_key", flat=True))
-
-                for course in self.program.course_set.all():
-                    self.paid_course_fa[course.id] = self.get_payments_count_for_course(course) > 0
+        if self.financial_aid_available:
+            for course in program_data.courses:
+                self.paid_course_fa[course.id] = self.get_payments_count_for_course(course) > 0
 
     def __str__(self):
         return 'MMTrack for user {0} on program "{1}"'.format(
@@ -168,6 +245,20 @@ class MMTrack:
         """Base queryset for the MMTrack User's completed FinalGrades"""
         return FinalGrade.objects.filter(user=self.user, status=FinalGradeStatus.COMPLETE)
 
+    @property
+    def final_grade_index(self):
+        """
+        In-memory index of the MMTrack User's completed FinalGrades in the program,
+        loaded with a single query the first time it is needed.
+        """
+        if self._final_grade_index is None:
+            self._final_grade_index = FinalGradeIndex(
+                self.final_grade_qset.filter(course_run__course__program=self.program).select_related(
+                    'course_run__course'
+                )
+            )
+        return self._final_grade_index
+
     def get_final_grade(self, edx_course_key):
         """
         Gets a user's FinalGrade for a CourseRun matching a course run key
@@ -177,7 +268,7 @@ class MMTrack:
         Returns:
             FinalGrade: a Final Grade object or None
         """
-        return self.final_grade_qset.for_course_run_key(edx_course_key).first()
+        return self.final_grade_index.by_course_run_key.get(edx_course_key)
 
     def get_required_final_grade(self, edx_course_key):
         """
@@ -191,7 +282,12 @@ class MMTrack:
         Returns:
             FinalGrade: a Final Grade object
         """
-        return self.final_grade_qset.for_course_run_key(edx_course_key).get()
+        final_grade = self.get_final_grade(edx_course_key)
+        if final_grade is None:
+            raise FinalGrade.DoesNotExist(
+                'No final grade for user {} in course run {}'.format(self.user.username, edx_course_key)
+            )
+        return final_grade
 
     def has_final_grade(self, edx_course_key):
         """
@@ -202,7 +298,7 @@ class MMTrack:
         Returns:
             bool: whether a frozen final grade exists
         """
-        return self.final_grade_qset.for_course_run_key(edx_course_key).exists()
+        return edx_course_key in self.final_grade_index.by_course_run_key
 
     def has_paid(self, edx_course_key):
         """
@@ -217,8 +313,7 @@ class MMTrack:
         # financial aid programs need to have a paid entry for the course
         if self.financial_aid_available:
             # get the course associated with the course key
-            course = Course.objects.get(courserun__edx_course_key=edx_course_key)
-            return self.paid_course_fa.get(course.id, False)
+            return self.paid_course_fa.get(self.edx_key_course_map.get(edx_course_key), False)
 
         # normal programs need to have paid_on_edx in the final grades or a verified enrollment
         if self.has_final_grade(edx_course_key):
@@ -233,6 +328,11 @@ class MMTrack:
         Returns:
             int: count of paid course runs
         """
+        if self.prefetched_data is not None:
+            order_ids = set()
+            for edx_course_key in self.course_edx_keys.get(course.id, ()):
+                order_ids.update(self.prefetched_data.paid_order_ids_by_key.get(edx_course_key, ()))
+            return len(order_ids)
         return Line.objects.filter(
             order__status__in=Order.FULFILLED_STATUSES,
             order__user=self.user,
@@ -254,7 +354,8 @@ class MMTrack:
         Returns:
             bool: whether or not a user has a final grade and has paid
         """
-        return self.final_grade_qset.paid_on_edx().for_course_run_key(edx_course_key).exists()
+        final_grade = self.get_final_grade(edx_course_key)
+        return final_grade is not None and final_grade.course_run_paid_on_edx
 
     def has_paid_final_grade(self, edx_course_key):
         """
@@ -298,12 +399,11 @@ class MMTrack:
         Returns:
             dict: dictionary of course_ids: FinalGrade objects
         """
-        grades = (
-            self.final_grade_qset
-            .for_course_run_keys(self.edx_course_keys)
-            .select_related('course_run')
-        )
-        return {grade.course_run.edx_course_key: grade for grade in grades}
+        return {
+            edx_course_key: final_grade
+            for edx_course_key, final_grade in self.final_grade_index.by_course_run_key.items()
+            if edx_course_key in self.edx_course_keys
+        }
 
     def get_final_grades_for_course(self, course):
         """
@@ -311,9 +411,9 @@ class MMTrack:
         Args:
             course (courses.models.Course): a course
         Returns:
-            qset: a queryset of all final grades for course
+            list: all final grades for course, the best grade first
         """
-        return self.final_grade_qset.filter(course_run__in=course.courserun_set.all()).order_by('-grade')
+        return list(self.final_grade_index.by_course_id.get(course.id, []))
 
     def get_best_final_grade_for_course(self, course):
         """
@@ -324,7 +424,10 @@ class MMTrack:
         Returns:
             grades.models.FinalGrade: the best final grade
         """
-        return self.get_final_grades_for_course(course).passed().first()
+        return next(
+            (final_grade for final_grade in self.get_final_grades_for_course(course) if final_grade.passed),
+            None
+        )
 
     def get_overall_final_grade_for_course(self, course):
         """
@@ -341,11 +444,24 @@ class MMTrack:
         if not course.has_exam:
             return str(round(best_grade.grade_percent))
 
-        combined_grade = CombinedFinalGrade.objects.filter(user=self.user, course=course)
-        if combined_grade.exists():
-            return str(round(combined_grade.first().grade))
+        combined_grade = self.get_combined_final_grade(course)
+        if combined_grade is not None:
+            return str(round(combined_grade.grade))
         return ""
 
+    def get_combined_final_grade(self, course):
+        """
+        Returns the combined final grade of the user for a course
+
+        Args:
+            course (courses.models.Course): a course
+        Returns:
+            grades.models.CombinedFinalGrade: the combined final grade or None
+        """
+        if self.prefetched_data is not None:
+            return self.prefetched_data.combined_final_grades_by_course.get(course.id)
+        return CombinedFinalGrade.objects.filter(user=self.user, course=course).first()
+
     def get_all_enrolled_course_runs(self):
         """
         Returns a list of CourseRuns for which the user is either enrolled
@@ -360,6 +476,9 @@ class MMTrack:
             if course_id in final_grades or self.enrollments.is_enrolled_in(course_id):
                 enrolled_course_ids.append(course_id)
 
+        if self._course_runs is not None:
+            enrolled_course_ids = set(enrolled_course_ids)
+            return [course_run for course_run in self._course_runs if course_run.edx_course_key in enrolled_course_ids]
         return list(CourseRun.objects.filter(edx_course_key__in=enrolled_course_ids).select_related('course'))
 
     def calculate_final_grade_average(self):
@@ -369,7 +488,7 @@ class MMTrack:
         Returns:
             float: The average final grade or None if no final grades
         """
-        final_grades = self.final_grade_qset.for_course_run_keys(self.edx_course_keys)
+        final_grades = list(self.get_all_final_grades().values())
         if final_grades:
             return round(
                 sum(Decimal(final_grade.grade_percent) for final_grade in final_grades) /
@@ -401,8 +520,14 @@ class MMTrack:
             int: A number of passed courses.
         """
         if self.financial_aid_available:
+            if self.prefetched_data is not None:
+                combined_grades_count = len(self.prefetched_data.combined_final_grades_by_course)
+            else:
+                combined_grades_count = CombinedFinalGrade.objects.filter(
+                    user=self.user, course__program=self.program
+                ).count()
             return sum([
-                CombinedFinalGrade.objects.filter(user=self.user, course__program=self.program).count(),
+                combined_grades_count,
                 self.count_passing_courses_for_keys(self.edx_course_keys_no_exam)
             ])
         else:
@@ -417,11 +542,11 @@ class MMTrack:
         Returns:
             int: A number of passed courses
         """
-        return (
-            self.final_grade_qset.for_course_run_keys(edx_course_keys).passed()
-            .values_list('course_run__course__id', flat=True)
-            .distinct().count()
-        )
+        return len({
+            final_grade.course_run.course_id
+            for edx_course_key, final_grade in self.final_grade_index.by_course_run_key.items()
+            if edx_course_key in edx_course_keys and final_grade.passed
+        })
 
     def get_exam_card_status(self):  # pylint: disable=too-many-return-statements
         """
@@ -493,6 +618,9 @@ class MMTrack:
         Returns:
             grades.models.ProctoredExamGrade: the best exam grade
         """
+        if self.prefetched_data is not None:
+            passed_grades = [grade for grade in self.get_course_proctorate_exam_results(course) if grade.passed]
+            return max(passed_grades, key=lambda grade: grade.percentage_grade, default=None)
         return self.get_course_proctorate_exam_results(course).filter(
             passed=True
         ).order_by('-percentage_grade').first()
@@ -505,8 +633,10 @@ class MMTrack:
             course (courses.models.Course): a course
 
         Returns:
-            qset: a queryset of grades.models.ProctoredExamGrade
+            qset: a queryset (or a list if the data is prefetched) of grades.models.ProctoredExamGrade
         """
+        if self.prefetched_data is not None:
+            return list(self.prefetched_data.proctored_exam_grades_by_course.get(course.id, []))
         return ProctoredExamGrade.for_user_course(self.user, course)
 
     def get_course_certificate(self, course):
@@ -592,6 +722,89 @@ def get_mmtrack(user, program):
     )
 
 
+class MMTrackBatch:
+    """
+    Factory of MMTrack objects for many users enrolled in the same program.
+
+    The program level data is computed once and the data of all the users is fetched with
+    set-based queries, so the number of queries does not depend on the number of users.
+    The MMTrack objects only know about the data in the program and don't see later changes.
+    """
+
+    def __init__(self, program, users):
+        """
+        Args:
+            program (programs.models.Program): the program where the users are enrolled
+            users (iterable of User): the Django users
+        """
+        users = list(users)
+        self.program = program
+        self.program_data = MMTrackProgramData(program, prefetch_course_runs=True)
+        self.edx_user_data = CachedEdxUserData.for_users(users, program=program)
+        self.prefetched_data = {
+            user.id: MMTrackPrefetchedData(
+                final_grade_index=None,
+                paid_order_ids_by_key=defaultdict(set),
+                combined_final_grades_by_course={},
+                proctored_exam_grades_by_course=defaultdict(list),
+            ) for user in users
+        }
+        user_ids = list(self.prefetched_data)
+
+        final_grades_by_user = defaultdict(list)
+        final_grades = FinalGrade.objects.filter(
+            user_id__in=user_ids,
+            status=FinalGradeStatus.COMPLETE,
+            course_run__course__program=program,
+        ).select_related('course_run__course')
+        for final_grade in final_grades:
+            final_grades_by_user[final_grade.user_id].append(final_grade)
+        for user_id, user_data in self.prefetched_data.items():
+            self.prefetched_data[user_id] = user_data._replace(
+                final_grade_index=FinalGradeIndex(final_grades_by_user[user_id])
+            )
+
+        paid_lines = Line.objects.filter(
+            order__status__in=Order.FULFILLED_STATUSES,
+            order__user_id__in=user_ids,
+            course_key__in=list(self.program_data.edx_key_course_map),
+        ).values_list('order__user_id', 'order_id', 'course_key')
+        for user_id, order_id, course_key in paid_lines:
+            self.prefetched_data[user_id].paid_order_ids_by_key[course_key].add(order_id)
+
+        combined_final_grades = CombinedFinalGrade.objects.filter(user_id__in=user_ids, course__program=program)
+        for combined_final_grade in combined_final_grades:
+            user_data = self.prefetched_data[combined_final_grade.user_id]
+            user_data.combined_final_grades_by_course[combined_final_grade.course_id] = combined_final_grade
+
+        proctored_exam_grades = ProctoredExamGrade.objects.filter(
+            user_id__in=user_ids,
+            course__program=program,
+            exam_run__date_grades_available__lte=now_in_utc(),
+        )
+        for proctored_exam_grade in proctored_exam_grades:
+            user_data = self.prefetched_data[proctored_exam_grade.user_id]
+            user_data.proctored_exam_grades_by_course[proctored_exam_grade.course_id].append(proctored_exam_grade)
+
+    def get_mmtrack(self, user):
+        """
+        Creates the mmtrack object for one of the users of the batch.
+
+        Args:
+            user (User): a Django user of the batch
+
+        Returns:
+            mmtrack (dashboard.utils.MMTrack): a instance of all user information about the program
+        """
+        return MMTrack(
+            user,
+            self.program,
+            self.edx_user_data[user.id],
+            program_data=self.program_data,
+            prefetched_data=self.prefetched_data[user.id],
+        )
+
+
 def convert_to_letter(grade):
     """Convert a decimal number to letter grade"""
     grade = round(grade, 1)
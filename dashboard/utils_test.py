@@ -8,8 +8,10 @@ from unittest.mock import (
     PropertyMock
 )
 
+from django.db import connection
 from django.urls import reverse
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 
 import pytz
 import ddt
@@ -17,12 +19,14 @@ import ddt
 from cms.factories import ProgramCertificateSignatoriesFactory, ProgramLetterSignatoryFactory, ImageFactory
 from courses.factories import ProgramFactory, CourseFactory, CourseRunFactory
 from dashboard.api_edx_cache import CachedEdxUserData
+from dashboard.factories import CachedEnrollmentFactory
 from dashboard.models import CachedEnrollment, CachedCertificate, CachedCurrentGrade
-from dashboard.utils import get_mmtrack, MMTrack, convert_to_letter
+from dashboard.utils import get_mmtrack, MMTrack, MMTrackBatch, convert_to_letter
 from ecommerce.factories import LineFactory, OrderFactory
 from ecommerce.models import Order
 from exams.factories import ExamProfileFactory, ExamAuthorizationFactory, ExamRunFactory
 from exams.models import ExamProfile, ExamAuthorization
+from grades.constants import FinalGradeStatus
 from grades.factories import FinalGradeFactory, ProctoredExamGradeFactory
 from grades.models import FinalGrade, MicromastersProgramCertificate, CombinedFinalGrade, \
     MicromastersProgramCommendation
@@ -407,6 +411,61 @@ class MMTrackTest(MockedESTestCase):
         with self.assertRaises(FinalGrade.DoesNotExist):
             mmtrack.get_required_final_grade('random-course-id')
 
+    def test_final_grades_number_of_queries(self):
+        """
+        All the final grade lookups should be answered by a single query
+        """
+        passed_grade = FinalGradeFactory.create(
+            user=self.user, course_run=self.cruns[0], grade=0.8, passed=True, course_run_paid_on_edx=True
+        )
+        failed_grade = FinalGradeFactory.create(
+            user=self.user, course_run=self.cruns[1], grade=0.4, passed=False, course_run_paid_on_edx=False
+        )
+        FinalGradeFactory.create(
+            user=self.user, course_run=self.cruns[2], grade=0.9, passed=True, status=FinalGradeStatus.PENDING
+        )
+        # a grade in another program
+        FinalGradeFactory.create(user=self.user, passed=True)
+        mmtrack = MMTrack(
+            user=self.user,
+            program=self.program,
+            edx_user_data=self.cached_edx_user_data
+        )
+        with self.assertNumQueries(1):
+            assert mmtrack.get_final_grade(passed_grade.course_run.edx_course_key) == passed_grade
+            assert mmtrack.get_final_grade(self.cruns[2].edx_course_key) is None
+            assert mmtrack.has_final_grade(failed_grade.course_run.edx_course_key) is True
+            assert mmtrack.has_passed_course(passed_grade.course_run.edx_course_key) is True
+            assert mmtrack.has_passed_course(failed_grade.course_run.edx_course_key) is False
+            assert mmtrack.has_final_grade_paid_on_edx(passed_grade.course_run.edx_course_key) is True
+            assert mmtrack.has_paid(failed_grade.course_run.edx_course_key) is False
+            assert mmtrack.get_all_final_grades() == {
+                passed_grade.course_run.edx_course_key: passed_grade,
+                failed_grade.course_run.edx_course_key: failed_grade,
+            }
+            assert mmtrack.get_final_grades_for_course(self.course) == [passed_grade, failed_grade]
+            assert mmtrack.get_best_final_grade_for_course(self.course) == passed_grade
+            assert mmtrack.calculate_final_grade_average() == 60
+            assert mmtrack.count_passing_courses_for_keys(mmtrack.edx_course_keys) == 1
+            assert mmtrack.count_courses_passed() == 1
+
+    def test_get_final_grades_for_course_ordering(self):
+        """
+        get_final_grades_for_course should return the grades in the same order as the database
+        """
+        grades = [
+            FinalGradeFactory.create(user=self.user, course_run=self.cruns[index], grade=grade)
+            for index, grade in enumerate([0.5, 0.3, 0.7])
+        ]
+        mmtrack = MMTrack(
+            user=self.user,
+            program=self.program,
+            edx_user_data=self.cached_edx_user_data
+        )
+        expected = list(FinalGrade.objects.filter(user=self.user).order_by('-grade'))
+        assert expected == [grades[2], grades[0], grades[1]]
+        assert mmtrack.get_final_grades_for_course(self.course) == expected
+
     def test_get_current_grade(self):
         """
         Test for get_current_grade method
@@ -440,15 +499,24 @@ class MMTrackTest(MockedESTestCase):
             course_run=course_run,
             passed=True
         )
+        mmtrack = MMTrack(
+            user=self.user,
+            program=self.program,
+            edx_user_data=self.cached_edx_user_data
+        )
         assert mmtrack.count_courses_passed() == 1
 
         course = CourseFactory.create(program=self.program)
-        final_grade = FinalGradeFactory.create(
+        FinalGradeFactory.create(
             user=self.user,
             course_run__course=course,
             passed=True
         )
-        mmtrack.edx_course_keys.add(final_grade.course_run.edx_course_key)
+        mmtrack = MMTrack(
+            user=self.user,
+            program=self.program,
+            edx_user_data=self.cached_edx_user_data
+        )
         assert mmtrack.count_courses_passed() == 2
 
     def test_count_courses_passed_fa(self):
@@ -513,15 +581,24 @@ class MMTrackTest(MockedESTestCase):
                 course_run=course_run,
                 passed=True
             )
+            mmtrack = MMTrack(
+                user=self.user,
+                program=self.program,
+                edx_user_data=self.cached_edx_user_data
+            )
             assert mmtrack.count_passing_courses_for_keys(mmtrack.edx_course_keys) == 1
 
         # now create a grade for another course
-        final_grade = FinalGradeFactory.create(
+        FinalGradeFactory.create(
             user=self.user,
             course_run__course__program=self.program,
             passed=True
         )
-        mmtrack.edx_course_keys.add(final_grade.course_run.edx_course_key)
+        mmtrack = MMTrack(
+            user=self.user,
+            program=self.program,
+            edx_user_data=self.cached_edx_user_data
+        )
         assert mmtrack.count_passing_courses_for_keys(mmtrack.edx_course_keys) == 2
 
     def test_has_paid_fa_no_final_grade(self):
@@ -620,9 +697,19 @@ class MMTrackTest(MockedESTestCase):
         assert mmtrack.has_paid(key) is False
         course_run = self.cruns[-1]
         final_grade = FinalGradeFactory.create(user=self.user, course_run=course_run, course_run_paid_on_edx=True)
+        mmtrack = MMTrack(
+            user=self.user,
+            program=self.program,
+            edx_user_data=self.cached_edx_user_data
+        )
         assert mmtrack.has_paid(key) is True
         final_grade.course_run_paid_on_edx = False
         final_grade.save()
+        mmtrack = MMTrack(
+            user=self.user,
+            program=self.program,
+            edx_user_data=self.cached_edx_user_data
+        )
         assert mmtrack.has_paid(key) is False
 
     def test_has_paid_for_any_in_program(self):
@@ -639,9 +726,19 @@ class MMTrackTest(MockedESTestCase):
         )
         assert mmtrack.has_paid_for_any_in_program() is False
         fg = FinalGradeFactory.create(user=self.user, course_run=new_course_runs[0], course_run_paid_on_edx=True)
+        mmtrack = MMTrack(
+            user=self.user,
+            program=new_program,
+            edx_user_data=self.cached_edx_user_data
+        )
         assert mmtrack.has_paid_for_any_in_program() is True
         fg.delete()
         FinalGradeFactory.create(user=self.user, course_run=new_course_runs[1], course_run_paid_on_edx=True)
+        mmtrack = MMTrack(
+            user=self.user,
+            program=new_program,
+            edx_user_data=self.cached_edx_user_data
+        )
         assert mmtrack.has_paid_for_any_in_program() is True
 
     @ddt.data(
@@ -781,6 +878,11 @@ class MMTrackTest(MockedESTestCase):
                 course=finaid_course,
             )
             FinalGradeFactory.create(user=self.user, course_run=course_run, grade=grade, passed=True)
+        mmtrack = MMTrack(
+            user=self.user,
+            program=self.program_financial_aid,
+            edx_user_data=self.cached_edx_user_data
+        )
         assert mmtrack.get_best_final_grade_for_course(finaid_course).grade == 0.8
 
     def test_get_overall_final_grade_for_course(self):
@@ -795,6 +897,11 @@ class MMTrackTest(MockedESTestCase):
         finaid_course = self.crun_fa.course
         assert mmtrack.get_overall_final_grade_for_course(finaid_course) == ""
         FinalGradeFactory.create(user=self.user, course_run=self.crun_fa, passed=True, grade=0.8)
+        mmtrack = MMTrack(
+            user=self.user,
+            program=self.program_financial_aid,
+            edx_user_data=self.cached_edx_user_data
+        )
         assert mmtrack.get_overall_final_grade_for_course(finaid_course) == "80"
         ExamRunFactory.create(course=finaid_course)
         CombinedFinalGrade.objects.create(user=self.user, course=finaid_course, grade="74")
@@ -980,6 +1087,105 @@ class MMTrackTest(MockedESTestCase):
             assert mmtrack.get_exam_card_status() == ExamProfile.PROFILE_SUCCESS
 
 
+class MMTrackBatchTest(MockedESTestCase):
+    """
+    Tests for the MMTrackBatch class
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.program = ProgramFactory.create(live=True, financial_aid_availability=True, price=1000)
+        cls.course_with_exam = CourseFactory.create(program=cls.program)
+        cls.course_no_exam = CourseFactory.create(program=cls.program)
+        last_week = now_in_utc() - timedelta(weeks=1)
+        cls.exam_run = ExamRunFactory.create(course=cls.course_with_exam, date_grades_available=last_week)
+        cls.course_runs = CourseRunFactory.create_batch(2, course=cls.course_with_exam)
+        cls.course_runs.append(CourseRunFactory.create(course=cls.course_no_exam))
+        cls.users = UserFactory.create_batch(3)
+
+        for user_index, user in enumerate(cls.users[:2]):
+            for run_index, course_run in enumerate(cls.course_runs):
+                CachedEnrollmentFactory.create(user=user, course_run=course_run)
+                FinalGradeFactory.create(
+                    user=user,
+                    course_run=course_run,
+                    grade=0.4 + 0.1 * user_index + 0.01 * run_index,
+                    passed=user_index == 0,
+                )
+            order = OrderFactory.create(user=user, status=Order.FULFILLED)
+            LineFactory.create(order=order, course_key=cls.course_runs[0].edx_course_key)
+            ProctoredExamGradeFactory.create(
+                user=user, course=cls.course_with_exam, exam_run=cls.exam_run, passed=True, percentage_grade=0.7
+            )
+        CombinedFinalGrade.objects.create(user=cls.users[0], course=cls.course_with_exam, grade=0.8)
+        # data in another program must be ignored
+        FinalGradeFactory.create(user=cls.users[0], passed=True)
+
+    def assert_same_mmtrack(self, batch_mmtrack, mmtrack):
+        """Asserts that the MMTrack built by the batch behaves like the one built by get_mmtrack"""
+        assert batch_mmtrack.edx_course_keys == mmtrack.edx_course_keys
+        assert batch_mmtrack.paid_course_fa == mmtrack.paid_course_fa
+        assert batch_mmtrack.get_all_final_grades() == mmtrack.get_all_final_grades()
+        assert batch_mmtrack.calculate_final_grade_average() == mmtrack.calculate_final_grade_average()
+        assert batch_mmtrack.count_courses_passed() == mmtrack.count_courses_passed()
+        assert batch_mmtrack.has_paid_for_any_in_program() == mmtrack.has_paid_for_any_in_program()
+        for course_run in self.course_runs:
+            key = course_run.edx_course_key
+            assert batch_mmtrack.get_final_grade(key) == mmtrack.get_final_grade(key)
+            assert batch_mmtrack.has_final_grade(key) == mmtrack.has_final_grade(key)
+            assert batch_mmtrack.has_passed_course(key) == mmtrack.has_passed_course(key)
+            assert batch_mmtrack.has_paid(key) == mmtrack.has_paid(key)
+            assert batch_mmtrack.is_enrolled_mmtrack(key) == mmtrack.is_enrolled_mmtrack(key)
+        for course in (self.course_with_exam, self.course_no_exam):
+            assert batch_mmtrack.get_final_grades_for_course(course) == \
+                list(mmtrack.get_final_grades_for_course(course))
+            assert batch_mmtrack.get_best_final_grade_for_course(course) == \
+                mmtrack.get_best_final_grade_for_course(course)
+            assert batch_mmtrack.get_overall_final_grade_for_course(course) == \
+                mmtrack.get_overall_final_grade_for_course(course)
+            assert batch_mmtrack.get_payments_count_for_course(course) == mmtrack.get_payments_count_for_course(course)
+            assert batch_mmtrack.get_course_proctorate_exam_results(course) == \
+                list(mmtrack.get_course_proctorate_exam_results(course))
+            assert batch_mmtrack.get_best_proctored_exam_grade(course) == mmtrack.get_best_proctored_exam_grade(course)
+
+    def test_get_mmtrack(self):
+        """
+        The MMTrack objects built by the batch should return the same values as the ones built by get_mmtrack
+        """
+        batch = MMTrackBatch(self.program, self.users)
+        for user in self.users:
+            self.assert_same_mmtrack(batch.get_mmtrack(user), get_mmtrack(user, self.program))
+
+    def test_required_final_grade(self):
+        """
+        get_required_final_grade should raise for a missing FinalGrade on a batch MMTrack
+        """
+        batch = MMTrackBatch(self.program, self.users)
+        key = self.course_runs[0].edx_course_key
+        assert batch.get_mmtrack(self.users[0]).get_required_final_grade(key).user == self.users[0]
+        with self.assertRaises(FinalGrade.DoesNotExist):
+            batch.get_mmtrack(self.users[2]).get_required_final_grade(key)
+
+    def test_number_of_queries(self):
+        """
+        The number of queries to build a batch should not depend on the number of users
+        """
+        with CaptureQueriesContext(connection) as single_user_queries:
+            MMTrackBatch(self.program, self.users[:1])
+        with CaptureQueriesContext(connection) as all_users_queries:
+            batch = MMTrackBatch(self.program, self.users)
+        assert len(all_users_queries) == len(single_user_queries)
+        with self.assertNumQueries(0):
+            for user in self.users:
+                mmtrack = batch.get_mmtrack(user)
+                mmtrack.count_courses_passed()
+                mmtrack.calculate_final_grade_average()
+                for course_run in self.course_runs:
+                    mmtrack.has_paid(course_run.edx_course_key)
+                    mmtrack.has_passed_course(course_run.edx_course_key)
+
+
 @ddt.ddt
 class ConvertLetterGradeTests(MockedESTestCase):
     """Tests grade to letter conversion"""
@@ -23,7 +23,12 @@ from dashboard.permissions import CanReadIfStaffOrSelf
 from dashboard.serializers import UnEnrollProgramsSerializer
 from dashboard.models import ProgramEnrollment
 from dashboard.api import get_user_program_info
-from dashboard.api_edx_cache import CachedEdxDataApi
+from dashboard.api_edx_cache import CachedEdxDataApi, UserCacheFreshness
+from dashboard.tasks import (
+    is_user_data_refresh_scheduled,
+    pop_user_credential_error,
+    schedule_user_data_refresh,
+)
 from micromasters.exceptions import PossiblyImproperlyConfigured
 from profiles.api import get_social_username, get_social_auth
 
@@ -68,6 +73,23 @@ class UserDashboard(APIView):
             # create an instance of the client to query edX
             edx_client = EdxApi(user_social.extra_data, settings.EDXORG_BASE_URL)
 
+        if edx_client is not None and settings.DASHBOARD_STALE_WHILE_REVALIDATE:
+            # the background refresh found that the token is fresh but invalid
+            exc = pop_user_credential_error(user.id)
+            if exc is not None:
+                return Response(
+                    status=exc.http_status_code,
+                    data={'error': str(exc)}
+                )
+            # serve the cached data right away and refresh it in the background if needed
+            program_dashboard = get_user_program_info(user, None)
+            if not program_dashboard['is_edx_data_fresh']:
+                schedule_user_data_refresh(user.id)
+            return Response(
+                status=status.HTTP_200_OK,
+                data=program_dashboard
+            )
+
         try:
             program_dashboard = get_user_program_info(user, edx_client)
         except utils.InvalidCredentialStored as exc:
@@ -82,6 +104,43 @@ class UserDashboard(APIView):
         )
 
 
+class UserDashboardFreshness(APIView):
+    """
+    Class based view to check if the cached edX data of a user is fresh, without building the dashboard.
+    """
+    authentication_classes = (
+        authentication.SessionAuthentication,
+        authentication.TokenAuthentication,
+    )
+    permission_classes = (permissions.IsAuthenticated, CanReadIfStaffOrSelf)
+
+    def get(self, request, username, *args, **kargs):  # pylint: disable=unused-argument
+        """
+        Returns the freshness of the cached edX data and whether a refresh is in progress.
+        If the background refresh found that the edX token is fresh but invalid,
+        the error status code tells the client that the user has to log in again.
+        """
+        user = get_object_or_404(
+            User,
+            social_auth__uid=username,
+            social_auth__provider=EdxOrgOAuth2.name
+        )
+        if user == request.user:
+            exc = pop_user_credential_error(user.id)
+            if exc is not None:
+                return Response(
+                    status=exc.http_status_code,
+                    data={'error': str(exc)}
+                )
+        return Response(
+            status=status.HTTP_200_OK,
+            data={
+                'is_edx_data_fresh': UserCacheFreshness(user).are_all_fresh(),
+                'is_refreshing': is_user_data_refresh_scheduled(user.id),
+            }
+        )
+
+
 class UserCourseEnrollment(APIView):
     """
     Create an audit enrollment for the user in a given course run identified by course_id.
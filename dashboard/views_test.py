@@ -17,7 +17,7 @@ from edx_api.enrollments.models import Enrollments, Enrollment
 from backends.utils import InvalidCredentialStored
 from courses.factories import ProgramFactory, CourseRunFactory
 from dashboard.factories import UserCacheRefreshTimeFactory, ProgramEnrollmentFactory
-from dashboard.models import ProgramEnrollment, CachedEnrollment
+from dashboard.models import ProgramEnrollment, CachedEnrollment, UserCacheRefreshTime
 from micromasters.exceptions import PossiblyImproperlyConfigured
 from micromasters.factories import UserFactory, SocialUserFactory
 from micromasters.utils import now_in_utc
@@ -87,7 +87,7 @@ class DashboardTest(MockedESTestCase, APITestCase):
         }
 
     @ddt.data(Instructor, Staff)
-    @patch('dashboard.api.CachedEdxDataApi.update_cache_if_expired')
+    @patch('dashboard.api.CachedEdxDataApi.update_expired_caches')
     def test_edx_is_not_refreshed_if_not_own_dashboard(self, role, update_mock):
         """
         If the dashboard being queried is not the user's own dashboard
@@ -103,7 +103,7 @@ class DashboardTest(MockedESTestCase, APITestCase):
         self.client.get(self.url)
         assert update_mock.call_count == 0
 
-    @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_cache_if_expired', new_callable=MagicMock)
+    @patch('dashboard.api_edx_cache.CachedEdxDataApi.update_expired_caches', new_callable=MagicMock)
     @patch('backends.utils.refresh_user_token', autospec=True)
     @ddt.data(400, 401,)
     def test_http_error_propagated_from_back_functions(
@@ -115,6 +115,70 @@ class DashboardTest(MockedESTestCase, APITestCase):
         result = self.client.get(self.url)
         assert result.status_code == status_code
 
+    @ddt.data(True, False)
+    def test_stale_while_revalidate(self, is_fresh):
+        """
+        In stale-while-revalidate mode the cached data is served and a refresh is scheduled if it is not fresh
+        """
+        if not is_fresh:
+            UserCacheRefreshTime.objects.filter(user=self.user).delete()
+        with patch('backends.utils.refresh_user_token', autospec=True), patch(
+            'dashboard.api.CachedEdxDataApi.update_expired_caches'
+        ) as update_mock, patch(
+            'dashboard.views.schedule_user_data_refresh', autospec=True
+        ) as schedule_mock, self.settings(DASHBOARD_STALE_WHILE_REVALIDATE=True):
+            result = self.client.get(self.url)
+        assert result.status_code == status.HTTP_200_OK
+        assert result.data['is_edx_data_fresh'] is is_fresh
+        assert len(result.data['programs']) == 2
+        assert update_mock.called is False
+        if is_fresh:
+            assert schedule_mock.called is False
+        else:
+            schedule_mock.assert_called_once_with(self.user.id)
+
+    @ddt.data(True, False)
+    def test_freshness(self, is_refreshing):
+        """
+        The freshness endpoint should report if the edX data is fresh and if it is being refreshed
+        """
+        url = reverse('dashboard_freshness_api', args=[self.user.social_auth.first().uid])
+        with patch(
+            'dashboard.views.is_user_data_refresh_scheduled', autospec=True, return_value=is_refreshing
+        ) as is_scheduled_mock:
+            result = self.client.get(url)
+        assert result.status_code == status.HTTP_200_OK
+        assert result.data == {
+            'is_edx_data_fresh': True,
+            'is_refreshing': is_refreshing,
+        }
+        is_scheduled_mock.assert_called_once_with(self.user.id)
+
+    @ddt.data(True, False)
+    def test_invalid_credential_after_background_refresh(self, use_freshness_endpoint):
+        """
+        If the background refresh found that the token is invalid, the next request should tell the client
+        to log in again
+        """
+        url = (
+            reverse('dashboard_freshness_api', args=[self.user.social_auth.first().uid])
+            if use_freshness_endpoint else self.url
+        )
+        with patch('backends.utils.refresh_user_token', autospec=True), patch(
+            'dashboard.views.pop_user_credential_error', autospec=True,
+            return_value=InvalidCredentialStored('invalid token', status.HTTP_401_UNAUTHORIZED),
+        ) as pop_mock, self.settings(DASHBOARD_STALE_WHILE_REVALIDATE=True):
+            result = self.client.get(url)
+        assert result.status_code == status.HTTP_401_UNAUTHORIZED
+        assert result.data == {'error': 'invalid token'}
+        pop_mock.assert_called_once_with(self.user.id)
+
+    def test_freshness_anonymous(self):
+        """Anonymous users can't check the freshness of the data"""
+        self.client.logout()
+        url = reverse('dashboard_freshness_api', args=[self.user.social_auth.first().uid])
+        assert self.client.get(url).status_code == status.HTTP_403_FORBIDDEN
+
     @patch('backends.utils.refresh_user_token', autospec=True)
     def test_refresh_token_fails(self, refr_token):
         """
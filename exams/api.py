@@ -10,6 +10,7 @@ from django.db.models import Q
 
 from dashboard.utils import get_mmtrack
 from dashboard.api import has_to_pay_for_exam
+from dashboard.payload_cache import bump_program_version
 from exams.exceptions import ExamAuthorizationException
 from exams.models import (
     ExamAuthorization,
@@ -64,17 +65,18 @@ def sso_digest(client_candidate_id, timestamp, session_timeout):
     return hashlib.sha256(data).hexdigest()
 
 
-def authorize_for_exam_run(user, course_run, exam_run):
+def authorize_for_exam_run(user, course_run, exam_run, mmtrack=None):
     """
     Authorize user for exam if he has paid for course and passed course.
 
     Args:
-        mmtrack (dashboard.utils.MMTrack): a instance of all user information about a program.
+        user (django.contib.auth.models.User): the user to authorize
         course_run (courses.models.CourseRun): A CourseRun object.
         exam_run (exams.models.ExamRun): the ExamRun we're authorizing for
+        mmtrack (dashboard.utils.MMTrack): an optional instance of all user information about the program
     """
-
-    mmtrack = get_mmtrack(user, course_run.course.program)
+    if mmtrack is None:
+        mmtrack = get_mmtrack(user, course_run.course.program)
     if not mmtrack.user.is_active:
         raise ExamAuthorizationException(
             "Inactive user '{}' cannot be authorized for the exam for course id '{}'".format(
@@ -128,13 +130,14 @@ def authorize_for_exam_run(user, course_run, exam_run):
     )
 
 
-def authorize_for_latest_passed_course(user, exam_run):
+def authorize_for_latest_passed_course(user, exam_run, mmtrack=None):
     """
     This walks the FinalGrade backwards chronologically and authorizes the first eligible one.
 
     Args:
-        mmtrack (dashboard.utils.MMTrack): An instance of all user information about a program
+        user (django.contib.auth.models.User): the user to authorize
         exam_run (exams.models.ExamRun): the ExamRun to authorize the learner for
+        mmtrack (dashboard.utils.MMTrack): an optional instance of all user information about the program
     """
     final_grades = FinalGrade.objects.filter(
         user=user,
@@ -148,7 +151,7 @@ def authorize_for_latest_passed_course(user, exam_run):
 
     for final_grade in final_grades:
         try:
-            authorize_for_exam_run(user, final_grade.course_run, exam_run)
+            authorize_for_exam_run(user, final_grade.course_run, exam_run, mmtrack=mmtrack)
         except ExamAuthorizationException:
             log.debug(
                 'Unable to authorize user: %s for exam on course_id: %s',
@@ -198,3 +201,5 @@ def update_authorizations_for_exam_run(exam_run):
         operation=ExamAuthorization.OPERATION_UPDATE,
         updated_on=now_in_utc()
     )
+    # the authorizations of many users changed, invalidate the dashboards of the whole program
+    bump_program_version(exam_run.course.program_id)
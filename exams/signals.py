@@ -10,6 +10,7 @@ from django.dispatch import receiver
 
 from courses.models import CourseRun
 from dashboard.models import CachedEnrollment
+from dashboard.payload_cache import bump_user_version
 from dashboard.utils import get_mmtrack
 from ecommerce.models import Order
 from exams.api import authorize_user_for_schedulable_exam_runs
@@ -33,7 +34,8 @@ def update_exam_profile(sender, instance, **kwargs):  # pylint: disable=unused-a
     """
     Signal handler to trigger a sync of the profile if an ExamProfile record exists for it.
     """
-    ExamProfile.objects.filter(profile_id=instance.id).update(status=ExamProfile.PROFILE_PENDING)
+    if ExamProfile.objects.filter(profile_id=instance.id).update(status=ExamProfile.PROFILE_PENDING):
+        bump_user_version(instance.user_id)
 
 
 @receiver(post_save, sender=ExamRun, dispatch_uid="update_exam_run")
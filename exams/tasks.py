@@ -8,6 +8,8 @@ from django.db import transaction
 from celery import group
 
 from dashboard.models import ProgramEnrollment
+from dashboard.payload_cache import bump_user_versions
+from dashboard.utils import MMTrackBatch
 from exams import api
 from exams.api import authorize_for_latest_passed_course
 from exams.pearson.exceptions import RetryableSFTPException
@@ -115,6 +117,11 @@ def export_exam_profiles(self):
             if invalid_profile_ids:
                 ExamProfile.objects.filter(
                     id__in=invalid_profile_ids).update(status=ExamProfile.PROFILE_INVALID)
+
+            # the status of the profile is shown on the dashboard
+            bump_user_versions(
+                exam_profile.profile.user_id for exam_profile in valid_profiles + invalid_profiles
+            )
     except:  # pylint: disable=bare-except
         log.exception('Unexpected exception updating ExamProfile.status')
 
@@ -174,6 +181,7 @@ def export_exam_authorizations(self):
         try:
             ExamAuthorization.objects.filter(
                 id__in=valid_auth_ids).update(status=ExamAuthorization.STATUS_IN_PROGRESS)
+            bump_user_versions(exam_auth.user_id for exam_auth in valid_auths)
         except:  # pylint: disable=bare-except
             log.exception('Unexpected exception updating ExamProfile.status')
 
@@ -246,10 +254,14 @@ def authorize_enrollment_for_exam_run(enrollment_ids, exam_run_id):
     Returns:
         None
     """
-    exam_run = ExamRun.objects.get(id=exam_run_id)
-    for enrollment in ProgramEnrollment.objects.filter(id__in=enrollment_ids).prefetch_related('user'):
+    exam_run = ExamRun.objects.select_related('course__program').get(id=exam_run_id)
+    enrollments = list(ProgramEnrollment.objects.filter(id__in=enrollment_ids).prefetch_related('user'))
+    mmtrack_batch = MMTrackBatch(exam_run.course.program, [enrollment.user for enrollment in enrollments])
+    for enrollment in enrollments:
         try:
-            authorize_for_latest_passed_course(enrollment.user, exam_run)
+            authorize_for_latest_passed_course(
+                enrollment.user, exam_run, mmtrack=mmtrack_batch.get_mmtrack(enrollment.user)
+            )
         # pylint: disable=bare-except
         except:
             log.exception(
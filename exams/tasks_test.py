@@ -1,7 +1,7 @@
 """
 Tests for exam tasks
 """
-from unittest.mock import patch
+from unittest.mock import ANY, patch
 
 from ddt import ddt, data, unpack
 from django.core.exceptions import ImproperlyConfigured
@@ -176,11 +176,17 @@ class ExamProfileTasksTest(MockedESTestCase):
 
             return (self.expected_in_progress_profiles, self.expected_invalid_profiles)
 
-        with patch('exams.pearson.writers.CDDWriter') as cdd_writer_mock_cls:
+        with patch('exams.pearson.writers.CDDWriter') as cdd_writer_mock_cls, patch(
+            'exams.tasks.bump_user_versions', autospec=True
+        ) as bump_mock:
             cdd_writer_instance = cdd_writer_mock_cls.return_value
             cdd_writer_instance.write.side_effect = side_effect
             export_exam_profiles.delay()
 
+        # the dashboards show the new status of the profiles
+        assert sorted(bump_mock.call_args[0][0]) == sorted(
+            exam_profile.profile.user_id for exam_profile in self.all_profiles
+        )
         assert upload_tsv_mock.call_count == 1
         assert 'cdd-' in upload_tsv_mock.call_args[0][0]
         assert upload_tsv_mock.call_args[0][0].endswith('.dat')
@@ -270,12 +276,17 @@ class ExamAuthorizationTasksTest(MockedESTestCase):
 
             return (self.exam_auths, [])
 
-        with patch('exams.pearson.writers.EADWriter') as ead_writer_mock_cls:
+        with patch('exams.pearson.writers.EADWriter') as ead_writer_mock_cls, patch(
+            'exams.tasks.bump_user_versions', autospec=True
+        ) as bump_mock:
             ead_writer_instance = ead_writer_mock_cls.return_value
             ead_writer_instance.write.side_effect = side_effect
 
             export_exam_authorizations.delay()
 
+        # the dashboards show the new status of the authorizations
+        assert sorted(bump_mock.call_args[0][0]) == sorted(exam_auth.user_id for exam_auth in self.exam_auths)
+
         assert upload_tsv_mock.call_count == 1
         assert 'ead-' in upload_tsv_mock.call_args[0][0]
         assert upload_tsv_mock.call_args[0][0].endswith('.dat')
@@ -377,5 +388,5 @@ class ExamRunTasksTest(MockedESTestCase):
         authorize_enrollment_for_exam_run([enrollment_1.id, enrollment_2.id], exam_run.id)
 
         assert authorize_for_latest_passed_course_mock.call_count == 2
-        authorize_for_latest_passed_course_mock.assert_any_call(enrollment_1.user, exam_run)
-        authorize_for_latest_passed_course_mock.assert_any_call(enrollment_2.user, exam_run)
+        authorize_for_latest_passed_course_mock.assert_any_call(enrollment_1.user, exam_run, mmtrack=ANY)
+        authorize_for_latest_passed_course_mock.assert_any_call(enrollment_2.user, exam_run, mmtrack=ANY)
@@ -260,7 +260,7 @@ def generate_program_certificate(user, program):
     )
 
 
-def generate_program_letter(user, program):
+def generate_program_letter(user, program, mmtrack=None):
     """
     Create a program letter if the user has a MM course certificate
     for each course in the program and program is non-fa.
@@ -268,6 +268,7 @@ def generate_program_letter(user, program):
     Args:
         user (User): a Django user.
         program (programs.models.Program): program where the user is enrolled.
+        mmtrack (dashboard.utils.MMTrack): an optional instance of all user information about the program
     """
     if MicromastersProgramCommendation.objects.filter(user=user, program=program).exists():
         log.info('User [%s] already has a letter for program [%s]', user, program)
@@ -278,7 +279,8 @@ def generate_program_letter(user, program):
         MicromastersProgramCommendation.objects.create(user=user, program=program)
         return
 
-    mmtrack = get_mmtrack(user, program)
+    if mmtrack is None:
+        mmtrack = get_mmtrack(user, program)
     courses_passed = mmtrack.count_courses_passed()
     program_course_count = (program.num_required_courses
                             if program.electives_set.exists()
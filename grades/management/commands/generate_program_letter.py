@@ -5,7 +5,11 @@ from django.core.management import BaseCommand
 
 from courses.models import Program
 from dashboard.models import ProgramEnrollment
+from dashboard.utils import MMTrackBatch
 from grades.api import generate_program_letter
+from micromasters.utils import chunks
+
+MMTRACK_BATCH_SIZE = 200
 
 
 class Command(BaseCommand):
@@ -24,5 +28,8 @@ class Command(BaseCommand):
                 )
                 continue
             enrollments = ProgramEnrollment.objects.filter(program=program).select_related('user')
-            for enrollment in enrollments:
-                generate_program_letter(enrollment.user, program)
+            for enrollments_chunk in chunks(enrollments.iterator(), chunk_size=MMTRACK_BATCH_SIZE):
+                users = [enrollment.user for enrollment in enrollments_chunk]
+                mmtrack_batch = MMTrackBatch(program, users)
+                for user in users:
+                    generate_program_letter(user, program, mmtrack=mmtrack_batch.get_mmtrack(user))
@@ -1,37 +1,90 @@
 """
 Provides functions for sending and retrieving data about in-app email
 """
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 import logging
 import json
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ImproperlyConfigured
 from django.db import transaction
+from django.db.models import Max
 from rest_framework import status
 
-from bs4 import BeautifulSoup
-
 from mail.exceptions import SendBatchException
 from mail.models import (
     AutomaticEmail,
     FinancialAidEmailAudit,
+    SearchResultMailChunk,
+    SearchResultMailJob,
     SentAutomaticEmail,
 )
-from mail.utils import filter_recipient_variables
-from micromasters.utils import chunks
+from mail.utils import render_email
+from micromasters.utils import chunks, now_in_utc
 from profiles.models import Profile
 from search.api import (
     adjust_search_for_percolator,
-    search_percolate_queries,
+    create_search_obj,
+    percolate_program_enrollments,
+    scan_search,
 )
 from search.models import PercolateQuery
 
 
 log = logging.getLogger(__name__)
 
+# how many times a request is sent again when Mailgun answers 429 Too Many Requests
+RATE_LIMIT_MAX_RETRIES = 5
+# the delay before the first retry, doubled at each retry unless Mailgun sends a Retry-After header
+RATE_LIMIT_BACKOFF_SECONDS = 1
+# the longest delay before a retry, so that a large Retry-After header does not block a worker indefinitely
+RATE_LIMIT_MAX_DELAY_SECONDS = RATE_LIMIT_BACKOFF_SECONDS * 2 ** RATE_LIMIT_MAX_RETRIES
+# number of SentAutomaticEmails created, locked or updated in a single query
+SENT_AUTOMATIC_EMAIL_CHUNK_SIZE = 1000
+
+
+def _make_session():
+    """
+    Creates the session used to send requests to Mailgun, which keeps the connections alive
+    so that they are reused by the following requests
+
+    Returns:
+        requests.Session: A session with a connection pool for each of the concurrent requests
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=settings.MAILGUN_SEND_CONCURRENCY)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_session = _make_session()
+
+
+def _get_retry_delay(response, attempt):
+    """
+    Returns how long to wait before sending again a request which has been rate limited
+
+    Args:
+        response (requests.Response): The 429 response
+        attempt (int): The number of retries so far
+
+    Returns:
+        float: The number of seconds to wait, at most RATE_LIMIT_MAX_DELAY_SECONDS
+    """
+    try:
+        delay = float(response.headers['Retry-After'])
+    except (KeyError, TypeError, ValueError):
+        delay = RATE_LIMIT_BACKOFF_SECONDS * 2 ** attempt
+    return min(max(delay, 0), RATE_LIMIT_MAX_DELAY_SECONDS)
+
 
 class MailgunClient:
     """
@@ -74,11 +127,18 @@ class MailgunClient:
                 sender_name=sender_name,
                 email=email_params['from']
             )
-        response = request_func(
-            mailgun_url,
-            auth=cls._basic_auth_credentials,
-            data=email_params
-        )
+        for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+            response = request_func(
+                mailgun_url,
+                auth=cls._basic_auth_credentials,
+                data=email_params
+            )
+            if response.status_code != status.HTTP_429_TOO_MANY_REQUESTS or attempt == RATE_LIMIT_MAX_RETRIES:
+                break
+            delay = _get_retry_delay(response, attempt)
+            log.warning("Mailgun rate limit reached, sending the request again in %s seconds", delay)
+            time.sleep(delay)
+
         if response.status_code == status.HTTP_401_UNAUTHORIZED:
             message = "Mailgun API keys not properly configured."
             log.error(message)
@@ -93,6 +153,7 @@ class MailgunClient:
                    raise_for_status=True, log_error_on_bounce=True):
         """
         Sends a text email to a list of recipients (one email per recipient) via batch.
+        The chunks are sent concurrently, MAILGUN_SEND_CONCURRENCY at a time.
 
         Args:
             subject (str): Email subject
@@ -131,50 +192,51 @@ class MailgunClient:
             )
             recipients = [(settings.MAILGUN_RECIPIENT_OVERRIDE, {})]
 
-        # parse our HTML body in order to generate a plain-text fallback
-        # the only thing we need to do manually is ensure that we keep the
-        # href for any URLs in the text
-        soup = BeautifulSoup(body, 'html5lib')
-        for link in soup.find_all('a'):
-            link.replace_with(link.attrs['href'])
-        fallback_text = soup.get_text().strip()
+        rendered_subject, rendered_body, fallback_text = render_email(subject, body)
 
         responses = []
         exception_pairs = []
-
-        for chunk in chunks(recipients, chunk_size=chunk_size):
-            chunk_dict = {email: context for email, context in chunk}
-            emails = list(chunk_dict.keys())
-
-            params = {
-                'to': emails,
-                'subject': filter_recipient_variables(subject),
-                'html': filter_recipient_variables(body),
-                'text': filter_recipient_variables(fallback_text),
-                'recipient-variables': json.dumps(chunk_dict),
-                'v:my-custom-data': json.dumps({
-                    "log_error_on_bounce": log_error_on_bounce
-                })
-            }
-            if sender_address:
-                params['from'] = sender_address
-
-            try:
-                response = cls._mailgun_request(
-                    requests.post,
+        futures = []
+
+        with ThreadPoolExecutor(max_workers=settings.MAILGUN_SEND_CONCURRENCY) as executor:
+            # the recipients are read in this thread, the workers only send the requests
+            for chunk in chunks(recipients, chunk_size=chunk_size):
+                chunk_dict = {email: context for email, context in chunk}
+                emails = list(chunk_dict.keys())
+
+                params = {
+                    'to': emails,
+                    'subject': rendered_subject,
+                    'html': rendered_body,
+                    'text': fallback_text,
+                    'recipient-variables': json.dumps(chunk_dict),
+                    'v:my-custom-data': json.dumps({
+                        "log_error_on_bounce": log_error_on_bounce
+                    })
+                }
+                if sender_address:
+                    params['from'] = sender_address
+
+                futures.append((emails, executor.submit(
+                    cls._mailgun_request,
+                    _session.post,
                     'messages',
                     params,
                     sender_name=sender_name,
                     raise_for_status=raise_for_status,
-                )
-
-                responses.append(response)
-            except ImproperlyConfigured:
-                raise
-            except Exception as exception:  # pylint: disable=broad-except
-                exception_pairs.append(
-                    (emails, exception)
-                )
+                )))
+
+            for emails, future in futures:
+                try:
+                    responses.append(future.result())
+                except ImproperlyConfigured:
+                    for _, other_future in futures:
+                        other_future.cancel()
+                    raise
+                except Exception as exception:  # pylint: disable=broad-except
+                    exception_pairs.append(
+                        (emails, exception)
+                    )
 
         if len(exception_pairs) > 0:
             raise SendBatchException(exception_pairs)
@@ -286,35 +348,85 @@ class MailgunClient:
         return response
 
 
-def send_automatic_emails(program_enrollment):
+def send_automatic_emails(program_enrollments, percolate_matches=None):
     """
-    Send all automatic emails which match the search criteria for a program enrollment
+    Send all automatic emails which match the search criteria for many program enrollments.
+    The matches are collected first, so that each AutomaticEmail is sent as a single batch
+    to all of the users who newly match it.
 
     Args:
-        program_enrollment (ProgramEnrollment): A ProgramEnrollment
+        program_enrollments (iterable of ProgramEnrollment): Program enrollments
+        percolate_matches (dict): optional results of search.api.percolate_program_enrollments
+            to use instead of percolating the ProgramEnrollments again
     """
-    percolate_queries = search_percolate_queries(program_enrollment.id, PercolateQuery.AUTOMATIC_EMAIL_TYPE)
-    automatic_emails = AutomaticEmail.objects.filter(
-        query__in=percolate_queries,
+    program_enrollments = list(program_enrollments)
+    missing_enrollments = [
+        program_enrollment for program_enrollment in program_enrollments
+        if percolate_matches is None or program_enrollment.id not in percolate_matches
+    ]
+    if missing_enrollments:
+        percolate_matches = {**(percolate_matches or {}), **percolate_program_enrollments(missing_enrollments)}
+
+    # the ids of the users matching each percolate query
+    query_user_ids = defaultdict(set)
+    for program_enrollment in program_enrollments:
+        for query_id in percolate_matches.get(program_enrollment.id, []):
+            query_user_ids[query_id].add(program_enrollment.user_id)
+    if not query_user_ids:
+        return
+
+    automatic_emails = list(AutomaticEmail.objects.filter(
+        query__in=list(query_user_ids),
+        query__source_type=PercolateQuery.AUTOMATIC_EMAIL_TYPE,
         enabled=True,
-    ).exclude(sentautomaticemail__user__programenrollment=program_enrollment)
-    user = program_enrollment.user
+    ).exclude(query__is_deleted=True))
+    user_ids = set.union(*query_user_ids.values())
+    already_sent = set(SentAutomaticEmail.objects.filter(
+        automatic_email__in=automatic_emails,
+        user_id__in=user_ids,
+    ).values_list('automatic_email_id', 'user_id'))
+    user_emails = dict(User.objects.filter(id__in=user_ids).values_list('id', 'email'))
+
     for automatic_email in automatic_emails:
+        emails = [
+            user_emails[user_id] for user_id in query_user_ids[automatic_email.query_id]
+            if (automatic_email.id, user_id) not in already_sent
+        ]
+        if not emails:
+            continue
         try:
-            with mark_emails_as_sent(automatic_email, [user.email]) as user_ids:
-                # user_ids should just contain user.id except when we already sent the user the email
-                # in a separate process
-                recipient_emails = User.objects.filter(id__in=user_ids).values_list('email', flat=True)
-                MailgunClient.send_batch(
-                    automatic_email.email_subject,
-                    automatic_email.email_body,
-                    [(context['email'], context) for context in get_mail_vars(list(recipient_emails))],
-                    sender_name=automatic_email.sender_name,
-                )
+            _send_automatic_email(automatic_email, emails)
         except:  # pylint: disable=bare-except
             log.exception("Error sending mailgun mail for automatic email %s", automatic_email)
 
 
+def _send_automatic_email(automatic_email, emails):
+    """
+    Sends an automatic email to the users who weren't sent it yet, and marks them as sent.
+    If only some of the chunks are delivered their recipients are still marked as sent.
+
+    Args:
+        automatic_email (AutomaticEmail): An instance of AutomaticEmail
+        emails (list of str): The emails of the recipients
+    """
+    try:
+        with mark_emails_as_sent(automatic_email, emails) as user_ids:
+            # user_ids should contain the users of the emails except the ones which were already
+            # sent the email in a separate process
+            recipient_emails = User.objects.filter(id__in=user_ids).values_list('email', flat=True)
+            MailgunClient.send_batch(
+                automatic_email.email_subject,
+                automatic_email.email_body,
+                [(context['email'], context) for context in get_mail_vars(list(recipient_emails))],
+                sender_name=automatic_email.sender_name,
+            )
+    except SendBatchException as send_batch_exception:
+        success_emails = set(emails).difference(send_batch_exception.failed_recipient_emails)
+        with mark_emails_as_sent(automatic_email, success_emails):
+            pass
+        raise
+
+
 def add_automatic_email(original_search, email_subject, email_body, sender_name, staff_user):
     """
     Add an automatic email entry
@@ -348,40 +460,161 @@ def add_automatic_email(original_search, email_subject, email_body, sender_name,
 @contextmanager
 def mark_emails_as_sent(automatic_email, emails):
     """
-    Context manager to mark users who have the given emails as sent after successful sending of email
+    Context manager to mark users who have the given emails as sent after successful sending of email.
+    The SentAutomaticEmails are created, locked and updated SENT_AUTOMATIC_EMAIL_CHUNK_SIZE at a time.
 
     Args:
         automatic_email (AutomaticEmail): An instance of AutomaticEmail
         emails (iterable): An iterable of emails
 
     Yields:
-        queryset of user id: A queryset of user ids which represent users who haven't been sent emails yet
+        list of int: A list of user ids which represent users who haven't been sent emails yet
     """
     user_ids = list(User.objects.filter(email__in=emails).values_list('id', flat=True))
 
     # At any point the SentAutomaticEmail will be in three possible states:
     # it doesn't exist, status=PENDING, and status=SENT. They should only change state in that direction, ie
     # we don't delete SentAutomaticEmail anywhere or change status from SENT to pending.
-    for user_id in user_ids:
-        # If a SentAutomaticEmail doesn't exist, create it with status=PENDING.
-        # No defaults because the default status is PENDING which is what we want
-        SentAutomaticEmail.objects.get_or_create(
-            user_id=user_id,
-            automatic_email=automatic_email,
-        )
+    # Create the missing SentAutomaticEmails with status=PENDING, the existing ones are left untouched.
+    SentAutomaticEmail.objects.bulk_create(
+        [SentAutomaticEmail(user_id=user_id, automatic_email=automatic_email) for user_id in user_ids],
+        batch_size=SENT_AUTOMATIC_EMAIL_CHUNK_SIZE,
+        ignore_conflicts=True,
+    )
 
     with transaction.atomic():
         # Now all SentAutomaticEmails are either PENDING or SENT.
         # If SENT it was already handled by a different thread, so filter on PENDING.
-        sent_queryset = SentAutomaticEmail.objects.filter(
+        pending_queryset = SentAutomaticEmail.objects.filter(
             user_id__in=user_ids,
             automatic_email=automatic_email,
             status=SentAutomaticEmail.PENDING,
-        )
-        user_ids_left = list(sent_queryset.select_for_update().values_list('user_id', flat=True))
+        ).order_by('id')
+        # Lock the rows one page at a time, the locks are held until the end of the transaction
+        sent_ids = []
+        user_ids_left = []
+        last_id = 0
+        while True:
+            page = list(
+                pending_queryset.filter(id__gt=last_id).select_for_update().values_list(
+                    'id', 'user_id'
+                )[:SENT_AUTOMATIC_EMAIL_CHUNK_SIZE]
+            )
+            if not page:
+                break
+            for sent_id, user_id in page:
+                sent_ids.append(sent_id)
+                user_ids_left.append(user_id)
+            last_id = page[-1][0]
+
         # We yield the list of user ids here to let the block know which emails have not yet been sent
         yield user_ids_left
-        sent_queryset.update(status=SentAutomaticEmail.SENT)
+        for sent_ids_chunk in chunks(sent_ids, chunk_size=SENT_AUTOMATIC_EMAIL_CHUNK_SIZE):
+            SentAutomaticEmail.objects.filter(id__in=sent_ids_chunk).update(status=SentAutomaticEmail.SENT)
+
+
+def _iter_search_result_emails(search_obj):
+    """
+    Iterates over the unique emails of the documents matching a search, scanning one page at a time
+
+    Args:
+        search_obj (Search): Search object
+
+    Yields:
+        str: An email address
+    """
+    seen = set()
+    # a learner has a document for each program enrollment, but should get the email once
+    for hit in scan_search(search_obj.sort('_doc').source(include=['email'])):
+        if hit.email not in seen:
+            seen.add(hit.email)
+            yield hit.email
+
+
+def create_search_result_mail_chunks(job):
+    """
+    Splits the recipients of a SearchResultMailJob in chunks of MAILGUN_BATCH_CHUNK_SIZE emails,
+    which can be sent independently
+
+    Args:
+        job (SearchResultMailJob): A job which hasn't been split yet
+    """
+    search_obj = create_search_obj(
+        job.staff_user,
+        search_param_dict=job.search_request,
+        filter_on_email_optin=True,
+    )
+    recipient_count = 0
+    with transaction.atomic():
+        for emails in chunks(_iter_search_result_emails(search_obj), chunk_size=settings.MAILGUN_BATCH_CHUNK_SIZE):
+            SearchResultMailChunk.objects.create(job=job, recipients=emails)
+            recipient_count += len(emails)
+        job.recipient_count = recipient_count
+        job.status = SearchResultMailJob.SENDING
+        job.save()
+
+
+def can_retry_search_result_mail_job(job):
+    """
+    Checks if a SearchResultMailJob is not sending emails anymore, so that it can be sent again.
+    A pending or sending job whose tasks were lost, i.e. because a worker died, is considered stalled
+    after SEARCH_RESULT_MAIL_STALLED_SECONDS without any progress.
+
+    Args:
+        job (SearchResultMailJob): A job
+
+    Returns:
+        bool: True if the job is finished, failed or stalled
+    """
+    if job.status in (SearchResultMailJob.FINISHED, SearchResultMailJob.FAILED):
+        return True
+    last_chunk_update = job.chunks.aggregate(last_update=Max('updated_on'))['last_update']
+    last_update = max(job.updated_on, last_chunk_update) if last_chunk_update else job.updated_on
+    return (now_in_utc() - last_update).total_seconds() > settings.SEARCH_RESULT_MAIL_STALLED_SECONDS
+
+
+def send_search_result_mail_chunk(chunk):
+    """
+    Sends the email of a SearchResultMailJob to the recipients of a chunk. The outcome is stored in the chunk
+    instead of raising, so that the failed chunks can be retried later.
+
+    Args:
+        chunk (SearchResultMailChunk): A chunk of recipients
+    """
+    job = chunk.job
+    try:
+        if job.automatic_email is not None:
+            with mark_emails_as_sent(job.automatic_email, chunk.recipients) as user_ids:
+                # user_ids should be all users with the matching email in the chunk
+                # except some who were already sent email in the meantime
+                recipient_emails = list(User.objects.filter(id__in=user_ids).values_list('email', flat=True))
+                _send_search_result_mail(job, recipient_emails)
+        else:
+            _send_search_result_mail(job, chunk.recipients)
+    except Exception as exception:  # pylint: disable=broad-except
+        log.exception("Error sending chunk %d of search result mail job %d", chunk.id, job.id)
+        chunk.status = SearchResultMailChunk.FAILED
+        chunk.error = str(exception)
+    else:
+        chunk.status = SearchResultMailChunk.SENT
+        chunk.error = ''
+    chunk.save()
+
+
+def _send_search_result_mail(job, emails):
+    """
+    Sends the email of a SearchResultMailJob with a single Mailgun batch request
+
+    Args:
+        job (SearchResultMailJob): A job
+        emails (list of str): The recipients, at most MAILGUN_BATCH_CHUNK_SIZE of them
+    """
+    MailgunClient.send_batch(
+        subject=job.email_subject,
+        body=job.email_body,
+        recipients=((context['email'], context) for context in get_mail_vars(emails)),
+        sender_name=job.sender_name,
+    )
 
 
 def get_mail_vars(emails):
@@ -5,7 +5,7 @@ import json
 import string
 from unittest.mock import Mock, patch
 
-from ddt import ddt, data
+from ddt import ddt, data, unpack
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.db.models.signals import post_save
@@ -18,6 +18,7 @@ from rest_framework.status import (
     HTTP_200_OK,
     HTTP_400_BAD_REQUEST,
     HTTP_401_UNAUTHORIZED,
+    HTTP_429_TOO_MANY_REQUESTS,
 )
 
 from dashboard.models import ProgramEnrollment
@@ -30,17 +31,27 @@ from financialaid.factories import FinancialAidFactory
 from mail.exceptions import SendBatchException
 from mail.api import (
     MailgunClient,
+    RATE_LIMIT_MAX_DELAY_SECONDS,
+    RATE_LIMIT_MAX_RETRIES,
     add_automatic_email,
+    create_search_result_mail_chunks,
     get_mail_vars,
     mark_emails_as_sent,
     send_automatic_emails,
+    send_search_result_mail_chunk,
 )
 from mail.models import (
     AutomaticEmail,
     FinancialAidEmailAudit,
+    SearchResultMailChunk,
+    SearchResultMailJob,
     SentAutomaticEmail,
 )
-from mail.factories import AutomaticEmailFactory
+from mail.factories import (
+    AutomaticEmailFactory,
+    SearchResultMailChunkFactory,
+    SearchResultMailJobFactory,
+)
 from mail.views_test import mocked_json
 from profiles.factories import ProfileFactory
 from micromasters.factories import UserFactory
@@ -51,11 +62,13 @@ from search.models import PercolateQuery
 
 
 @ddt
-@patch('requests.post', autospec=True, return_value=Mock(
+@patch('mail.api._session.post', autospec=True, return_value=Mock(
     spec=Response,
     status_code=HTTP_200_OK,
     json=mocked_json()
 ))
+# the requests are sent one at a time so that their order is predictable
+@override_settings(MAILGUN_SEND_CONCURRENCY=1)
 class MailAPITests(MockedESTestCase):
     """
     Tests for the Mailgun client class
@@ -244,6 +257,79 @@ b@example.com: {"name": "B"}"""
             assert sorted(recipients) == sorted([email for email, _ in chunked_emails_to[call_num]])
             assert isinstance(exception, KeyError)
 
+    @override_settings(MAILGUN_RECIPIENT_OVERRIDE=None, MAILGUN_SEND_CONCURRENCY=4)
+    def test_send_batch_concurrent(self, mock_post):
+        """
+        Test that MailgunClient.send_batch sends the chunks concurrently and keeps the failures of each chunk
+        """
+        failing_email = 'c@example.com'
+
+        def _post(url, auth, data):  # pylint: disable=unused-argument
+            """Fail the chunk with the failing email"""
+            if failing_email in data['to']:
+                raise KeyError
+            return Mock(spec=Response, status_code=HTTP_200_OK)
+        mock_post.side_effect = _post
+
+        chunk_size = 10
+        recipient_tuples = [("{0}@example.com".format(letter), None) for letter in string.ascii_letters]
+        chunked_emails_to = [
+            [email for email, _ in recipient_tuples[i:i + chunk_size]]
+            for i in range(0, len(recipient_tuples), chunk_size)
+        ]
+        with self.assertRaises(SendBatchException) as send_batch_exception:
+            MailgunClient.send_batch('email subject', 'email body', recipient_tuples, chunk_size=chunk_size)
+
+        assert mock_post.call_count == 6
+        assert sorted(
+            sorted(called_kwargs['data']['to']) for _, called_kwargs in mock_post.call_args_list
+        ) == sorted(sorted(emails) for emails in chunked_emails_to)
+        exception_pairs = send_batch_exception.exception.exception_pairs
+        assert len(exception_pairs) == 1
+        assert exception_pairs[0][0] == chunked_emails_to[0]
+        assert isinstance(exception_pairs[0][1], KeyError)
+
+    @override_settings(MAILGUN_RECIPIENT_OVERRIDE=None)
+    @data(
+        [None, [1, 2]],
+        ['3', [3, 3]],
+        ['86400', [RATE_LIMIT_MAX_DELAY_SECONDS, RATE_LIMIT_MAX_DELAY_SECONDS]],
+        ['-5', [0, 0]],
+    )
+    @unpack
+    def test_send_batch_rate_limited(self, retry_after, expected_delays, mock_post):
+        """
+        Test that a request is sent again after a delay when Mailgun answers 429
+        """
+        rate_limited = Mock(
+            spec=Response,
+            status_code=HTTP_429_TOO_MANY_REQUESTS,
+            headers={} if retry_after is None else {'Retry-After': retry_after},
+        )
+        mock_post.side_effect = [rate_limited, rate_limited, mock_post.return_value]
+        with patch('mail.api.time.sleep', autospec=True) as mock_sleep:
+            responses = MailgunClient.send_batch('email subject', 'email body', self.batch_recipient_arg)
+
+        assert responses == [mock_post.return_value]
+        assert mock_post.call_count == 3
+        assert [call[0][0] for call in mock_sleep.call_args_list] == expected_delays
+
+    @override_settings(MAILGUN_RECIPIENT_OVERRIDE=None)
+    def test_send_batch_rate_limited_give_up(self, mock_post):
+        """
+        Test that the 429 is handled as an error once the retries are exhausted
+        """
+        mock_post.return_value = Response()
+        mock_post.return_value.status_code = HTTP_429_TOO_MANY_REQUESTS
+        with patch('mail.api.time.sleep', autospec=True) as mock_sleep, self.assertRaises(
+            SendBatchException
+        ) as send_batch_exception:
+            MailgunClient.send_batch('email subject', 'email body', self.batch_recipient_arg)
+
+        assert mock_post.call_count == RATE_LIMIT_MAX_RETRIES + 1
+        assert mock_sleep.call_count == RATE_LIMIT_MAX_RETRIES
+        assert isinstance(send_batch_exception.exception.exception_pairs[0][1], HTTPError)
+
     @override_settings(MAILGUN_RECIPIENT_OVERRIDE=None)
     def test_send_batch_improperly_configured(self, mock_post):
         """
@@ -338,7 +424,7 @@ b@example.com: {"name": "B"}"""
 
 
 @ddt
-@patch('requests.post', autospec=True, return_value=Mock(
+@patch('mail.api._session.post', autospec=True, return_value=Mock(
     spec=Response,
     status_code=HTTP_200_OK,
     json=mocked_json()
@@ -463,7 +549,7 @@ class FinancialAidMailAPITests(MockedESTestCase):
 
 
 @ddt
-@patch('requests.post', autospec=True, return_value=Mock(
+@patch('mail.api._session.post', autospec=True, return_value=Mock(
     spec=Response,
     status_code=HTTP_200_OK,
     json=mocked_json()
@@ -572,68 +658,150 @@ class AutomaticEmailTests(MockedESTestCase):
         with mute_signals(post_save):
             cls.staff_user = UserFactory.create()
 
+    def percolate_matches(self, *queries, program_enrollment=None):
+        """Percolate results where the enrollment matches the queries"""
+        program_enrollment = program_enrollment or self.program_enrollment_unsent
+        return {program_enrollment.id: {query.id for query in queries}}
+
     def test_send_automatic_emails(self):
         """send_automatic_emails should send emails to users which fit criteria and mark them so we don't send twice"""
         with patch(
-            'mail.api.search_percolate_queries', autospec=True, return_value=self.percolate_queries,
-        ) as mock_search_queries, patch('mail.api.MailgunClient') as mock_mailgun:
-            send_automatic_emails(self.program_enrollment_unsent)
+            'mail.api.percolate_program_enrollments', autospec=True,
+            return_value=self.percolate_matches(*self.percolate_queries),
+        ) as mock_percolate, patch('mail.api.MailgunClient') as mock_mailgun:
+            send_automatic_emails([self.program_enrollment_unsent])
 
         recipient_tuples = [
             (context['email'], context) for context in get_mail_vars([self.program_enrollment_unsent.user.email])
         ]
-        mock_search_queries.assert_called_with(self.program_enrollment_unsent.id, PercolateQuery.AUTOMATIC_EMAIL_TYPE)
-        mock_mailgun.send_batch.assert_called_with(
+        mock_percolate.assert_called_once_with([self.program_enrollment_unsent])
+        mock_mailgun.send_batch.assert_called_once_with(
             self.automatic_email.email_subject,
             self.automatic_email.email_body,
             recipient_tuples,
             sender_name=self.automatic_email.sender_name,
         )
+        assert SentAutomaticEmail.objects.get(
+            automatic_email=self.automatic_email,
+            user=self.program_enrollment_unsent.user,
+        ).status == SentAutomaticEmail.SENT
+
+    def test_send_automatic_emails_batch(self):
+        """Each automatic email should be sent in a single batch to all the matching users"""
+        program_enrollments = ProgramEnrollmentFactory.create_batch(3)
+        percolate_matches = {
+            program_enrollment.id: {self.percolate_query.id} for program_enrollment in program_enrollments
+        }
+        with patch(
+            'mail.api.percolate_program_enrollments', autospec=True,
+        ) as mock_percolate, patch('mail.api.MailgunClient') as mock_mailgun:
+            send_automatic_emails(program_enrollments, percolate_matches=percolate_matches)
+
+        assert mock_percolate.called is False
+        assert mock_mailgun.send_batch.call_count == 1
+        recipients = mock_mailgun.send_batch.call_args[0][2]
+        assert sorted(email for email, _ in recipients) == sorted(
+            program_enrollment.user.email for program_enrollment in program_enrollments
+        )
+        assert SentAutomaticEmail.objects.filter(
+            automatic_email=self.automatic_email,
+            user__in=[program_enrollment.user for program_enrollment in program_enrollments],
+            status=SentAutomaticEmail.SENT,
+        ).count() == len(program_enrollments)
+
+    def test_send_automatic_emails_partial_failure(self):
+        """If some of the chunks fail, the recipients of the other chunks should be marked as sent"""
+        program_enrollments = ProgramEnrollmentFactory.create_batch(3)
+        failed_email = program_enrollments[0].user.email
+        percolate_matches = {
+            program_enrollment.id: {self.percolate_query.id} for program_enrollment in program_enrollments
+        }
+        with patch('mail.api.MailgunClient') as mock_mailgun:
+            mock_mailgun.send_batch.side_effect = SendBatchException([([failed_email], HTTPError())])
+            send_automatic_emails(program_enrollments, percolate_matches=percolate_matches)
+
+        assert mock_mailgun.send_batch.call_count == 1
+        sent_emails = SentAutomaticEmail.objects.filter(
+            automatic_email=self.automatic_email,
+            user__in=[program_enrollment.user for program_enrollment in program_enrollments],
+        ).values_list('user__email', 'status')
+        expected_status = {
+            program_enrollment.user.email: SentAutomaticEmail.SENT for program_enrollment in program_enrollments
+        }
+        expected_status[failed_email] = SentAutomaticEmail.PENDING
+        assert dict(sent_emails) == expected_status
+
+    def test_send_automatic_emails_missing_matches(self):
+        """Only the enrollments missing from the percolate results should be percolated"""
+        percolate_matches = self.percolate_matches(
+            self.percolate_query, program_enrollment=self.program_enrollment_sent
+        )
+        with patch(
+            'mail.api.percolate_program_enrollments', autospec=True,
+            return_value=self.percolate_matches(self.percolate_query),
+        ) as mock_percolate, patch('mail.api.MailgunClient') as mock_mailgun:
+            send_automatic_emails(
+                [self.program_enrollment_sent, self.program_enrollment_unsent],
+                percolate_matches=percolate_matches,
+            )
+
+        mock_percolate.assert_called_once_with([self.program_enrollment_unsent])
+        assert mock_mailgun.send_batch.call_count == 1
+        assert [email for email, _ in mock_mailgun.send_batch.call_args[0][2]] == [
+            self.program_enrollment_unsent.user.email
+        ]
 
     def test_no_matching_query(self):
         """If there are no queries matching percolate we should do nothing"""
         with patch(
-            'mail.api.search_percolate_queries', autospec=True, return_value=[],
-        ) as mock_search_queries, patch('mail.api.MailgunClient') as mock_mailgun:
-            send_automatic_emails(self.program_enrollment_unsent)
+            'mail.api.percolate_program_enrollments', autospec=True, return_value=self.percolate_matches(),
+        ), patch('mail.api.MailgunClient') as mock_mailgun:
+            send_automatic_emails([self.program_enrollment_unsent])
 
-        mock_search_queries.assert_called_with(self.program_enrollment_unsent.id, PercolateQuery.AUTOMATIC_EMAIL_TYPE)
-        assert mock_mailgun.send_individual_email.called is False
+        assert mock_mailgun.send_batch.called is False
 
     def test_not_enabled(self):
         """If the automatic email is not enabled we should do nothing"""
         with patch(
-            'mail.api.search_percolate_queries', autospec=True, return_value=[self.percolate_query_disabled],
-        ) as mock_search_queries, patch('mail.api.MailgunClient') as mock_mailgun:
-            send_automatic_emails(self.program_enrollment_unsent)
+            'mail.api.percolate_program_enrollments', autospec=True,
+            return_value=self.percolate_matches(self.percolate_query_disabled),
+        ), patch('mail.api.MailgunClient') as mock_mailgun:
+            send_automatic_emails([self.program_enrollment_unsent])
 
-        mock_search_queries.assert_called_with(self.program_enrollment_unsent.id, PercolateQuery.AUTOMATIC_EMAIL_TYPE)
-        assert mock_mailgun.send_individual_email.called is False
+        assert mock_mailgun.send_batch.called is False
 
     def test_already_sent(self):
         """If a user was already sent email we should not send it again"""
         with patch(
-            'mail.api.search_percolate_queries', autospec=True, return_value=self.percolate_queries,
-        ) as mock_search_queries, patch('mail.api.MailgunClient') as mock_mailgun:
-            send_automatic_emails(self.program_enrollment_sent)
+            'mail.api.percolate_program_enrollments', autospec=True,
+            return_value=self.percolate_matches(
+                *self.percolate_queries, program_enrollment=self.program_enrollment_sent
+            ),
+        ), patch('mail.api.MailgunClient') as mock_mailgun:
+            send_automatic_emails([self.program_enrollment_sent])
 
-        mock_search_queries.assert_called_with(self.program_enrollment_sent.id, PercolateQuery.AUTOMATIC_EMAIL_TYPE)
-        assert mock_mailgun.send_individual_email.called is False
+        assert mock_mailgun.send_batch.called is False
 
     def test_failed_send(self):
-        """If we fail to send email to the first user we should still send it to the second"""
+        """If we fail to send the first automatic email we should still send the second"""
 
         new_automatic = AutomaticEmailFactory.create(enabled=True)
 
-        with patch('mail.api.search_percolate_queries', autospec=True, return_value=[
-            self.percolate_query, new_automatic.query
-        ]) as mock_search_queries, patch(
-            'mail.api.MailgunClient', send_individual_email=Mock(side_effect=[KeyError(), None])
+        with patch(
+            'mail.api.percolate_program_enrollments', autospec=True,
+            return_value=self.percolate_matches(self.percolate_query, new_automatic.query),
+        ), patch(
+            'mail.api.MailgunClient', send_batch=Mock(side_effect=[KeyError(), None])
         ) as mock_mailgun:
-            send_automatic_emails(self.program_enrollment_unsent)
+            send_automatic_emails([self.program_enrollment_unsent])
 
-        mock_search_queries.assert_called_with(self.program_enrollment_unsent.id, PercolateQuery.AUTOMATIC_EMAIL_TYPE)
         assert mock_mailgun.send_batch.call_count == 2
+        # the email which failed is not marked as sent
+        assert SentAutomaticEmail.objects.filter(
+            user=self.program_enrollment_unsent.user,
+            automatic_email__in=[self.automatic_email, new_automatic],
+            status=SentAutomaticEmail.SENT,
+        ).count() == 1
 
     def test_add_automatic_email(self):
         """Add an AutomaticEmail entry with associated PercolateQuery"""
@@ -669,6 +837,107 @@ class AutomaticEmailTests(MockedESTestCase):
             status=SentAutomaticEmail.SENT
         ).values_list('user__email', flat=True)) == expected
 
+    def test_mark_emails_as_sent_chunked(self):
+        """The pending SentAutomaticEmails should be created, locked and updated a chunk at a time"""
+        with mute_signals(post_save):
+            users = UserFactory.create_batch(5)
+        SentAutomaticEmail.objects.create(automatic_email=self.automatic_email, user=users[0])
+        SentAutomaticEmail.objects.create(
+            automatic_email=self.automatic_email, user=users[1], status=SentAutomaticEmail.SENT
+        )
+        with patch('mail.api.SENT_AUTOMATIC_EMAIL_CHUNK_SIZE', 2):
+            with mark_emails_as_sent(self.automatic_email, [user.email for user in users]) as user_ids:
+                assert sorted(user_ids) == sorted(user.id for user in users if user != users[1])
+
+        assert sorted(self.automatic_email.sentautomaticemail_set.filter(
+            user__in=users,
+            status=SentAutomaticEmail.SENT,
+        ).values_list('user_id', flat=True)) == sorted(user.id for user in users)
+
+
+@ddt
+class SearchResultMailTests(MockedESTestCase):
+    """Tests for the emails sent to search results"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        with mute_signals(post_save):
+            cls.profiles = [ProfileFactory.create() for _ in range(3)]
+        cls.emails = [profile.user.email for profile in cls.profiles]
+
+    @override_settings(MAILGUN_BATCH_CHUNK_SIZE=2)
+    def test_create_search_result_mail_chunks(self):
+        """The unique emails matching the search should be split in chunks"""
+        job = SearchResultMailJobFactory.create(search_request={"query": {"match_all": {}}})
+        hits = [Mock(email=email) for email in self.emails + self.emails[:1]]
+        with patch('mail.api.scan_search', autospec=True, return_value=iter(hits)) as mock_scan, patch(
+            'mail.api.create_search_obj', autospec=True
+        ) as mock_create_search_obj:
+            create_search_result_mail_chunks(job)
+
+        mock_create_search_obj.assert_called_once_with(
+            job.staff_user, search_param_dict=job.search_request, filter_on_email_optin=True,
+        )
+        assert mock_scan.call_count == 1
+        job.refresh_from_db()
+        assert job.status == SearchResultMailJob.SENDING
+        assert job.recipient_count == 3
+        assert [chunk.recipients for chunk in job.chunks.order_by('id')] == [self.emails[:2], self.emails[2:]]
+        assert all(chunk.status == SearchResultMailChunk.PENDING for chunk in job.chunks.all())
+
+    def test_send_search_result_mail_chunk(self):
+        """The email of the job should be sent to the recipients of the chunk"""
+        chunk = SearchResultMailChunkFactory.create(recipients=self.emails)
+        job = chunk.job
+        with patch('mail.api.MailgunClient') as mock_mailgun:
+            send_search_result_mail_chunk(chunk)
+
+        _, called_kwargs = mock_mailgun.send_batch.call_args
+        assert called_kwargs['subject'] == job.email_subject
+        assert called_kwargs['body'] == job.email_body
+        assert called_kwargs['sender_name'] == job.sender_name
+        assert sorted(called_kwargs['recipients']) == sorted(
+            (context['email'], context) for context in get_mail_vars(self.emails)
+        )
+        chunk.refresh_from_db()
+        assert chunk.status == SearchResultMailChunk.SENT
+
+    @data(SendBatchException([(['a@example.com'], HTTPError())]), ImproperlyConfigured())
+    def test_send_search_result_mail_chunk_error(self, exception):
+        """A failure should be recorded in the chunk instead of being raised"""
+        chunk = SearchResultMailChunkFactory.create(recipients=self.emails)
+        with patch('mail.api.MailgunClient', send_batch=Mock(side_effect=exception)):
+            send_search_result_mail_chunk(chunk)
+
+        chunk.refresh_from_db()
+        assert chunk.status == SearchResultMailChunk.FAILED
+        assert chunk.error == str(exception)
+
+    @data(True, False)
+    def test_send_search_result_mail_chunk_automatic(self, errored):
+        """Recipients of an automatic email should only be sent the email once"""
+        automatic_email = AutomaticEmailFactory.create(enabled=True)
+        SentAutomaticEmail.objects.create(
+            automatic_email=automatic_email,
+            user=self.profiles[0].user,
+            status=SentAutomaticEmail.SENT,
+        )
+        chunk = SearchResultMailChunkFactory.create(
+            recipients=self.emails, job__automatic_email=automatic_email
+        )
+        with patch('mail.api.MailgunClient', send_batch=Mock(side_effect=HTTPError() if errored else None)) as (
+            mock_mailgun
+        ):
+            send_search_result_mail_chunk(chunk)
+
+        _, called_kwargs = mock_mailgun.send_batch.call_args
+        assert sorted(email for email, _ in called_kwargs['recipients']) == sorted(self.emails[1:])
+        expected_sent = self.emails[:1] if errored else self.emails
+        assert sorted(automatic_email.sentautomaticemail_set.filter(
+            status=SentAutomaticEmail.SENT
+        ).values_list('user__email', flat=True)) == sorted(expected_sent)
+
 
 class RecipientVariablesTests(MockedESTestCase):
     """Tests for recipient variables"""
@@ -6,7 +6,11 @@ from factory import (
 from factory.django import DjangoModelFactory
 from factory.fuzzy import FuzzyText
 
-from mail.models import AutomaticEmail
+from mail.models import (
+    AutomaticEmail,
+    SearchResultMailChunk,
+    SearchResultMailJob,
+)
 from search.factories import PercolateQueryFactory
 from search.models import PercolateQuery
 from micromasters.factories import UserFactory
@@ -23,3 +27,24 @@ class AutomaticEmailFactory(DjangoModelFactory):
 
     class Meta:
         model = AutomaticEmail
+
+
+class SearchResultMailJobFactory(DjangoModelFactory):
+    """Factory for SearchResultMailJob"""
+    staff_user = SubFactory(UserFactory)
+    search_request = {}
+    email_subject = FuzzyText()
+    email_body = FuzzyText()
+    sender_name = Faker('name')
+
+    class Meta:
+        model = SearchResultMailJob
+
+
+class SearchResultMailChunkFactory(DjangoModelFactory):
+    """Factory for SearchResultMailChunk"""
+    job = SubFactory(SearchResultMailJobFactory)
+    recipients = ['a@example.com', 'b@example.com']
+
+    class Meta:
+        model = SearchResultMailChunk
@@ -0,0 +1,51 @@
+# Generated by Django 2.2.13 on 2026-10-17 12:00
+
+from django.conf import settings
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('mail', '0008_partnerschool'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchResultMailJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+                ('search_request', django.contrib.postgres.fields.jsonb.JSONField(null=True)),
+                ('email_subject', models.TextField(blank=True)),
+                ('email_body', models.TextField(blank=True)),
+                ('sender_name', models.TextField(blank=True)),
+                ('recipient_count', models.IntegerField(default=0)),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('sending', 'sending'), ('finished', 'finished')], default='pending', max_length=30)),
+                ('automatic_email', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='mail.AutomaticEmail')),
+                ('staff_user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='SearchResultMailChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+                ('recipients', django.contrib.postgres.fields.jsonb.JSONField()),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('sent', 'sent'), ('failed', 'failed')], default='pending', max_length=30)),
+                ('error', models.TextField(blank=True)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='mail.SearchResultMailJob')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
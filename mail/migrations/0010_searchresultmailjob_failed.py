@@ -0,0 +1,23 @@
+# Generated by Django 2.2.13 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail', '0009_searchresultmailjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchresultmailjob',
+            name='error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AlterField(
+            model_name='searchresultmailjob',
+            name='status',
+            field=models.CharField(choices=[('pending', 'pending'), ('sending', 'sending'), ('finished', 'finished'), ('failed', 'failed')], default='pending', max_length=30),
+        ),
+    ]
@@ -2,6 +2,7 @@
 Models for mail
 """
 from django.contrib.auth.models import User
+from django.contrib.postgres.fields import JSONField
 from django.db import models
 
 from financialaid.models import FinancialAid
@@ -66,6 +67,63 @@ class SentAutomaticEmail(TimestampedModel):
         )
 
 
+class SearchResultMailJob(TimestampedModel):
+    """
+    An email sent by a staff user to the learners matching a search, which is delivered asynchronously
+    """
+    PENDING = 'pending'
+    SENDING = 'sending'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+
+    STATUSES = [PENDING, SENDING, FINISHED, FAILED]
+
+    staff_user = models.ForeignKey(User, null=True, on_delete=models.CASCADE)
+    automatic_email = models.ForeignKey(AutomaticEmail, null=True, on_delete=models.SET_NULL)
+    search_request = JSONField(null=True)
+    email_subject = models.TextField(null=False, blank=True)
+    email_body = models.TextField(null=False, blank=True)
+    sender_name = models.TextField(null=False, blank=True)
+    recipient_count = models.IntegerField(default=0)
+    # PENDING until the recipients are split in chunks, SENDING until every chunk has been handled.
+    # FAILED if the recipients couldn't be split or if a chunk task failed, the job can then be retried.
+    status = models.CharField(
+        max_length=30,
+        choices=[(status, status) for status in STATUSES],
+        default=PENDING,
+    )
+    error = models.TextField(null=False, blank=True)
+
+    def __str__(self):
+        return "SearchResultMailJob sender={}, subject={}".format(self.sender_name, self.email_subject)
+
+
+class SearchResultMailChunk(TimestampedModel):
+    """
+    A group of recipients of a SearchResultMailJob which are sent a single Mailgun batch request
+    """
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    STATUSES = [PENDING, SENT, FAILED]
+
+    job = models.ForeignKey(SearchResultMailJob, null=False, on_delete=models.CASCADE, related_name='chunks')
+    recipients = JSONField()
+    status = models.CharField(
+        max_length=30,
+        choices=[(status, status) for status in STATUSES],
+        default=PENDING,
+    )
+    error = models.TextField(null=False, blank=True)
+
+    def __str__(self):
+        return "SearchResultMailChunk for job={job} with status={status}".format(
+            job=self.job_id,
+            status=self.status,
+        )
+
+
 class PartnerSchool(models.Model):
     """
     Model for partner school to send records to
@@ -2,11 +2,16 @@
 Serializers for mail
 """
 
+from django.db.models import Count
 from rest_framework import (
     fields,
     serializers
 )
-from mail.models import AutomaticEmail
+from mail.models import (
+    AutomaticEmail,
+    SearchResultMailChunk,
+    SearchResultMailJob,
+)
 from search.models import PercolateQuery
 
 
@@ -46,3 +51,31 @@ class AutomaticEmailSerializer(serializers.ModelSerializer):
             'id',
             'query'
         )
+
+
+class SearchResultMailJobSerializer(serializers.ModelSerializer):
+    """
+    Serializer for the progress of a SearchResultMailJob
+    """
+    chunks = serializers.SerializerMethodField()
+
+    def get_chunks(self, job):
+        """
+        Returns the number of chunks of the job for each status
+        """
+        counts = {status: 0 for status in SearchResultMailChunk.STATUSES}
+        counts.update(
+            job.chunks.values_list('status').annotate(count=Count('id')).order_by()
+        )
+        return counts
+
+    class Meta:
+        model = SearchResultMailJob
+        fields = (
+            'id',
+            'status',
+            'error',
+            'recipient_count',
+            'chunks',
+            'created_on',
+        )
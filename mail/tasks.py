@@ -0,0 +1,88 @@
+"""
+Tasks for sending the emails of the search results
+"""
+import logging
+
+from celery import chain, group
+from django.conf import settings
+
+from mail.api import (
+    create_search_result_mail_chunks,
+    send_search_result_mail_chunk as _send_search_result_mail_chunk,
+)
+from mail.models import SearchResultMailChunk, SearchResultMailJob
+from micromasters.celery import app
+from micromasters.utils import chunks
+
+
+log = logging.getLogger(__name__)
+
+
+@app.task
+def send_search_result_mail(job_id):
+    """
+    Splits the recipients of a SearchResultMailJob in chunks, if it hasn't been done yet,
+    and sends the pending chunks MAILGUN_SEND_CONCURRENCY at a time
+
+    Args:
+        job_id (int): A SearchResultMailJob id
+    """
+    job = SearchResultMailJob.objects.get(id=job_id)
+    if job.status == SearchResultMailJob.PENDING:
+        try:
+            create_search_result_mail_chunks(job)
+        except Exception as exc:  # pylint: disable=broad-except
+            log.exception("Unable to split the recipients of search result mail job %d", job_id)
+            fail_search_result_mail_job(job_id, error=str(exc))
+            return
+
+    chunk_ids = list(
+        job.chunks.filter(status=SearchResultMailChunk.PENDING).order_by('id').values_list('id', flat=True)
+    )
+    log.info("Sending %d chunks of search result mail job %d", len(chunk_ids), job_id)
+    # each group waits for the previous one, so there are never more concurrent Mailgun requests than the group size
+    waves = [
+        group(send_search_result_mail_chunk.si(chunk_id) for chunk_id in chunk_ids_wave)
+        for chunk_ids_wave in chunks(chunk_ids, chunk_size=settings.MAILGUN_SEND_CONCURRENCY)
+    ]
+    # if a chunk task fails outside of its own error handling the job would never be finished
+    chain(*waves, finish_search_result_mail_job.si(job_id)).on_error(
+        fail_search_result_mail_job.si(job_id, error="A task sending a chunk of emails failed")
+    ).delay()
+
+
+@app.task
+def send_search_result_mail_chunk(chunk_id):
+    """
+    Sends the email of a SearchResultMailJob to the recipients of a chunk
+
+    Args:
+        chunk_id (int): A SearchResultMailChunk id
+    """
+    chunk = SearchResultMailChunk.objects.select_related('job__automatic_email').get(id=chunk_id)
+    if chunk.status != SearchResultMailChunk.PENDING:
+        return
+    _send_search_result_mail_chunk(chunk)
+
+
+@app.task
+def finish_search_result_mail_job(job_id):
+    """
+    Marks a SearchResultMailJob as finished after all of its chunks have been handled
+
+    Args:
+        job_id (int): A SearchResultMailJob id
+    """
+    SearchResultMailJob.objects.filter(id=job_id).update(status=SearchResultMailJob.FINISHED, error='')
+
+
+@app.task
+def fail_search_result_mail_job(job_id, error=''):
+    """
+    Marks a SearchResultMailJob as failed, so that it can be retried
+
+    Args:
+        job_id (int): A SearchResultMailJob id
+        error (str): The reason of the failure
+    """
+    SearchResultMailJob.objects.filter(id=job_id).update(status=SearchResultMailJob.FAILED, error=error)
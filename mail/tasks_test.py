@@ -0,0 +1,117 @@
+"""
+Tests for the mail tasks
+"""
+import pytest
+
+from mail.factories import SearchResultMailChunkFactory, SearchResultMailJobFactory
+from mail.models import SearchResultMailChunk, SearchResultMailJob
+from mail.tasks import (
+    fail_search_result_mail_job,
+    finish_search_result_mail_job,
+    send_search_result_mail,
+    send_search_result_mail_chunk,
+)
+
+# pylint: disable=redefined-outer-name
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def mock_send_chunk(mocker):
+    """Mock the function sending a chunk of recipients"""
+    def _send(chunk):
+        """Mark the chunk as sent"""
+        chunk.status = SearchResultMailChunk.SENT
+        chunk.save()
+    return mocker.patch('mail.tasks._send_search_result_mail_chunk', autospec=True, side_effect=_send)
+
+
+def test_send_search_result_mail(mocker, settings, mock_send_chunk):
+    """A new job should be split in chunks, which are all sent before the job is finished"""
+    settings.MAILGUN_SEND_CONCURRENCY = 2
+    job = SearchResultMailJobFactory.create()
+
+    def _create_chunks(job):
+        """Create three chunks for the job"""
+        SearchResultMailChunkFactory.create_batch(3, job=job)
+        job.status = SearchResultMailJob.SENDING
+        job.save()
+    create_chunks_mock = mocker.patch(
+        'mail.tasks.create_search_result_mail_chunks', autospec=True, side_effect=_create_chunks
+    )
+
+    send_search_result_mail.delay(job.id)
+
+    assert create_chunks_mock.call_count == 1
+    assert mock_send_chunk.call_count == 3
+    job.refresh_from_db()
+    assert job.status == SearchResultMailJob.FINISHED
+    assert set(job.chunks.values_list('status', flat=True)) == {SearchResultMailChunk.SENT}
+
+
+def test_send_search_result_mail_retry(mocker, mock_send_chunk):
+    """A job which has already been split should only send the pending chunks"""
+    job = SearchResultMailJobFactory.create(status=SearchResultMailJob.SENDING)
+    SearchResultMailChunkFactory.create(job=job, status=SearchResultMailChunk.SENT)
+    pending_chunk = SearchResultMailChunkFactory.create(job=job)
+    create_chunks_mock = mocker.patch('mail.tasks.create_search_result_mail_chunks', autospec=True)
+
+    send_search_result_mail.delay(job.id)
+
+    assert create_chunks_mock.called is False
+    assert mock_send_chunk.call_count == 1
+    assert mock_send_chunk.call_args[0][0].id == pending_chunk.id
+    job.refresh_from_db()
+    assert job.status == SearchResultMailJob.FINISHED
+
+
+def test_send_search_result_mail_chunk_already_sent(mock_send_chunk):
+    """A chunk which isn't pending anymore should not be sent again"""
+    chunk = SearchResultMailChunkFactory.create(status=SearchResultMailChunk.SENT)
+    send_search_result_mail_chunk.delay(chunk.id)
+    assert mock_send_chunk.called is False
+
+
+def test_send_search_result_mail_split_error(mocker, mock_send_chunk):
+    """If the recipients can't be split in chunks the job should fail instead of staying pending"""
+    job = SearchResultMailJobFactory.create()
+    mocker.patch(
+        'mail.tasks.create_search_result_mail_chunks', autospec=True, side_effect=ConnectionError('ES is down')
+    )
+
+    send_search_result_mail.delay(job.id)
+
+    assert mock_send_chunk.called is False
+    job.refresh_from_db()
+    assert job.status == SearchResultMailJob.FAILED
+    assert job.error == 'ES is down'
+
+
+def test_send_search_result_mail_chunk_task_error(mocker):
+    """If a chunk task fails the job should be marked as failed instead of staying in the sending state"""
+    job = SearchResultMailJobFactory.create(status=SearchResultMailJob.SENDING)
+    SearchResultMailChunkFactory.create(job=job)
+    chain_mock = mocker.patch('mail.tasks.chain', autospec=True)
+
+    send_search_result_mail(job.id)
+
+    chain_mock.return_value.on_error.assert_called_once_with(
+        fail_search_result_mail_job.si(job.id, error=mocker.ANY)
+    )
+    chain_mock.return_value.on_error.return_value.delay.assert_called_once_with()
+
+
+def test_fail_and_finish_search_result_mail_job():
+    """A job can be marked as failed, and the error is cleared once it finishes"""
+    job = SearchResultMailJobFactory.create(status=SearchResultMailJob.SENDING)
+
+    fail_search_result_mail_job.delay(job.id, error='error')
+    job.refresh_from_db()
+    assert job.status == SearchResultMailJob.FAILED
+    assert job.error == 'error'
+
+    finish_search_result_mail_job.delay(job.id)
+    job.refresh_from_db()
+    assert job.status == SearchResultMailJob.FINISHED
+    assert job.error == ''
@@ -6,6 +6,8 @@ from mail.views import (
     LearnerMailView,
     FinancialAidMailView,
     SearchResultMailView,
+    SearchResultMailJobView,
+    SearchResultMailJobRetryView,
     CourseTeamMailView,
     AutomaticEmailView,
     MailWebhookView,
@@ -18,6 +20,10 @@ urlpatterns = [
     url(r'^api/v0/financial_aid_mail/(?P<financial_aid_id>[\d]+)/$', FinancialAidMailView.as_view(),
         name='financial_aid_mail_api'),
     url(r'^api/v0/mail/search/$', SearchResultMailView.as_view(), name='search_result_mail_api'),
+    url(r'^api/v0/mail/search/(?P<job_id>[\d]+)/$', SearchResultMailJobView.as_view(),
+        name='search_result_mail_job_api'),
+    url(r'^api/v0/mail/search/(?P<job_id>[\d]+)/retry/$', SearchResultMailJobRetryView.as_view(),
+        name='search_result_mail_job_retry_api'),
     url(r'^api/v0/mail/course/(?P<course_id>[\d]+)/$', CourseTeamMailView.as_view(), name='course_team_mail_api'),
     url(r'^api/v0/mail/learner/(?P<student_id>[\d]+)/$', LearnerMailView.as_view(), name='learner_mail_api'),
     url(r'^api/v0/mail/grades/(?P<partner_id>[\d]+)/$', GradesRecordMailView.as_view(), name='grades_mail_api'),
@@ -1,8 +1,11 @@
 """
 Utils for mail
 """
+from functools import lru_cache
 import logging
 
+from bs4 import BeautifulSoup
+from django.conf import settings
 from django.core.exceptions import ValidationError
 
 from dashboard.models import ProgramEnrollment
@@ -26,6 +29,9 @@ RECIPIENT_VARIABLE_NAMES = {
     'Email': 'email',
 }
 
+# number of distinct emails whose rendering is kept in memory by render_email
+RENDERED_EMAIL_CACHE_SIZE = 256
+
 
 def generate_financial_aid_email(financial_aid):
     """
@@ -107,6 +113,48 @@ def filter_recipient_variables(text):
     return text
 
 
+def render_email(subject, body):
+    """
+    Prepares the subject and the HTML body of an email for Mailgun and generates the plain-text fallback.
+    The same emails are usually sent many times, so the result is cached.
+
+    Args:
+        subject (str): subject of the email
+        body (str): HTML body of the email
+
+    Returns:
+        tuple: the subject, the HTML body and the plain-text body, with the recipient variables replaced
+    """
+    return _render_email(subject, body, settings.MAILGUN_HTML_PARSER)
+
+
+@lru_cache(maxsize=RENDERED_EMAIL_CACHE_SIZE)
+def _render_email(subject, body, parser):
+    """
+    Implementation of render_email
+
+    Args:
+        subject (str): subject of the email
+        body (str): HTML body of the email
+        parser (str): the BeautifulSoup parser used to generate the plain-text fallback
+
+    Returns:
+        tuple: the subject, the HTML body and the plain-text body, with the recipient variables replaced
+    """
+    # parse our HTML body in order to generate a plain-text fallback
+    # the only thing we need to do manually is ensure that we keep the
+    # href for any URLs in the text
+    soup = BeautifulSoup(body, parser)
+    for link in soup.find_all('a'):
+        link.replace_with(link.attrs['href'])
+    fallback_text = soup.get_text().strip()
+    return (
+        filter_recipient_variables(subject),
+        filter_recipient_variables(body),
+        filter_recipient_variables(fallback_text),
+    )
+
+
 def get_email_footer(url):
     """
     Construct a footer for email
@@ -2,8 +2,9 @@
 Tests for mail utils
 """
 
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 from django.core.exceptions import ValidationError
+from django.test import override_settings
 from requests import Response
 from rest_framework import status
 
@@ -25,7 +26,9 @@ from mail.utils import (
     generate_financial_aid_email,
     generate_mailgun_response_json,
     filter_recipient_variables,
+    render_email,
     RECIPIENT_VARIABLE_NAMES,
+    _render_email,
 )
 from mail.views_test import mocked_json
 from search.base import MockedESTestCase
@@ -156,3 +159,31 @@ class MailUtilsTests(MockedESTestCase):
         text = ' '.join(map('[{}]'.format, RECIPIENT_VARIABLE_NAMES.keys()))
         result = ' '.join(map('%recipient.{}%'.format, RECIPIENT_VARIABLE_NAMES.values()))
         assert filter_recipient_variables(text) == result
+
+    def test_render_email(self):
+        """
+        Test that the subject and the body get the recipient variables and a plain-text version of the body
+        """
+        _render_email.cache_clear()
+        body = '<h1>Hi [PreferredName]</h1><p>Go to <a href="www.google.com">google</a></p>'
+        assert render_email('Hello [PreferredName]', body) == (
+            'Hello %recipient.preferred_name%',
+            '<h1>Hi %recipient.preferred_name%</h1><p>Go to <a href="www.google.com">google</a></p>',
+            'Hi %recipient.preferred_name%Go to www.google.com',
+        )
+
+    @override_settings(MAILGUN_HTML_PARSER='html.parser')
+    def test_render_email_cached(self):
+        """
+        Test that the same email is parsed only once, with the configured parser
+        """
+        _render_email.cache_clear()
+        with patch('mail.utils.BeautifulSoup', autospec=True) as mock_soup:
+            mock_soup.return_value.find_all.return_value = []
+            mock_soup.return_value.get_text.return_value = 'body'
+            first = render_email('subject', '<p>body</p>')
+            assert render_email('subject', '<p>body</p>') == first
+            render_email('other subject', '<p>body</p>')
+        assert mock_soup.call_count == 2
+        mock_soup.assert_called_with('<p>body</p>', 'html.parser')
+        _render_email.cache_clear()
@@ -3,7 +3,6 @@ Views for email REST APIs
 """
 import logging
 
-from django.contrib.auth.models import User
 from django.shortcuts import get_object_or_404
 from django.template.loader import render_to_string
 from django.urls import reverse
@@ -12,7 +11,7 @@ from rest_framework import (
     permissions,
     status,
 )
-from rest_framework.generics import GenericAPIView, ListAPIView
+from rest_framework.generics import GenericAPIView, ListAPIView, RetrieveAPIView
 from rest_framework.mixins import UpdateModelMixin
 from rest_framework.views import APIView
 from rest_framework.viewsets import GenericViewSet
@@ -24,26 +23,27 @@ from financialaid.models import FinancialAid
 from financialaid.permissions import UserCanEditFinancialAid
 from mail.api import (
     add_automatic_email,
-    get_mail_vars,
+    can_retry_search_result_mail_job,
     MailgunClient,
-    mark_emails_as_sent,
 )
-from mail.exceptions import SendBatchException
 from mail.permissions import (
     UserCanMessageCourseTeamPermission,
     UserCanMessageLearnersPermission,
     UserCanMessageSpecificLearnerPermission,
     MailGunWebHookPermission,
 )
-from mail.serializers import GenericMailSerializer, AutomaticEmailSerializer
+from mail.serializers import GenericMailSerializer, AutomaticEmailSerializer, SearchResultMailJobSerializer
+from mail.tasks import send_search_result_mail
 from mail.utils import generate_mailgun_response_json, get_email_footer
-from mail.models import AutomaticEmail, PartnerSchool
+from mail.models import (
+    AutomaticEmail,
+    PartnerSchool,
+    SearchResultMailChunk,
+    SearchResultMailJob,
+)
 from profiles.models import Profile
 from profiles.util import full_name
-from search.api import (
-    create_search_obj,
-    get_all_query_matching_emails,
-)
+from search.api import create_search_obj
 
 log = logging.getLogger(__name__)
 
@@ -128,53 +128,97 @@ class SearchResultMailView(APIView):
 
     def post(self, request, *args, **kargs):  # pylint: disable=unused-argument
         """
-        POST method handler
+        POST method handler, which queues the emails and returns the job keeping track of them
         """
         email_subject = request.data['email_subject']
         email_body = request.data['email_body'] + get_email_footer(request.build_absolute_uri('/settings'))
         sender_name = full_name(request.user)
-        search_obj = create_search_obj(
-            request.user,
-            search_param_dict=request.data.get('search_request'),
-            filter_on_email_optin=True
-        )
-        emails = get_all_query_matching_emails(search_obj)
 
+        automatic_email = None
         if request.data.get('send_automatic_emails'):
+            search_obj = create_search_obj(
+                request.user,
+                search_param_dict=request.data.get('search_request'),
+                filter_on_email_optin=True
+            )
             automatic_email = add_automatic_email(
                 search_obj,
-                email_subject=request.data['email_subject'],
+                email_subject=email_subject,
                 email_body=email_body,
                 sender_name=sender_name,
                 staff_user=request.user,
             )
 
-            try:
-                with mark_emails_as_sent(automatic_email, emails) as user_ids:
-                    # user_ids should be all users with the matching email in emails
-                    # except some who were already sent email in the meantime
-                    recipient_emails = list(User.objects.filter(id__in=user_ids).values_list('email', flat=True))
-                    MailgunClient.send_batch(
-                        subject=email_subject,
-                        body=email_body,
-                        recipients=((context['email'], context) for context in get_mail_vars(recipient_emails)),
-                        sender_name=sender_name,
-                    )
-            except SendBatchException as send_batch_exception:
-                success_emails = set(emails).difference(send_batch_exception.failed_recipient_emails)
-                with mark_emails_as_sent(automatic_email, success_emails):
-                    pass
-                raise
+        job = SearchResultMailJob.objects.create(
+            staff_user=request.user,
+            automatic_email=automatic_email,
+            search_request=request.data.get('search_request'),
+            email_subject=email_subject,
+            email_body=email_body,
+            sender_name=sender_name,
+        )
+        send_search_result_mail.delay(job.id)
+        return Response(status=status.HTTP_202_ACCEPTED, data=SearchResultMailJobSerializer(job).data)
+
+
+class SearchResultMailJobView(RetrieveAPIView):
+    """
+    View class that returns the progress of the emails sent to search results
+    """
+    authentication_classes = (
+        authentication.SessionAuthentication,
+        authentication.TokenAuthentication,
+    )
+    permission_classes = (permissions.IsAuthenticated, UserCanMessageLearnersPermission, )
+    serializer_class = SearchResultMailJobSerializer
+    lookup_field = "id"
+    lookup_url_kwarg = "job_id"
+
+    def get_queryset(self):
+        """Get the queryset which should be serialized"""
+        return SearchResultMailJob.objects.filter(staff_user=self.request.user)
+
+
+class SearchResultMailJobRetryView(GenericAPIView):
+    """
+    View class that sends again the chunks of emails to search results which failed or were never sent
+    """
+    authentication_classes = (
+        authentication.SessionAuthentication,
+        authentication.TokenAuthentication,
+    )
+    permission_classes = (permissions.IsAuthenticated, UserCanMessageLearnersPermission, )
+    serializer_class = SearchResultMailJobSerializer
+    lookup_field = "id"
+    lookup_url_kwarg = "job_id"
 
+    def get_queryset(self):
+        """Get the queryset of the jobs which can be retried"""
+        return SearchResultMailJob.objects.filter(staff_user=self.request.user)
+
+    def post(self, request, *args, **kargs):  # pylint: disable=unused-argument
+        """
+        POST method handler
+        """
+        job = self.get_object()
+        if not can_retry_search_result_mail_job(job):
+            return Response(
+                status=status.HTTP_409_CONFLICT,
+                data={"detail": "The emails are still being sent"},
+            )
+        if job.status in (SearchResultMailJob.PENDING, SearchResultMailJob.FAILED) and not job.chunks.exists():
+            # the recipients were never split in chunks
+            job.status = SearchResultMailJob.PENDING
         else:
-            MailgunClient.send_batch(
-                subject=email_subject,
-                body=email_body,
-                recipients=((context['email'], context) for context in get_mail_vars(emails)),
-                sender_name=sender_name,
+            job.chunks.filter(status=SearchResultMailChunk.FAILED).update(
+                status=SearchResultMailChunk.PENDING,
+                error='',
             )
-
-        return Response(status=status.HTTP_200_OK, data={})
+            job.status = SearchResultMailJob.SENDING
+        job.error = ''
+        job.save()
+        send_search_result_mail.delay(job.id)
+        return Response(status=status.HTTP_202_ACCEPTED, data=self.get_serializer(job).data)
 
 
 class CourseTeamMailView(GenericAPIView):
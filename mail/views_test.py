@@ -1,9 +1,11 @@
 """
 Tests for HTTP email API views
 """
+from datetime import timedelta
 from unittest.mock import Mock, patch
 import ddt
 
+from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.urls import reverse
 from django.db.models.signals import post_save
@@ -27,12 +29,20 @@ from financialaid.api_test import (
     create_enrolled_profile,
 )
 from financialaid.factories import FinancialAidFactory, TierProgramFactory
-from mail.exceptions import SendBatchException
-from mail.factories import AutomaticEmailFactory
-from mail.models import SentAutomaticEmail, AutomaticEmail
-from mail.serializers import AutomaticEmailSerializer
+from mail.factories import (
+    AutomaticEmailFactory,
+    SearchResultMailChunkFactory,
+    SearchResultMailJobFactory,
+)
+from mail.models import (
+    AutomaticEmail,
+    SearchResultMailChunk,
+    SearchResultMailJob,
+)
+from mail.serializers import AutomaticEmailSerializer, SearchResultMailJobSerializer
 from mail.utils import get_email_footer
 from mail.views import MailWebhookView
+from micromasters.utils import now_in_utc
 from profiles.factories import (
     ProfileFactory,
     UserFactory,
@@ -80,89 +90,33 @@ class SearchResultMailViewsBase(MockedESTestCase, APITestCase):
             'email_subject': 'email subject',
             'email_body': 'email body'
         }
-        self.email_results = {'a@example.com', 'b@example.com'}
-        self.email_vars = [{
-            'email': 'a@example.com',
-            'mail_id': 'id1',
-            'first_name': 'A',
-        }, {
-            'email': 'b@example.com',
-            'mail_id': 'id2',
-            'first_name': 'B',
-        }]
-        self.recipient_tuples = [(context['email'], context) for context in self.email_vars]
 
 
+@ddt.ddt
 class SearchResultMailViewsTests(SearchResultMailViewsBase):
     """Tests for the mail API"""
 
     def test_send_view(self):
         """
-        Test that the SearchResultMailView will accept and return expected values
+        Test that the SearchResultMailView queues the emails and returns the job
         """
-        with patch(
-            'mail.views.get_all_query_matching_emails', autospec=True, return_value=self.email_results
-        ) as mock_get_emails, patch(
-            'mail.views.MailgunClient'
-        ) as mock_mailgun_client, patch(
-            'mail.views.get_mail_vars', autospec=True, return_value=self.email_vars,
-        ) as mock_get_mail_vars:
-            mock_mailgun_client.send_batch.return_value = [Response()]
+        with patch('mail.views.send_search_result_mail', autospec=True) as mock_send_task, patch(
+            'mail.views.add_automatic_email', autospec=True,
+        ) as mock_add_automatic_email:
             resp_post = self.client.post(self.search_result_mail_url, data=self.request_data, format='json')
-        assert resp_post.status_code == status.HTTP_200_OK
-        assert resp_post.data == {}
-        assert mock_get_emails.called
-        assert mock_get_emails.call_args[0][0].to_dict() == create_search_obj(
-            user=self.staff,
-            search_param_dict=self.request_data['search_request'],
-            filter_on_email_optin=True,
-        ).to_dict()
-
-        assert mock_mailgun_client.send_batch.called
-        _, called_kwargs = mock_mailgun_client.send_batch.call_args
-        assert called_kwargs['subject'] == self.request_data['email_subject']
-        self.assertIn(self.request_data['email_body'], called_kwargs['body'])
-        self.assertIn('edit your settings', called_kwargs['body'])
-        assert list(called_kwargs['recipients']) == self.recipient_tuples
-        mock_get_mail_vars.assert_called_once_with(self.email_results)
-
-    def test_view_response_error(self):
-        """
-        If there's at least one non-zero status code from Mailgun, we should return a 500 status code in our response.
-        """
-        exception_pairs = [
-            ['b@example.com'], HTTPError()
-        ]
-        with patch(
-            'mail.views.get_all_query_matching_emails', autospec=True, return_value=self.email_results
-        ), patch(
-            'mail.views.MailgunClient'
-        ) as mock_mailgun_client, patch(
-            'mail.views.get_mail_vars', autospec=True, return_value=self.email_vars,
-        ) as mock_get_mail_vars:
-            mock_mailgun_client.send_batch.side_effect = SendBatchException(exception_pairs)
-            with self.assertRaises(SendBatchException) as send_batch_exception:
-                self.client.post(self.search_result_mail_url, data=self.request_data, format='json')
-
-        assert send_batch_exception.exception.exception_pairs == exception_pairs
-        mock_get_mail_vars.assert_called_once_with(self.email_results)
-
-    def test_view_response_improperly_configured(self):
-        """
-        Test that the SearchResultMailView will raise ImproperlyConfigured if mailgun returns 401, which
-        results in returning 500 since micromasters.utils.custom_exception_handler catches ImproperlyConfigured
-        """
-        with patch(
-            'mail.views.get_all_query_matching_emails', autospec=True, return_value=self.email_results
-        ), patch(
-            'mail.views.MailgunClient'
-        ) as mock_mailgun_client, patch(
-            'mail.views.get_mail_vars', autospec=True, return_value=self.email_vars,
-        ) as mock_get_mail_vars:
-            mock_mailgun_client.send_batch.side_effect = ImproperlyConfigured
-            resp = self.client.post(self.search_result_mail_url, data=self.request_data, format='json')
-        assert resp.status_code == status.HTTP_500_INTERNAL_SERVER_ERROR
-        mock_get_mail_vars.assert_called_once_with(self.email_results)
+        assert resp_post.status_code == status.HTTP_202_ACCEPTED
+
+        job = SearchResultMailJob.objects.get()
+        assert resp_post.data == SearchResultMailJobSerializer(job).data
+        assert job.status == SearchResultMailJob.PENDING
+        assert job.staff_user == self.staff
+        assert job.automatic_email is None
+        assert job.search_request == self.request_data['search_request']
+        assert job.email_subject == self.request_data['email_subject']
+        assert job.email_body == self.request_data['email_body'] + get_email_footer('http://testserver/settings')
+        assert job.sender_name == full_name(self.staff)
+        mock_send_task.delay.assert_called_once_with(job.id)
+        assert mock_add_automatic_email.called is False
 
     def test_no_program_user_response(self):
         """
@@ -175,6 +129,122 @@ class SearchResultMailViewsTests(SearchResultMailViewsBase):
         resp_post = self.client.post(self.search_result_mail_url, data=self.request_data, format='json')
         assert resp_post.status_code == status.HTTP_403_FORBIDDEN
 
+    def test_job_progress(self):
+        """
+        The progress of a job should be returned to the staff user who sent the emails
+        """
+        job = SearchResultMailJobFactory.create(
+            staff_user=self.staff, status=SearchResultMailJob.SENDING, recipient_count=5
+        )
+        SearchResultMailChunkFactory.create_batch(2, job=job, status=SearchResultMailChunk.SENT)
+        SearchResultMailChunkFactory.create(job=job, status=SearchResultMailChunk.FAILED)
+
+        resp = self.client.get(reverse('search_result_mail_job_api', kwargs={'job_id': job.id}))
+        assert resp.status_code == status.HTTP_200_OK
+        assert resp.data == {
+            'id': job.id,
+            'status': SearchResultMailJob.SENDING,
+            'error': '',
+            'recipient_count': 5,
+            'chunks': {
+                SearchResultMailChunk.PENDING: 0,
+                SearchResultMailChunk.SENT: 2,
+                SearchResultMailChunk.FAILED: 1,
+            },
+            'created_on': resp.data['created_on'],
+        }
+
+    def test_job_progress_other_staff(self):
+        """
+        A staff user should not see the jobs of other staff users
+        """
+        job = SearchResultMailJobFactory.create()
+        resp = self.client.get(reverse('search_result_mail_job_api', kwargs={'job_id': job.id}))
+        assert resp.status_code == status.HTTP_404_NOT_FOUND
+
+    def test_retry_job(self):
+        """
+        Retrying a finished job should send again only the chunks which failed
+        """
+        job = SearchResultMailJobFactory.create(staff_user=self.staff, status=SearchResultMailJob.FINISHED)
+        sent_chunk = SearchResultMailChunkFactory.create(job=job, status=SearchResultMailChunk.SENT)
+        failed_chunk = SearchResultMailChunkFactory.create(
+            job=job, status=SearchResultMailChunk.FAILED, error='error'
+        )
+
+        with patch('mail.views.send_search_result_mail', autospec=True) as mock_send_task:
+            resp = self.client.post(reverse('search_result_mail_job_retry_api', kwargs={'job_id': job.id}))
+        assert resp.status_code == status.HTTP_202_ACCEPTED
+        mock_send_task.delay.assert_called_once_with(job.id)
+
+        job.refresh_from_db()
+        sent_chunk.refresh_from_db()
+        failed_chunk.refresh_from_db()
+        assert job.status == SearchResultMailJob.SENDING
+        assert sent_chunk.status == SearchResultMailChunk.SENT
+        assert failed_chunk.status == SearchResultMailChunk.PENDING
+        assert failed_chunk.error == ''
+
+    @ddt.data(True, False)
+    def test_retry_failed_job(self, has_chunks):
+        """
+        Retrying a failed job should split the recipients again if it didn't happen, or else send the chunks
+        which were not sent
+        """
+        job = SearchResultMailJobFactory.create(
+            staff_user=self.staff, status=SearchResultMailJob.FAILED, error='error'
+        )
+        if has_chunks:
+            SearchResultMailChunkFactory.create(job=job, status=SearchResultMailChunk.FAILED, error='error')
+            SearchResultMailChunkFactory.create(job=job, status=SearchResultMailChunk.PENDING)
+
+        with patch('mail.views.send_search_result_mail', autospec=True) as mock_send_task:
+            resp = self.client.post(reverse('search_result_mail_job_retry_api', kwargs={'job_id': job.id}))
+        assert resp.status_code == status.HTTP_202_ACCEPTED
+        mock_send_task.delay.assert_called_once_with(job.id)
+
+        job.refresh_from_db()
+        assert job.error == ''
+        if has_chunks:
+            assert job.status == SearchResultMailJob.SENDING
+            assert set(job.chunks.values_list('status', flat=True)) == {SearchResultMailChunk.PENDING}
+        else:
+            assert job.status == SearchResultMailJob.PENDING
+
+    @ddt.data(SearchResultMailJob.PENDING, SearchResultMailJob.SENDING)
+    def test_retry_stalled_job(self, job_status):
+        """
+        A job without any progress for SEARCH_RESULT_MAIL_STALLED_SECONDS can be retried
+        """
+        job = SearchResultMailJobFactory.create(staff_user=self.staff, status=job_status)
+        chunk = SearchResultMailChunkFactory.create(job=job, status=SearchResultMailChunk.SENT)
+        last_update = now_in_utc() - timedelta(seconds=settings.SEARCH_RESULT_MAIL_STALLED_SECONDS + 60)
+        SearchResultMailJob.objects.filter(id=job.id).update(updated_on=last_update)
+        # a chunk sent recently means that the job is still in progress
+        SearchResultMailChunk.objects.filter(id=chunk.id).update(updated_on=now_in_utc())
+        with patch('mail.views.send_search_result_mail', autospec=True):
+            resp = self.client.post(reverse('search_result_mail_job_retry_api', kwargs={'job_id': job.id}))
+        assert resp.status_code == status.HTTP_409_CONFLICT
+
+        SearchResultMailChunk.objects.filter(id=chunk.id).update(updated_on=last_update)
+        with patch('mail.views.send_search_result_mail', autospec=True) as mock_send_task:
+            resp = self.client.post(reverse('search_result_mail_job_retry_api', kwargs={'job_id': job.id}))
+        assert resp.status_code == status.HTTP_202_ACCEPTED
+        mock_send_task.delay.assert_called_once_with(job.id)
+        job.refresh_from_db()
+        assert job.status == SearchResultMailJob.SENDING
+
+    @ddt.data(SearchResultMailJob.PENDING, SearchResultMailJob.SENDING)
+    def test_retry_job_in_progress(self, job_status):
+        """
+        A job can't be retried while it is still sending emails
+        """
+        job = SearchResultMailJobFactory.create(staff_user=self.staff, status=job_status)
+        with patch('mail.views.send_search_result_mail', autospec=True) as mock_send_task:
+            resp = self.client.post(reverse('search_result_mail_job_retry_api', kwargs={'job_id': job.id}))
+        assert resp.status_code == status.HTTP_409_CONFLICT
+        assert mock_send_task.delay.called is False
+
 
 class AutomaticEmailTests(SearchResultMailViewsBase):
     """Tests for automatic emails created by search mail view"""
@@ -184,8 +254,6 @@ class AutomaticEmailTests(SearchResultMailViewsBase):
 
         self.request_data = self.request_data.copy()
         self.request_data['send_automatic_emails'] = True
-        for email in self.email_results:
-            UserFactory.create(email=email)
 
         self.automatic_email = AutomaticEmailFactory.create()
         self.search_obj = create_search_obj(
@@ -198,72 +266,13 @@ class AutomaticEmailTests(SearchResultMailViewsBase):
         """
         If send_automatic_emails is set to true, we should save the information in the AutomaticEmail model
         """
-        with patch(
-            'mail.views.get_all_query_matching_emails', autospec=True, return_value=self.email_results
-        ) as mock_get_emails, patch(
-            'mail.views.MailgunClient', send_batch=Mock(return_value=Response())
-        ) as mock_mailgun_client, patch(
+        with patch('mail.views.send_search_result_mail', autospec=True) as mock_send_task, patch(
             'mail.views.add_automatic_email', autospec=True, return_value=self.automatic_email,
-        ) as mock_add_automatic_email, patch(
-            'mail.views.get_mail_vars', autospec=True, return_value=self.email_vars,
-        ) as mock_get_mail_vars:
+        ) as mock_add_automatic_email:
             resp_post = self.client.post(self.search_result_mail_url, data=self.request_data, format='json')
-        assert resp_post.status_code == status.HTTP_200_OK
-        assert mock_get_emails.call_args[0][0].to_dict() == self.search_obj.to_dict()
-
-        assert mock_mailgun_client.send_batch.called
-        _, called_kwargs = mock_mailgun_client.send_batch.call_args
-        assert called_kwargs['subject'] == self.request_data['email_subject']
-        body_result = self.request_data['email_body'] + get_email_footer('http://testserver/settings')
-        assert called_kwargs['body'] == body_result
-        assert list(called_kwargs['recipients']) == self.recipient_tuples
-
-        assert mock_add_automatic_email.call_args[0][0].to_dict() == self.search_obj.to_dict()
-        assert mock_add_automatic_email.call_args[1] == {
-            "email_subject": self.request_data['email_subject'],
-            "email_body": body_result,
-            "sender_name": full_name(self.staff),
-            "staff_user": self.staff,
-        }
-
-        mock_get_mail_vars.assert_called_once_with(list(self.email_results))
-
-        assert SentAutomaticEmail.objects.filter(
-            user__email__in=self.email_results,
-            automatic_email=self.automatic_email,
-            status=SentAutomaticEmail.SENT,
-        ).count() == len(self.email_results)
-
-    def test_automatic_email_fail(self):
-        """
-        If one request fails, we should mark all other success emails as having been sent anyway
-        """
-        success_emails = {'a@example.com'}
-        failure_emails = self.email_results.difference(success_emails)
-        exception_pairs = [
-            (failure_emails, HTTPError())
-        ]
+        assert resp_post.status_code == status.HTTP_202_ACCEPTED
 
-        with patch(
-            'mail.views.get_all_query_matching_emails', autospec=True, return_value=self.email_results
-        ), patch(
-            'mail.views.MailgunClient', send_batch=Mock(side_effect=SendBatchException(exception_pairs))
-        ) as mock_mailgun_client, patch(
-            'mail.views.add_automatic_email', autospec=True, return_value=self.automatic_email,
-        ) as mock_add_automatic_email, patch(
-            'mail.views.get_mail_vars', autospec=True, return_value=self.email_vars,
-        ) as mock_get_mail_vars:
-            with self.assertRaises(SendBatchException) as send_batch_exception:
-                self.client.post(self.search_result_mail_url, data=self.request_data, format='json')
-        assert send_batch_exception.exception.exception_pairs == exception_pairs
-
-        assert mock_mailgun_client.send_batch.called
-        _, called_kwargs = mock_mailgun_client.send_batch.call_args
-        assert called_kwargs['subject'] == self.request_data['email_subject']
         body_result = self.request_data['email_body'] + get_email_footer('http://testserver/settings')
-        assert called_kwargs['body'] == body_result
-        assert list(called_kwargs['recipients']) == self.recipient_tuples
-
         assert mock_add_automatic_email.call_args[0][0].to_dict() == self.search_obj.to_dict()
         assert mock_add_automatic_email.call_args[1] == {
             "email_subject": self.request_data['email_subject'],
@@ -272,13 +281,9 @@ class AutomaticEmailTests(SearchResultMailViewsBase):
             "staff_user": self.staff,
         }
 
-        mock_get_mail_vars.assert_called_once_with(list(self.email_results))
-
-        assert sorted(SentAutomaticEmail.objects.filter(
-            user__email__in=self.email_results,
-            automatic_email=self.automatic_email,
-            status=SentAutomaticEmail.SENT,
-        ).values_list('user__email', flat=True)) == sorted(success_emails)
+        job = SearchResultMailJob.objects.get()
+        assert job.automatic_email == self.automatic_email
+        mock_send_task.delay.assert_called_once_with(job.id)
 
 
 class AutomaticEmailViewTests(APITestCase, MockedESTestCase):
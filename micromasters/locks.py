@@ -48,6 +48,20 @@ def release_lock(lock_name, token):
         pass
 
 
+def is_locked(lock_name):
+    """
+    Checks if a lock is currently held
+
+    Args:
+        lock_name (str): The lock key in redis
+
+    Returns:
+        bool: True if the lock is held
+    """
+    redis = caches['redis'].client.get_client()
+    return bool(redis.exists(lock_name))
+
+
 class Lock(AbstractContextManager):
     """
     Attempt to acquire a lock. If so is_still_locked is yielded to the with block
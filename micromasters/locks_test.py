@@ -8,6 +8,7 @@ import pytest
 
 from micromasters.locks import (
     Lock,
+    is_locked,
     release_lock,
 )
 from micromasters.utils import now_in_utc
@@ -133,3 +134,14 @@ def test_release_lock(long_lock):
     # This release does work because the token matches up
     release_lock(long_lock.name, token)
     assert Lock(long_lock.name, long_lock.expiration).acquire() is True
+
+
+def test_is_locked(long_lock):
+    """
+    is_locked should tell if a lock is held by anybody
+    """
+    assert is_locked(long_lock.name) is False
+    assert long_lock.acquire() is True
+    assert is_locked(long_lock.name) is True
+    long_lock.release()
+    assert is_locked(long_lock.name) is False
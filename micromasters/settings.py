@@ -1,6 +1,7 @@
 """
 Django settings for MicroMasters.
 """
+import importlib.util
 import logging
 import os
 import platform
@@ -310,6 +311,16 @@ MAILGUN_KEY = get_string('MAILGUN_KEY', None)
 if not MAILGUN_KEY:
     raise ImproperlyConfigured("MAILGUN_KEY not set")
 MAILGUN_BATCH_CHUNK_SIZE = get_int('MAILGUN_BATCH_CHUNK_SIZE', 1000)
+# BeautifulSoup parser generating the plain-text version of the emails, lxml is the fastest one
+MAILGUN_HTML_PARSER = get_string('MAILGUN_HTML_PARSER', 'html5lib')
+if MAILGUN_HTML_PARSER not in ('html5lib', 'html.parser', 'lxml'):
+    raise ImproperlyConfigured("MAILGUN_HTML_PARSER must be one of html5lib, html.parser or lxml")
+if importlib.util.find_spec(MAILGUN_HTML_PARSER) is None:
+    raise ImproperlyConfigured("MAILGUN_HTML_PARSER is {} but it is not installed".format(MAILGUN_HTML_PARSER))
+# maximum number of Mailgun batch requests which are sent at the same time
+MAILGUN_SEND_CONCURRENCY = get_int('MAILGUN_SEND_CONCURRENCY', 4)
+# a search result mail job without progress for this long is considered lost and can be retried
+SEARCH_RESULT_MAIL_STALLED_SECONDS = get_int('SEARCH_RESULT_MAIL_STALLED_SECONDS', 60 * 60)
 MAILGUN_RECIPIENT_OVERRIDE = get_string('MAILGUN_RECIPIENT_OVERRIDE', None)
 MAILGUN_FROM_EMAIL = get_string('MAILGUN_FROM_EMAIL', 'no-reply@micromasters.mit.edu')
 MAILGUN_BCC_TO_EMAIL = get_string('MAILGUN_BCC_TO_EMAIL', 'no-reply@micromasters.mit.edu')
@@ -499,6 +510,10 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'grades.tasks.generate_course_certificates_for_fa_students',
         'schedule': crontab(minute=0, hour='*')
     },
+    'drain-search-index-queue-every-minute': {
+        'task': 'search.tasks.drain_index_queue',
+        'schedule': crontab(minute='*', hour='*')
+    },
     'discussions-sync-memberships-every-minute': {
         'task': 'discussions.tasks.sync_channel_memberships',
         'schedule': crontab(minute='*', hour='*')
@@ -516,11 +531,42 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TIMEZONE = 'UTC'
+# The redis broker delivers again the tasks which are not done after this many seconds, including the ones waiting
+# for their countdown, so it must be longer than the countdowns of the paced batch update
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'visibility_timeout': get_int('CELERY_BROKER_VISIBILITY_TIMEOUT', 6 * 60 * 60),
+}
 
 
 # Celery parallel rate limit for batch_update_user_data
 # This is the number of tasks per minute, each task updates data for 20 users
 BATCH_UPDATE_RATE_LIMIT = get_string('BATCH_UPDATE_RATE_LIMIT', '5/m')
+# If enabled batch_update_user_data refreshes the users by priority tier and paces the refreshes
+# according to the latency and the error rate of edX
+BATCH_UPDATE_PRIORITY_SCHEDULING = get_bool('BATCH_UPDATE_PRIORITY_SCHEDULING', False)
+# Hours between two refreshes of the users in active or about to be frozen course runs, or recently logged in
+BATCH_UPDATE_HOT_REFRESH_HOURS = get_int('BATCH_UPDATE_HOT_REFRESH_HOURS', 6)
+# Hours between two refreshes of the users in recently ended or upcoming course runs
+BATCH_UPDATE_WARM_REFRESH_HOURS = get_int('BATCH_UPDATE_WARM_REFRESH_HOURS', 24)
+# Hours between two refreshes of all the other users
+BATCH_UPDATE_DORMANT_REFRESH_HOURS = get_int('BATCH_UPDATE_DORMANT_REFRESH_HOURS', 24 * 7)
+# Number of consecutive refreshes without changes after which a user is moved to the tier below
+BATCH_UPDATE_UNCHANGED_REFRESHES_TO_DEMOTE = get_int('BATCH_UPDATE_UNCHANGED_REFRESHES_TO_DEMOTE', 4)
+# Bounds of the number of users refreshed per minute by the paced batch update
+BATCH_UPDATE_MIN_USERS_PER_MINUTE = get_int('BATCH_UPDATE_MIN_USERS_PER_MINUTE', 10)
+BATCH_UPDATE_MAX_USERS_PER_MINUTE = get_int('BATCH_UPDATE_MAX_USERS_PER_MINUTE', 100)
+# The pace of the batch update is halved when edX is slower or fails more often than this
+BATCH_UPDATE_TARGET_LATENCY_SECONDS = get_int('BATCH_UPDATE_TARGET_LATENCY_SECONDS', 5)
+BATCH_UPDATE_MAX_ERROR_PERCENT = get_int('BATCH_UPDATE_MAX_ERROR_PERCENT', 5)
+
+# If enabled the dashboard API serves the cached edX data right away and refreshes it in a celery task
+DASHBOARD_STALE_WHILE_REVALIDATE = get_bool('DASHBOARD_STALE_WHILE_REVALIDATE', False)
+# Number of seconds a scheduled dashboard refresh prevents other refreshes for the same user
+DASHBOARD_REFRESH_LOCK_SECONDS = get_int('DASHBOARD_REFRESH_LOCK_SECONDS', 300)
+# If enabled the dashboard payload of each program is cached in redis until the underlying data changes
+DASHBOARD_PAYLOAD_CACHE_ENABLED = get_bool('DASHBOARD_PAYLOAD_CACHE_ENABLED', False)
+# Upper bound for the life of a cached payload, because some course statuses depend on the current time
+DASHBOARD_PAYLOAD_CACHE_SECONDS = get_int('DASHBOARD_PAYLOAD_CACHE_SECONDS', 60 * 60)
 
 
 # django cache back-ends
@@ -550,6 +596,17 @@ if not ELASTICSEARCH_INDEX:
     raise ImproperlyConfigured("Missing ELASTICSEARCH_INDEX")
 ELASTICSEARCH_HTTP_AUTH = get_string("ELASTICSEARCH_HTTP_AUTH", None)
 ELASTICSEARCH_SHARD_COUNT = get_int('ELASTICSEARCH_SHARD_COUNT', 5)
+# number of persistent connections kept in the pool of each Elasticsearch host
+ELASTICSEARCH_MAX_CONNECTIONS = get_int('ELASTICSEARCH_MAX_CONNECTIONS', 10)
+# how long a process caches the index aliases, recreate_index waits as long before indexing
+ELASTICSEARCH_ALIAS_CACHE_SECONDS = get_int('ELASTICSEARCH_ALIAS_CACHE_SECONDS', 60)
+# percentage of the outdated documents whose differences with Elasticsearch are logged, for debugging
+ELASTICSEARCH_DOCUMENT_DIFF_LOG_PERCENT = get_int('ELASTICSEARCH_DOCUMENT_DIFF_LOG_PERCENT', 0)
+# users changed by the search signals are indexed at most once per debounce window, in batches
+SEARCH_INDEX_DEBOUNCE_SECONDS = get_int('SEARCH_INDEX_DEBOUNCE_SECONDS', 60)
+SEARCH_INDEX_QUEUE_BATCH_SIZE = get_int('SEARCH_INDEX_QUEUE_BATCH_SIZE', 500)
+# index the users right away instead of queueing them, used by the tests
+SEARCH_INDEX_QUEUE_SYNC = get_bool('SEARCH_INDEX_QUEUE_SYNC', False)
 
 # django-role-permissions
 ROLEPERMISSIONS_MODULE = 'roles.roles'
@@ -7,6 +7,7 @@ import sys
 from unittest import mock
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
 
 
@@ -49,3 +50,19 @@ class TestSettings(TestCase):
         """DISABLE_SERVER_SIDE_CURSORS should be false if MITXPRO_DB_DISABLE_SS_CURSORS is false"""
         settings_vars = self.patch_settings({**REQUIRED_SETTINGS, "MICROMASTERS_DB_DISABLE_SS_CURSORS": "false"})
         assert settings_vars["DEFAULT_DATABASE_CONFIG"]["DISABLE_SERVER_SIDE_CURSORS"] is False
+
+    def test_mailgun_html_parser(self):
+        """MAILGUN_HTML_PARSER should accept the parsers supported by BeautifulSoup"""
+        for parser in ("html5lib", "html.parser"):
+            settings_vars = self.patch_settings({**REQUIRED_SETTINGS, "MAILGUN_HTML_PARSER": parser})
+            assert settings_vars["MAILGUN_HTML_PARSER"] == parser
+
+    def test_mailgun_html_parser_invalid(self):
+        """MAILGUN_HTML_PARSER should not accept an unknown parser"""
+        with self.assertRaises(ImproperlyConfigured):
+            self.patch_settings({**REQUIRED_SETTINGS, "MAILGUN_HTML_PARSER": "xml"})
+
+    def test_mailgun_html_parser_not_installed(self):
+        """MAILGUN_HTML_PARSER should not accept a parser which is not installed"""
+        with mock.patch("importlib.util.find_spec", return_value=None), self.assertRaises(ImproperlyConfigured):
+            self.patch_settings({**REQUIRED_SETTINGS, "MAILGUN_HTML_PARSER": "lxml"})
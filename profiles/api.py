@@ -4,6 +4,7 @@ Functions for profiles
 import logging
 
 from django.core.exceptions import ObjectDoesNotExist
+from social_django.models import UserSocialAuth
 
 from backends.edxorg import EdxOrgOAuth2
 
@@ -38,3 +39,22 @@ def get_social_username(user):
     except Exception as ex:  # pylint: disable=broad-except
         log.error("Unexpected error retrieving social auth username: %s", ex)
         return None
+
+
+def get_social_usernames(user_ids):
+    """
+    Get the social auth edX usernames of many users with a single query.
+
+    Args:
+        user_ids (iterable of int): the ids of the Django users
+
+    Returns:
+        dict: a map of user ids to edX usernames. As in get_social_username, the username
+            is None for users with no edX account or with more than one.
+    """
+    usernames = {}
+    for user_id, uid in UserSocialAuth.objects.filter(
+            user_id__in=user_ids, provider=EdxOrgOAuth2.name
+    ).values_list('user_id', 'uid'):
+        usernames[user_id] = None if user_id in usernames else uid
+    return usernames
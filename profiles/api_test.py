@@ -9,7 +9,7 @@ from testfixtures import LogCapture
 
 from backends.edxorg import EdxOrgOAuth2
 
-from profiles.api import get_social_username, get_social_auth
+from profiles.api import get_social_username, get_social_usernames, get_social_auth
 from profiles.factories import SocialProfileFactory
 from micromasters.factories import UserSocialAuthFactory
 from search.base import MockedESTestCase
@@ -70,6 +70,23 @@ class SocialTests(MockedESTestCase):
                 )
             )
 
+    def test_get_social_usernames(self):
+        """
+        get_social_usernames should return the same usernames as get_social_username
+        """
+        other_user = SocialProfileFactory.create().user
+        duplicated_user = SocialProfileFactory.create().user
+        UserSocialAuthFactory.create(user=duplicated_user, uid='other name')
+        users = [self.user, other_user, duplicated_user]
+        usernames = get_social_usernames([user.id for user in users])
+        assert usernames == {
+            self.user.id: self.user.social_auth.first().uid,
+            other_user.id: other_user.social_auth.first().uid,
+            duplicated_user.id: None,
+        }
+        for user in users:
+            assert usernames[user.id] == get_social_username(user)
+
     def test_get_social_auth(self):
         """
         Tests that get_social_auth returns a user's edX social auth object, and if multiple edX social auth objects
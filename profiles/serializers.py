@@ -159,7 +159,12 @@ class ProfileBaseSerializer(ModelSerializer):
     education = EducationSerializer(many=True)
 
     def get_username(self, obj):
-        """Getter for the username field"""
+        """
+        Getter for the username field. The usernames can be provided in bulk
+        as a map of user ids to edX usernames in the 'social_usernames' context key.
+        """
+        if 'social_usernames' in self.context:
+            return self.context['social_usernames'].get(obj.user_id)
         return get_social_username(obj.user)
 
 
@@ -306,7 +311,12 @@ class ProfileImageSerializer(ModelSerializer):
     username = SerializerMethodField()
 
     def get_username(self, obj):
-        """Getter for the username field"""
+        """
+        Getter for the username field. The usernames can be provided in bulk
+        as a map of user ids to edX usernames in the 'social_usernames' context key.
+        """
+        if 'social_usernames' in self.context:
+            return self.context['social_usernames'].get(obj.user_id)
         return get_social_username(obj.user)
 
     class Meta:
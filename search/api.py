@@ -3,6 +3,7 @@ Functions for executing ES searches
 """
 import json
 import logging
+import random
 
 from django.conf import settings
 from django.contrib.auth.models import User
@@ -15,6 +16,7 @@ from jsonpatch import make_patch
 
 from courses.models import Program
 from dashboard.models import ProgramEnrollment
+from micromasters.utils import chunks
 from profiles.models import Profile
 from roles.api import get_advance_searchable_program_ids
 from search.connection import (
@@ -33,9 +35,19 @@ from search.exceptions import (
     NoProgramAccessException,
     PercolateException,
 )
-from search.indexing_api import serialize_program_enrolled_user
+from search.indexing_api import (
+    get_document_fingerprints,
+    make_document_fingerprint,
+    save_document_fingerprints,
+    serialize_program_enrolled_users,
+)
+from search.util import fix_nested_filter
 
 DEFAULT_ES_LOOP_PAGE_SIZE = 100
+# number of documents percolated in a single request
+PERCOLATE_CHUNK_SIZE = 100
+# number of memberships created or updated in a single query
+MEMBERSHIP_CHUNK_SIZE = 1000
 
 
 log = logging.getLogger(__name__)
@@ -249,19 +261,24 @@ def get_all_query_matching_emails(search_obj):
     return search_for_field(search_obj, "email")
 
 
-def search_percolate_queries(program_enrollment_id, source_type):
+def search_percolate_queries(program_enrollment_id, source_type, percolate_matches=None):
     """
     Find all PercolateQuery objects whose queries match a user document
 
     Args:
         program_enrollment_id (int): A ProgramEnrollment id
         source_type (str): The type of the percolate query to filter on
+        percolate_matches (dict): optional results of percolate_program_enrollments to use
+            instead of querying Elasticsearch, if they include the ProgramEnrollment
 
     Returns:
         django.db.models.query.QuerySet: A QuerySet of PercolateQuery matching the percolate results
     """
-    enrollment = ProgramEnrollment.objects.get(id=program_enrollment_id)
-    result_ids = _search_percolate_queries(enrollment)
+    if percolate_matches is not None and program_enrollment_id in percolate_matches:
+        result_ids = percolate_matches[program_enrollment_id]
+    else:
+        enrollment = ProgramEnrollment.objects.get(id=program_enrollment_id)
+        result_ids = _search_percolate_queries(enrollment)
     return PercolateQuery.objects.filter(id__in=result_ids, source_type=source_type).exclude(is_deleted=True)
 
 
@@ -275,30 +292,57 @@ def _search_percolate_queries(program_enrollment):
     Returns:
         list of int: A list of PercolateQuery ids
     """
+    return sorted(percolate_program_enrollments([program_enrollment]).get(program_enrollment.id, []))
+
+
+def percolate_program_enrollments(program_enrollments):
+    """
+    Find the PercolateQuery ids whose queries match the documents of many program enrollments.
+    The documents are built in bulk and percolated together, PERCOLATE_CHUNK_SIZE at a time.
+
+    Args:
+        program_enrollments (iterable of ProgramEnrollment): Program enrollments
+
+    Returns:
+        dict: A map of ProgramEnrollment ids to the sets of matching PercolateQuery ids.
+            Enrollments which aren't indexed, i.e. because of a missing profile, don't match any query.
+    """
     conn = get_conn()
     percolate_index = get_default_alias(PERCOLATE_INDEX_TYPE)
-    doc = serialize_program_enrolled_user(program_enrollment)
-    if not doc:
-        return []
-    # We don't need this to search for percolator queries and
-    # it causes a dynamic mapping failure so we need to remove it
-    del doc['_id']
-
-    body = {
-        "query": {
-            "percolate": {
-                "field": "query",
-                "document": doc
-            }
+    # every query can match, so we need as many results as the number of queries
+    max_results = PercolateQuery.objects.count()
+    matches = {}
+    for program_enrollments_chunk in chunks(program_enrollments, chunk_size=PERCOLATE_CHUNK_SIZE):
+        enrollment_ids = [enrollment.id for enrollment in program_enrollments_chunk]
+        matches.update({enrollment_id: set() for enrollment_id in enrollment_ids})
+        docs = serialize_program_enrolled_users(enrollment_ids)
+        if not docs:
+            continue
+        for doc in docs:
+            # We don't need this to search for percolator queries and
+            # it causes a dynamic mapping failure so we need to remove it
+            del doc['_id']
+
+        body = {
+            "query": {
+                "percolate": {
+                    "field": "query",
+                    "documents": docs,
+                }
+            },
+            "size": max_results,
         }
-    }
 
-    result = conn.search(percolate_index, GLOBAL_DOC_TYPE, body=body)
-    failures = result.get('_shards', {}).get('failures', [])
-    if len(failures) > 0:
-        raise PercolateException("Failed to percolate: {}".format(failures))
+        result = conn.search(percolate_index, GLOBAL_DOC_TYPE, body=body)
+        failures = result.get('_shards', {}).get('failures', [])
+        if len(failures) > 0:
+            raise PercolateException("Failed to percolate: {}".format(failures))
 
-    return [int(row['_id']) for row in result['hits']['hits']]
+        for row in result['hits']['hits']:
+            # the positions of the documents matched by the query
+            for slot in row.get('fields', {}).get('_percolator_document_slot', []):
+                matches[docs[slot]['id']].add(int(row['_id']))
+    return matches
 
 
 def adjust_search_for_percolator(search):
@@ -330,45 +374,107 @@ def adjust_search_for_percolator(search):
     return updated_search
 
 
-def document_needs_updating(enrollment):
+def get_enrollments_needing_update(enrollments):
     """
-    Get the document from elasticsearch and see if it matches what's in the database
+    Find the enrollments whose documents in Elasticsearch don't match what's in the database.
+
+    The fingerprints of the indexed documents are compared with the ones of the fresh documents, so
+    Elasticsearch is only queried for the enrollments without a fingerprint, with a single mget.
+    The differences of a sample of the outdated documents are logged if
+    ELASTICSEARCH_DOCUMENT_DIFF_LOG_PERCENT is set.
 
     Args:
-        enrollment (ProgramEnrollment): A program enrollment
+        enrollments (iterable of ProgramEnrollment): Program enrollments
 
     Returns:
-        bool: True if the document needs to be updated via reindex
+        list of ProgramEnrollment: the enrollments whose documents need to be updated via reindex
     """
-    index = get_default_alias(PRIVATE_ENROLLMENT_INDEX_TYPE)
+    enrollments = list(enrollments)
+    documents = {
+        document['id']: document for document in
+        serialize_program_enrolled_users([enrollment.id for enrollment in enrollments])
+    }
+    fingerprints = get_document_fingerprints(list(documents))
+
+    outdated_ids = set()
+    unknown_ids = []
+    for enrollment_id, document in documents.items():
+        if enrollment_id not in fingerprints:
+            unknown_ids.append(enrollment_id)
+        elif fingerprints[enrollment_id] != make_document_fingerprint(document):
+            outdated_ids.add(enrollment_id)
+
+    log_percent = settings.ELASTICSEARCH_DOCUMENT_DIFF_LOG_PERCENT
+    logged_ids = [enrollment_id for enrollment_id in outdated_ids if random.uniform(0, 100) < log_percent]
+    sources = _get_private_sources(unknown_ids + logged_ids)
+    up_to_date = []
+    for enrollment_id in unknown_ids:
+        # Convert OrderedDict to dict
+        serialized_enrollment = json.loads(json.dumps(documents[enrollment_id]))
+        del serialized_enrollment['_id']
+        source = sources.get(enrollment_id)
+        if source == serialized_enrollment:
+            up_to_date.append(documents[enrollment_id])
+            continue
+        outdated_ids.add(enrollment_id)
+        if source is not None and random.uniform(0, 100) < log_percent:
+            logged_ids.append(enrollment_id)
+    save_document_fingerprints(up_to_date)
+
+    for enrollment_id in logged_ids:
+        serialized_enrollment = json.loads(json.dumps(documents[enrollment_id]))
+        del serialized_enrollment['_id']
+        diff = make_patch(sources.get(enrollment_id, {}), serialized_enrollment).patch
+        serialized_diff = json.dumps(diff, indent="    ")
+        log.info("Difference found for enrollment %s: %s", enrollment_id, serialized_diff)
 
-    conn = get_conn()
+    return [enrollment for enrollment in enrollments if enrollment.id in outdated_ids]
+
+
+def _get_private_sources(program_enrollment_ids):
+    """
+    Get the private documents of some program enrollments from Elasticsearch
+
+    Args:
+        program_enrollment_ids (list of int): Program enrollment ids
+
+    Returns:
+        dict: A map of program enrollment ids to the sources of the documents which have been found
+    """
+    if not program_enrollment_ids:
+        return {}
+    index = get_default_alias(PRIVATE_ENROLLMENT_INDEX_TYPE)
     try:
-        document = conn.get(index=index, doc_type=GLOBAL_DOC_TYPE, id=enrollment.id)
+        response = get_conn().mget(index=index, doc_type=GLOBAL_DOC_TYPE, body={'ids': program_enrollment_ids})
     except NotFoundError:
-        return True
-    serialized_enrollment = serialize_program_enrolled_user(enrollment)
-    del serialized_enrollment['_id']
-    source = document['_source']
+        return {}
+    return {
+        int(document['_id']): document['_source'] for document in response['docs'] if document.get('found')
+    }
 
-    if serialized_enrollment != source:
-        # Convert OrderedDict to dict
-        reserialized_enrollment = json.loads(json.dumps(serialized_enrollment))
 
-        diff = make_patch(source, reserialized_enrollment).patch
-        serialized_diff = json.dumps(diff, indent="    ")
-        log.info("Difference found for enrollment %s: %s", enrollment, serialized_diff)
-        return True
-    return False
+def document_needs_updating(enrollment):
+    """
+    Get the document from elasticsearch and see if it matches what's in the database
+
+    Args:
+        enrollment (ProgramEnrollment): A program enrollment
+
+    Returns:
+        bool: True if the document needs to be updated via reindex
+    """
+    return len(get_enrollments_needing_update([enrollment])) > 0
 
 
-def update_percolate_memberships(user, source_type):
+def update_percolate_memberships(user, source_type, percolate_matches=None):
     """
     Updates membership in a PercolateQuery
 
     Args:
         user (User): A User to check for membership changes
         source_type (str): The type of the percolate query to filter on
+        percolate_matches (dict): optional results of percolate_program_enrollments to use
+            instead of querying Elasticsearch for the enrollments of the user they include
     """
     # ensure we have a membership for each of the queries so we can acquire a lock on them
     percolate_queries = list(PercolateQuery.objects.filter(source_type=source_type).exclude(is_deleted=True))
@@ -379,7 +485,9 @@ def update_percolate_memberships(user, source_type):
 
     # if there are no percolate queries or memberships then there's nothing to do
     if membership_ids:
-        _update_memberships([query.id for query in percolate_queries], membership_ids, user)
+        _update_memberships(
+            [query.id for query in percolate_queries], membership_ids, user, percolate_matches=percolate_matches
+        )
 
 
 def _ensure_memberships_for_queries(percolate_queries, user):
@@ -398,7 +506,7 @@ def _ensure_memberships_for_queries(percolate_queries, user):
     return membership_ids
 
 
-def _update_memberships(percolate_query_ids, membership_ids, user, force_save=False):
+def _update_memberships(percolate_query_ids, membership_ids, user, percolate_matches=None):
     """
     Atomically determine and update memberships
 
@@ -406,7 +514,7 @@ def _update_memberships(percolate_query_ids, membership_ids, user, force_save=Fa
         percolate_query_ids (set of int): a set of PercolateQuery.id
         membership_ids (list of int): A list of ids for PercolateQueryMemberships to update
         user (User): A User to check for membership changes
-        force_save (bool): True if membership saves should be force even if no change
+        percolate_matches (dict): optional results of percolate_program_enrollments, see update_percolate_memberships
     """
 
     with transaction.atomic():
@@ -415,13 +523,16 @@ def _update_memberships(percolate_query_ids, membership_ids, user, force_save=Fa
         # limit the query_ids to the queries we are trying to update
         query_ids = set()
         for enrollment in user.programenrollment_set.all():
-            query_ids.update(set(_search_percolate_queries(enrollment)))
+            if percolate_matches is not None and enrollment.id in percolate_matches:
+                query_ids.update(percolate_matches[enrollment.id])
+            else:
+                query_ids.update(set(_search_percolate_queries(enrollment)))
         query_ids.intersection_update(percolate_query_ids)
 
         for membership in memberships:
             # only update if there's a delta in membership status
             is_member = membership.query_id in query_ids
-            if force_save or (membership.is_member is not is_member):
+            if membership.is_member is not is_member:
                 membership.is_member = is_member
                 membership.needs_update = True
                 membership.save()
@@ -429,15 +540,37 @@ def _update_memberships(percolate_query_ids, membership_ids, user, force_save=Fa
 
 def populate_query_memberships(percolate_query_id):
     """
-    Populates PercolateQueryMemberships for the given query and enrollments
+    Populates PercolateQueryMemberships for the given query and all active users
+
+    Rather than percolating the enrollments of every user one by one, the query is run as a scan search
+    against the private enrollment index, which contains the same documents which would be percolated.
+    The memberships are then created and updated in bulk.
 
     Args:
         percolate_query_id (int): Database id for the PercolateQuery to populate
     """
-    # practically this is a list of 1 query, but _ensure_memberships_for_queries requires a list
     query = PercolateQuery.objects.get(id=percolate_query_id)
-    users = User.objects.filter(is_active=True).iterator()
+    search = Search(index=get_default_alias(PRIVATE_ENROLLMENT_INDEX_TYPE), doc_type=GLOBAL_DOC_TYPE)
+    # the query is fixed the same way as the one indexed in the percolator, so they match the same documents
+    search.update_from_dict(fix_nested_filter(query.query, None))
+    matching_user_ids = search_for_field(search, 'user_id')
+
+    active_user_ids = set(User.objects.filter(is_active=True).values_list('id', flat=True))
+    with transaction.atomic():
+        existing_user_ids = set(
+            PercolateQueryMembership.objects.filter(query=query).values_list('user_id', flat=True)
+        )
+        PercolateQueryMembership.objects.bulk_create(
+            [
+                PercolateQueryMembership(query=query, user_id=user_id)
+                for user_id in active_user_ids - existing_user_ids
+            ],
+            batch_size=MEMBERSHIP_CHUNK_SIZE,
+            ignore_conflicts=True,
+        )
 
-    for user in users:
-        membership_ids = _ensure_memberships_for_queries([query], user)
-        _update_memberships(set([query.id]), membership_ids, user, force_save=True)
+        # every membership of an active user is saved, even if the status did not change
+        memberships = PercolateQueryMembership.objects.filter(query=query, user__is_active=True)
+        memberships.update(is_member=False, needs_update=True)
+        for user_ids_chunk in chunks(sorted(matching_user_ids & active_user_ids), chunk_size=MEMBERSHIP_CHUNK_SIZE):
+            memberships.filter(user_id__in=user_ids_chunk).update(is_member=True)
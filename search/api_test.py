@@ -2,7 +2,7 @@
 Tests for search API functionality
 """
 from itertools import product
-from unittest.mock import Mock, patch
+from unittest.mock import ANY, Mock, patch
 import ddt
 from elasticsearch_dsl import Search, Q
 from factory.django import mute_signals
@@ -10,6 +10,7 @@ from django.test import (
     override_settings,
 )
 from django.db.models.signals import post_save
+from django_redis import get_redis_connection
 
 from courses.factories import ProgramFactory
 from dashboard.models import ProgramEnrollment
@@ -24,11 +25,14 @@ from search.api import (
     document_needs_updating,
     execute_search,
     get_all_query_matching_emails,
+    get_enrollments_needing_update,
+    percolate_program_enrollments,
     prepare_and_execute_search,
     search_for_field,
     search_percolate_queries,
     update_percolate_memberships,
     populate_query_memberships,
+    _get_private_sources,
 )
 from search.base import ESTestCase
 from search.connection import (
@@ -41,7 +45,36 @@ from search.exceptions import (
     PercolateException,
 )
 from search.factories import PercolateQueryFactory, PercolateQueryMembershipFactory
+from search.indexing_api import CACHE_KEY_DOCUMENT_FINGERPRINTS, get_document_fingerprints
 from search.models import PercolateQuery, PercolateQueryMembership
+from search.util import fix_nested_filter
+
+
+# a stored query which uses the 'filter' of the old nested queries, see fix_nested_filter
+NESTED_FILTER_QUERY = {
+    "query": {
+        "bool": {
+            "should": [
+                {
+                    "nested": {
+                        "path": "program.course_runs",
+                        "filter": {
+                            "term": {
+                                "program.course_runs.semester": "2015 - Summer"
+                            }
+                        }
+                    }
+                },
+                {
+                    "match": {
+                        "profile.first_name": "Alice"
+                    }
+                }
+            ],
+            "minimum_should_match": 1
+        }
+    }
+}
 
 
 # pylint: disable=unused-argument
@@ -263,6 +296,41 @@ class SearchAPITests(ESTestCase):
         assert document_needs_updating(enrollment) is True
 
 
+    # This patch works around on_commit by invoking it immediately, since in TestCase all tests run in transactions
+    @patch('search.signals.transaction.on_commit', side_effect=lambda callback: callback())
+    def test_enrollments_needing_update_fingerprints(self, mocked_on_commit):
+        """
+        Elasticsearch should only be queried for the enrollments without a fingerprint of their document
+        """
+        enrollments = [ProgramEnrollmentFactory.create() for _ in range(3)]
+        get_redis_connection("redis").hdel(CACHE_KEY_DOCUMENT_FINGERPRINTS, enrollments[0].id)
+        with mute_signals(post_save):
+            enrollments[1].user.profile.first_name = "Changed"
+            enrollments[1].user.profile.save()
+
+        with patch('search.api._get_private_sources', wraps=_get_private_sources) as get_sources_mock:
+            assert get_enrollments_needing_update(enrollments) == [enrollments[1]]
+        get_sources_mock.assert_called_once_with([enrollments[0].id])
+        # the missing fingerprint has been restored from Elasticsearch
+        assert enrollments[0].id in get_document_fingerprints([enrollments[0].id])
+
+    @ddt.data(0, 100)
+    def test_enrollments_needing_update_log_diff(self, log_percent):
+        """
+        The differences of the outdated documents should only be logged when enabled
+        """
+        with patch('search.signals.transaction.on_commit', side_effect=lambda callback: callback()):
+            enrollment = ProgramEnrollmentFactory.create()
+        with mute_signals(post_save):
+            enrollment.user.profile.first_name = "Changed"
+            enrollment.user.profile.save()
+
+        with override_settings(ELASTICSEARCH_DOCUMENT_DIFF_LOG_PERCENT=log_percent), patch(
+            'search.api.log'
+        ) as log_mock:
+            assert get_enrollments_needing_update([enrollment]) == [enrollment]
+        assert log_mock.info.called is (log_percent == 100)
+
 # This patch works around on_commit by invoking it immediately, since in TestCase all tests run in transactions
 @ddt.ddt
 @patch('search.signals.transaction.on_commit', side_effect=lambda callback: callback())
@@ -311,6 +379,46 @@ class PercolateTests(ESTestCase):
             ).values_list("id", flat=True)
         ) == [query.id]
 
+    def test_percolate_program_enrollments(self, mock_on_commit):
+        """percolate_program_enrollments should percolate many enrollments at once"""
+        with mute_signals(post_save):
+            profiles = [ProfileFactory.create(filled_out=True, first_name=name) for name in ("Alice", "Bob")]
+            # an enrollment without a profile isn't indexed
+            no_profile_enrollment = ProgramEnrollmentFactory.create()
+        program_enrollments = [ProgramEnrollmentFactory.create(user=profile.user) for profile in profiles]
+        queries = [
+            PercolateQuery.objects.create(
+                query={"query": {"match": {"profile.first_name": first_name}}},
+                original_query={},
+                source_type=source_type,
+            ) for first_name, source_type in [
+                ("Alice", PercolateQuery.AUTOMATIC_EMAIL_TYPE),
+                ("Bob", PercolateQuery.DISCUSSION_CHANNEL_TYPE),
+                ("Alice Bob", PercolateQuery.AUTOMATIC_EMAIL_TYPE),
+                ("missing", PercolateQuery.AUTOMATIC_EMAIL_TYPE),
+            ]
+        ]
+
+        with patch('search.api.PERCOLATE_CHUNK_SIZE', 2):
+            assert percolate_program_enrollments(program_enrollments + [no_profile_enrollment]) == {
+                program_enrollments[0].id: {queries[0].id, queries[2].id},
+                program_enrollments[1].id: {queries[1].id, queries[2].id},
+                no_profile_enrollment.id: set(),
+            }
+
+    def test_search_percolate_queries_with_matches(self, mock_on_commit):
+        """search_percolate_queries should not query Elasticsearch again for enrollments already percolated"""
+        with mute_signals(post_save):
+            query = PercolateQueryFactory.create(source_type=PercolateQuery.AUTOMATIC_EMAIL_TYPE)
+            program_enrollment = ProgramEnrollmentFactory.create()
+        with patch('search.api.get_conn') as es_mock:
+            assert list(search_percolate_queries(
+                program_enrollment.id,
+                PercolateQuery.AUTOMATIC_EMAIL_TYPE,
+                percolate_matches={program_enrollment.id: {query.id}},
+            )) == [query]
+        assert es_mock.called is False
+
     def test_not_percolated(self, mock_on_commit):
         """If there are no percolated queries we should return an empty queryset"""
         with mute_signals(post_save):
@@ -456,22 +564,31 @@ class PercolateTests(ESTestCase):
     @ddt.unpack
     def test_populate_query_memberships(self, source_type, is_member, query_matches, mock_on_commit):
         """
-        Tests that existing memberships are updated where appropriate
+        Tests that memberships are created or updated for every user with a single search
         """
         with mute_signals(post_save):
-            query = PercolateQueryFactory.create(source_type=source_type)
+            query = PercolateQueryFactory.create(
+                source_type=source_type, query={"query": {"term": {"program.is_learner": True}}}
+            )
             profiles = [ProfileFactory.create(filled_out=True) for _ in range(3)]
-            program_enrollments = [ProgramEnrollmentFactory.create(user=profile.user) for profile in profiles]
+            for profile in profiles:
+                ProgramEnrollmentFactory.create(user=profile.user)
+        # one of the users already has a membership
+        PercolateQueryMembershipFactory.create(
+            user=profiles[0].user, query=query, is_member=is_member, needs_update=False
+        )
 
         with patch(
-            'search.api._search_percolate_queries',
-            return_value=[query.id] if query_matches else []
-        ) as search_percolate_queries_mock:
+            'search.api.search_for_field',
+            return_value={profile.user.id for profile in profiles} if query_matches else set()
+        ) as search_for_field_mock:
             populate_query_memberships(query.id)
 
-        assert search_percolate_queries_mock.call_count == len(program_enrollments)
-        for program_enrollment in program_enrollments:
-            search_percolate_queries_mock.assert_any_call(program_enrollment)
+        search_for_field_mock.assert_called_once_with(ANY, 'user_id')
+        search_obj = search_for_field_mock.call_args[0][0]
+        # pylint: disable=protected-access
+        assert search_obj._index == [get_default_alias(PRIVATE_ENROLLMENT_INDEX_TYPE)]
+        assert search_obj.to_dict()['query'] == query.query['query']
 
         for profile in profiles:
             membership = PercolateQueryMembership.objects.get(user=profile.user, query=query)
@@ -496,10 +613,49 @@ class PercolateTests(ESTestCase):
                 ProfileFactory.create(user=user, filled_out=True)
             ProgramEnrollmentFactory.create(user=user)
 
-        with patch('search.api.get_conn') as es_mock:
+        # the enrollments of users without a profile are not indexed, so they can't match
+        with patch('search.api.search_for_field', return_value={user.id} if has_profile else set()):
             populate_query_memberships(query.id)
-            assert es_mock.return_value.search.call_count == (1 if has_profile and is_active else 0)
 
-        assert PercolateQueryMembership.objects.filter(user=user, query=query).count() == (
-            1 if is_active else 0
+        # like before, active users get a membership even without a profile, which is never a match
+        assert list(
+            PercolateQueryMembership.objects.filter(user=user, query=query).values_list('is_member', flat=True)
+        ) == ([has_profile] if is_active else [])
+
+    def test_populate_query_memberships_nested_filter(self, mock_on_commit):
+        """
+        The nested filters of the stored query should be fixed like in the percolator
+        """
+        with mute_signals(post_save):
+            query = PercolateQueryFactory.create(
+                source_type=PercolateQuery.DISCUSSION_CHANNEL_TYPE, query=NESTED_FILTER_QUERY,
+            )
+        with patch('search.api.search_for_field', return_value=set()) as search_for_field_mock:
+            populate_query_memberships(query.id)
+
+        search_obj = search_for_field_mock.call_args[0][0]
+        assert search_obj.to_dict()['query'] == fix_nested_filter(NESTED_FILTER_QUERY, None)['query']
+
+    def test_populate_query_memberships_percolate_parity(self, mock_on_commit):
+        """
+        The memberships populated with a search should match the users whose enrollments are percolated
+        """
+        with mute_signals(post_save):
+            profiles = [ProfileFactory.create(filled_out=True, first_name=name) for name in ("Alice", "Bob")]
+        program_enrollments = [ProgramEnrollmentFactory.create(user=profile.user) for profile in profiles]
+        query = PercolateQuery.objects.create(
+            query=NESTED_FILTER_QUERY,
+            original_query={},
+            source_type=PercolateQuery.DISCUSSION_CHANNEL_TYPE,
         )
+
+        populate_query_memberships(query.id)
+
+        percolated_user_ids = {
+            program_enrollment.user_id for program_enrollment in program_enrollments
+            if query.id in percolate_program_enrollments([program_enrollment])[program_enrollment.id]
+        }
+        assert percolated_user_ids == {profiles[0].user.id}
+        assert set(
+            PercolateQueryMembership.objects.filter(query=query, is_member=True).values_list('user_id', flat=True)
+        ) == percolated_user_ids
@@ -4,6 +4,7 @@ Base test classes for search
 from unittest.mock import patch
 
 from django.test import (
+    override_settings,
     TestCase,
 )
 
@@ -19,7 +20,9 @@ class ESTestCase(TestCase):
     @classmethod
     def setUpClass(cls):
         # Make sure index exists when signals are run.
-        recreate_index()
+        # The settings fixtures are not active yet, don't wait for the alias caches to expire
+        with override_settings(ELASTICSEARCH_ALIAS_CACHE_SECONDS=0):
+            recreate_index()
         super().setUpClass()
 
     def setUp(self):
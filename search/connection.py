@@ -1,7 +1,12 @@
 """Manages the Elasticsearch connection"""
+from collections import defaultdict
+import threading
+import time
 import uuid
 
 from django.conf import settings
+from elasticsearch import Urllib3HttpConnection
+from elasticsearch.exceptions import TransportError
 from elasticsearch_dsl.connections import connections
 
 from search.exceptions import ReindexException
@@ -10,6 +15,17 @@ from search.exceptions import ReindexException
 _CONN = None
 # When we create the connection, check to make sure all appropriate mappings exist
 _CONN_VERIFIED = False
+# get_conn is used by the threads of parallel_bulk, make sure only one client is created
+_CONN_LOCK = threading.Lock()
+
+# index type -> (expiration timestamp, list of aliases)
+_ALIAS_CACHE = {}
+
+# (method, status) -> number of requests
+_REQUEST_COUNTS = defaultdict(int)
+# method -> total number of seconds spent in requests
+_REQUEST_SECONDS = defaultdict(float)
+_METRICS_LOCK = threading.Lock()
 
 PUBLIC_ENROLLMENT_INDEX_TYPE = 'public_enrollment'
 PRIVATE_ENROLLMENT_INDEX_TYPE = 'private_enrollment'
@@ -24,6 +40,74 @@ ALL_INDEX_TYPES = [
 ]
 
 
+class MeteredConnection(Urllib3HttpConnection):
+    """
+    A pooled connection which counts the requests sent to Elasticsearch and the time they take
+    """
+    def perform_request(self, method, *args, **kwargs):  # pylint: disable=arguments-differ
+        start = time.monotonic()
+        status = 'error'
+        try:
+            status, headers, data = super().perform_request(method, *args, **kwargs)
+            return status, headers, data
+        except TransportError as ex:
+            status = ex.status_code
+            raise
+        finally:
+            duration = time.monotonic() - start
+            with _METRICS_LOCK:
+                _REQUEST_COUNTS[(method, str(status))] += 1
+                _REQUEST_SECONDS[method] += duration
+
+
+def get_request_metrics():
+    """
+    Returns the counters of the requests this process has sent to Elasticsearch,
+    in the format of Prometheus samples
+
+    Returns:
+        list of tuple: tuples of (metric name, labels, value)
+    """
+    with _METRICS_LOCK:
+        samples = [
+            ('elasticsearch_requests_total', {'method': method, 'status': status}, count)
+            for (method, status), count in sorted(_REQUEST_COUNTS.items())
+        ]
+        samples.extend(
+            ('elasticsearch_request_duration_seconds_sum', {'method': method}, seconds)
+            for method, seconds in sorted(_REQUEST_SECONDS.items())
+        )
+    return samples
+
+
+def _get_client():
+    """
+    Lazily create the client, without verifying the indices
+
+    Returns:
+        tuple: the Elasticsearch client and whether it has just been created
+    """
+    # pylint: disable=global-statement
+    global _CONN
+
+    with _CONN_LOCK:
+        if _CONN is None:
+            http_auth = settings.ELASTICSEARCH_HTTP_AUTH
+            use_ssl = http_auth is not None
+            _CONN = connections.create_connection(
+                hosts=[settings.ELASTICSEARCH_URL],
+                http_auth=http_auth,
+                use_ssl=use_ssl,
+                # make sure we verify SSL certificates (off by default)
+                verify_certs=use_ssl,
+                connection_class=MeteredConnection,
+                # the number of connections kept alive for each host
+                maxsize=settings.ELASTICSEARCH_MAX_CONNECTIONS,
+            )
+            return _CONN, True
+        return _CONN, False
+
+
 def get_conn(*, verify=True, verify_indices=None):
     """
     Lazily create the connection.
@@ -36,22 +120,11 @@ def get_conn(*, verify=True, verify_indices=None):
         elasticsearch.client.Elasticsearch: An Elasticsearch client
     """
     # pylint: disable=global-statement
-    global _CONN
     global _CONN_VERIFIED
 
-    do_verify = False
-    if _CONN is None:
-        http_auth = settings.ELASTICSEARCH_HTTP_AUTH
-        use_ssl = http_auth is not None
-        _CONN = connections.create_connection(
-            hosts=[settings.ELASTICSEARCH_URL],
-            http_auth=http_auth,
-            use_ssl=use_ssl,
-            # make sure we verify SSL certificates (off by default)
-            verify_certs=use_ssl
-        )
-        # Verify connection on first connect if verify=True.
-        do_verify = verify
+    conn, created = _get_client()
+    # Verify connection on first connect if verify=True.
+    do_verify = created and verify
 
     if verify and not _CONN_VERIFIED:
         # If we have a connection but haven't verified before, do it now.
@@ -62,7 +135,7 @@ def get_conn(*, verify=True, verify_indices=None):
             # We only skip verification if we're reindexing or
             # deleting the index. Make sure we verify next time we connect.
             _CONN_VERIFIED = False
-        return _CONN
+        return conn
 
     # Make sure everything exists.
     if verify_indices is None:
@@ -72,13 +145,27 @@ def get_conn(*, verify=True, verify_indices=None):
                 get_aliases(index_type)
             )
     for verify_index in verify_indices:
-        if not _CONN.indices.exists(verify_index):
+        if not conn.indices.exists(verify_index):
             raise ReindexException("Unable to find index {index_name}".format(
                 index_name=verify_index
             ))
 
     _CONN_VERIFIED = True
-    return _CONN
+    return conn
+
+
+def reset_conn():
+    """
+    Forget the connection so that the next call to get_conn creates a new one.
+    Used by forked processes, which must not share the connection of the parent process.
+    """
+    # pylint: disable=global-statement
+    global _CONN
+    global _CONN_VERIFIED
+    with _CONN_LOCK:
+        _CONN = None
+        _CONN_VERIFIED = False
+    clear_alias_cache()
 
 
 def make_backing_index_name():
@@ -112,11 +199,20 @@ def make_alias_name(index_type, *, is_reindexing):
     )
 
 
+def clear_alias_cache():
+    """
+    Forget the aliases cached by get_aliases
+    """
+    _ALIAS_CACHE.clear()
+
+
 def get_aliases(index_type):
     """
     Return a list of active aliases
 
     There is always one item in the returned list and the first is always the default alias.
+    While there is no reindexing in progress the result is cached for ELASTICSEARCH_ALIAS_CACHE_SECONDS,
+    recreate_index waits for the caches to expire after creating the reindexing aliases.
 
     Args:
         index_type (str): The index type
@@ -126,7 +222,12 @@ def get_aliases(index_type):
             A list of aliases.
             The list will always have at least one tuple, and the first is always the default alias
     """
-    conn = get_conn(verify=False)
+    now = time.monotonic()
+    cached = _ALIAS_CACHE.get(index_type)
+    if cached is not None and cached[0] > now:
+        return list(cached[1])
+
+    conn, _ = _get_client()
 
     default_alias = make_alias_name(index_type, is_reindexing=False)
     reindexing_alias = make_alias_name(index_type, is_reindexing=True)
@@ -134,7 +235,10 @@ def get_aliases(index_type):
     aliases = [default_alias]
     if conn.indices.exists(reindexing_alias):
         aliases.append(reindexing_alias)
-    return aliases
+    elif settings.ELASTICSEARCH_ALIAS_CACHE_SECONDS > 0:
+        # the reindexing alias can disappear at any time, so only the default alias is cached
+        _ALIAS_CACHE[index_type] = (now + settings.ELASTICSEARCH_ALIAS_CACHE_SECONDS, aliases)
+    return list(aliases)
 
 
 def get_default_alias(index_type):
@@ -147,4 +251,4 @@ def get_default_alias(index_type):
     Returns:
         str: The default alias
     """
-    return get_aliases(index_type)[0]
+    return make_alias_name(index_type, is_reindexing=False)
@@ -0,0 +1,90 @@
+"""
+Tests for the Elasticsearch connection
+"""
+from elasticsearch import Urllib3HttpConnection
+from elasticsearch.exceptions import NotFoundError
+import pytest
+
+from search import connection
+from search.connection import (
+    clear_alias_cache,
+    get_aliases,
+    get_default_alias,
+    get_request_metrics,
+    make_alias_name,
+    MeteredConnection,
+    PERCOLATE_INDEX_TYPE,
+)
+
+# pylint: disable=redefined-outer-name,unused-argument
+
+
+@pytest.fixture
+def mocked_client(mocker, settings):
+    """Mocks the Elasticsearch client and enables the alias cache"""
+    settings.ELASTICSEARCH_ALIAS_CACHE_SECONDS = 60
+    conn = mocker.Mock()
+    mocker.patch('search.connection._get_client', return_value=(conn, False))
+    clear_alias_cache()
+    yield conn
+    clear_alias_cache()
+
+
+@pytest.fixture
+def clean_metrics(mocker):
+    """Start with empty request counters"""
+    mocker.patch.object(connection, '_REQUEST_COUNTS', connection.defaultdict(int))
+    mocker.patch.object(connection, '_REQUEST_SECONDS', connection.defaultdict(float))
+
+
+def test_get_aliases_cached(mocked_client):
+    """The default alias should be cached when there is no reindexing alias"""
+    mocked_client.indices.exists.return_value = False
+    expected = [make_alias_name(PERCOLATE_INDEX_TYPE, is_reindexing=False)]
+    assert get_aliases(PERCOLATE_INDEX_TYPE) == expected
+    assert get_aliases(PERCOLATE_INDEX_TYPE) == expected
+    assert mocked_client.indices.exists.call_count == 1
+
+    clear_alias_cache()
+    assert get_aliases(PERCOLATE_INDEX_TYPE) == expected
+    assert mocked_client.indices.exists.call_count == 2
+
+
+def test_get_aliases_reindexing_not_cached(mocked_client):
+    """The aliases should not be cached while a reindexing is in progress"""
+    mocked_client.indices.exists.return_value = True
+    expected = [
+        make_alias_name(PERCOLATE_INDEX_TYPE, is_reindexing=False),
+        make_alias_name(PERCOLATE_INDEX_TYPE, is_reindexing=True),
+    ]
+    assert get_aliases(PERCOLATE_INDEX_TYPE) == expected
+    assert get_aliases(PERCOLATE_INDEX_TYPE) == expected
+    assert mocked_client.indices.exists.call_count == 2
+
+
+def test_get_default_alias(mocked_client):
+    """The default alias doesn't need any request"""
+    assert get_default_alias(PERCOLATE_INDEX_TYPE) == make_alias_name(PERCOLATE_INDEX_TYPE, is_reindexing=False)
+    assert mocked_client.indices.exists.call_count == 0
+
+
+def test_request_metrics(mocker, clean_metrics):
+    """The requests and their duration should be counted by method and status"""
+    perform_request_mock = mocker.patch.object(
+        Urllib3HttpConnection, 'perform_request', return_value=(200, {}, '{}')
+    )
+    conn = MeteredConnection()
+    assert conn.perform_request('GET', '/_search') == (200, {}, '{}')
+    conn.perform_request('GET', '/_search')
+    perform_request_mock.side_effect = NotFoundError(404, 'not found', {})
+    with pytest.raises(NotFoundError):
+        conn.perform_request('HEAD', '/index')
+
+    samples = get_request_metrics()
+    assert [sample for sample in samples if sample[0] == 'elasticsearch_requests_total'] == [
+        ('elasticsearch_requests_total', {'method': 'GET', 'status': '200'}, 2),
+        ('elasticsearch_requests_total', {'method': 'HEAD', 'status': '404'}, 1),
+    ]
+    assert [
+        sample[1] for sample in samples if sample[0] == 'elasticsearch_request_duration_seconds_sum'
+    ] == [{'method': 'GET'}, {'method': 'HEAD'}]
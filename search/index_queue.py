@@ -0,0 +1,50 @@
+"""
+Debounced queue of the users whose program enrollment documents need to be indexed
+"""
+from django_redis import get_redis_connection
+
+from micromasters.utils import now_in_utc
+
+# sorted sets of the queued user ids, scored by the time they were first queued
+CACHE_KEY_INDEX_QUEUE_CHECK_IF_CHANGED = "search_index_queue_check_if_changed"
+CACHE_KEY_INDEX_QUEUE = "search_index_queue"
+
+
+def enqueue_users(user_ids, check_if_changed=False):
+    """
+    Adds users to the queue. Users who are already queued keep their place, so they are indexed
+    once the debounce window started by their first change is over.
+
+    Args:
+        user_ids (list of int): Ids of users to update in the Elasticsearch index
+        check_if_changed (bool): If true, only index the documents which would be different
+    """
+    if not user_ids:
+        return
+    key = CACHE_KEY_INDEX_QUEUE_CHECK_IF_CHANGED if check_if_changed else CACHE_KEY_INDEX_QUEUE
+    queued_on = now_in_utc().timestamp()
+    get_redis_connection("redis").zadd(key, {user_id: queued_on for user_id in user_ids}, nx=True)
+
+
+def pop_due_users(debounce_seconds):
+    """
+    Removes from the queue the users who have been queued for longer than the debounce window
+
+    Args:
+        debounce_seconds (int): How long users stay in the queue
+
+    Returns:
+        tuple: the sorted lists of ids of the users whose documents must be checked before indexing
+            and of the users whose documents must be indexed anyway
+    """
+    limit = now_in_utc().timestamp() - debounce_seconds
+    pipe = get_redis_connection("redis").pipeline()
+    for key in (CACHE_KEY_INDEX_QUEUE_CHECK_IF_CHANGED, CACHE_KEY_INDEX_QUEUE):
+        pipe.zrangebyscore(key, '-inf', limit)
+        pipe.zremrangebyscore(key, '-inf', limit)
+    users_to_check, _, users_to_index, _ = pipe.execute()
+
+    users_to_index = {int(user_id) for user_id in users_to_index}
+    # indexing a user anyway also takes care of any check
+    users_to_check = {int(user_id) for user_id in users_to_check} - users_to_index
+    return sorted(users_to_check), sorted(users_to_index)
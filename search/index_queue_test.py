@@ -0,0 +1,62 @@
+"""
+Tests for the debounced queue of users to index
+"""
+from datetime import timedelta
+
+from django_redis import get_redis_connection
+import pytest
+
+from micromasters.utils import now_in_utc
+from search import index_queue
+from search.index_queue import enqueue_users, pop_due_users
+
+# pylint: disable=redefined-outer-name,unused-argument
+
+TEST_CACHE_KEY_INDEX_QUEUE_CHECK_IF_CHANGED = "test_search_index_queue_check_if_changed"
+TEST_CACHE_KEY_INDEX_QUEUE = "test_search_index_queue"
+
+
+@pytest.fixture
+def patched_redis_keys(mocker):
+    """Patch the redis keys used by the queue"""
+    mocker.patch.object(
+        index_queue, "CACHE_KEY_INDEX_QUEUE_CHECK_IF_CHANGED", TEST_CACHE_KEY_INDEX_QUEUE_CHECK_IF_CHANGED
+    )
+    mocker.patch.object(index_queue, "CACHE_KEY_INDEX_QUEUE", TEST_CACHE_KEY_INDEX_QUEUE)
+    yield
+    get_redis_connection("redis").delete(TEST_CACHE_KEY_INDEX_QUEUE_CHECK_IF_CHANGED, TEST_CACHE_KEY_INDEX_QUEUE)
+
+
+def _mock_now(mocker, seconds_from_now):
+    """Mock the current time used by the queue"""
+    mocker.patch('search.index_queue.now_in_utc', return_value=now_in_utc() + timedelta(seconds=seconds_from_now))
+
+
+def test_pop_due_users(mocker, patched_redis_keys):
+    """Users should only be popped once their debounce window is over"""
+    _mock_now(mocker, -100)
+    enqueue_users([1, 2, 5], check_if_changed=True)
+    enqueue_users([5])
+    _mock_now(mocker, -30)
+    enqueue_users([3], check_if_changed=True)
+    enqueue_users([4])
+    _mock_now(mocker, 0)
+    # user 5 is indexed anyway, so there's nothing to check
+    assert pop_due_users(60) == ([1, 2], [5])
+    assert pop_due_users(60) == ([], [])
+    assert pop_due_users(10) == ([3], [4])
+
+
+def test_enqueue_users_coalesces(mocker, patched_redis_keys):
+    """Queueing a user several times should not postpone the indexing and should index the user once"""
+    _mock_now(mocker, -100)
+    enqueue_users([1], check_if_changed=True)
+    enqueue_users([2])
+    _mock_now(mocker, -10)
+    enqueue_users([1, 2], check_if_changed=True)
+    enqueue_users([1, 2])
+    _mock_now(mocker, 0)
+    # the users queued again are not postponed
+    assert pop_due_users(60) == ([1], [2])
+    assert pop_due_users(0) == ([2], [1])
+    assert pop_due_users(0) == ([], [])
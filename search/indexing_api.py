@@ -1,28 +1,41 @@
 """
 Functions for ES indexing
 """
+from concurrent.futures import ProcessPoolExecutor
+import json
 import logging
+import time
 
 from django.conf import settings
-from elasticsearch.helpers import bulk
+from django.db import connections
+from django.db.models import Count, Max, Min
+from django_redis import get_redis_connection
+from elasticsearch.helpers import bulk, parallel_bulk, streaming_bulk
 from elasticsearch.exceptions import NotFoundError
 
+from courses.models import Course
+from profiles.api import get_social_usernames
 from profiles.models import Profile
 from profiles.serializers import ProfileSerializer
 from dashboard.models import ProgramEnrollment
 from dashboard.serializers import UserProgramSearchSerializer
+from dashboard.utils import MMTrackBatch
+from roles.models import Role
 from micromasters.utils import (
     chunks,
     dict_with_keys,
+    generate_md5,
     now_in_utc,
 )
 from search.connection import (
     ALL_INDEX_TYPES,
+    clear_alias_cache,
     get_aliases,
     get_default_alias,
     get_conn,
     make_alias_name,
     make_backing_index_name,
+    reset_conn,
     GLOBAL_DOC_TYPE,
     PERCOLATE_INDEX_TYPE,
     PRIVATE_ENROLLMENT_INDEX_TYPE,
@@ -30,10 +43,7 @@ from search.connection import (
 )
 from search.exceptions import ReindexException
 from search.models import PercolateQuery
-from search.util import (
-    fix_nested_filter,
-    open_json_stream,
-)
+from search.util import fix_nested_filter
 
 log = logging.getLogger(__name__)
 
@@ -233,6 +243,22 @@ PERCOLATE_MAPPING = {
 
 INDEX_WILDCARD = '{index_name}_*'.format(index_name=settings.ELASTICSEARCH_INDEX)
 
+# hash of the backing indexes of the current recreate_index run, by index type
+CACHE_KEY_REINDEX_BACKING_INDEXES = 'recreate_index_backing_indexes'
+# hash of the last program enrollment id indexed by the current recreate_index run, by partition
+CACHE_KEY_REINDEX_PARTITIONS = 'recreate_index_partitions'
+REINDEX_PARTITION_DONE = 'done'
+# number of program enrollment ids in each partition of recreate_index
+REINDEX_PARTITION_SIZE = 10000
+# number of program enrollments serialized and sent to Elasticsearch at once by recreate_index
+REINDEX_CHUNK_SIZE = 500
+# number of program enrollments whose documents are built together by serialize_program_enrolled_users
+SERIALIZE_CHUNK_SIZE = 500
+# hash of the fingerprints of the last private documents sent to Elasticsearch, by program enrollment id
+CACHE_KEY_DOCUMENT_FINGERPRINTS = 'search_document_fingerprints'
+# number of concurrent bulk requests sent by index_program_enrolled_users
+INDEXING_THREAD_COUNT = 4
+
 
 def _index_chunk(chunk, *, index):
     """
@@ -259,11 +285,10 @@ def _index_chunk(chunk, *, index):
             errors=errors
         ))
 
-    refresh_index(index)
     return insert_count
 
 
-def _index_chunks(items, *, index, chunk_size=100):
+def _index_chunks(items, *, index, chunk_size=100, bulk_mode=False):
     """
     Add/update records in Elasticsearch.
 
@@ -273,10 +298,16 @@ def _index_chunks(items, *, index, chunk_size=100):
         index (str): An Elasticsearch index
         chunk_size (int):
             How many items to index at once.
+        bulk_mode (bool):
+            If true, stream the items without refreshing the index. The caller is responsible
+            for refreshing the index once everything has been indexed.
 
     Returns:
         int: Number of indexed items
     """
+    if bulk_mode:
+        return _stream_items(items, index=index, chunk_size=chunk_size)
+
     # Use an iterator so we can keep track of what's been indexed already
     log.info("Indexing chunk pairs, chunk_size=%d...", chunk_size)
     count = 0
@@ -289,6 +320,113 @@ def _index_chunks(items, *, index, chunk_size=100):
     return count
 
 
+def _stream_items(items, *, index, chunk_size):
+    """
+    Add/update records in Elasticsearch with streaming bulk requests, without refreshing the index
+
+    Args:
+        items (iterable):
+            Iterable of serialized items to index
+        index (str): An Elasticsearch index
+        chunk_size (int):
+            How many items to send in each bulk request
+
+    Returns:
+        int: Number of indexed items
+    """
+    conn = get_conn(verify_indices=[index])
+    count = 0
+    errors = []
+    for ok, result in streaming_bulk(
+            conn,
+            items,
+            index=index,
+            doc_type=GLOBAL_DOC_TYPE,
+            chunk_size=chunk_size,
+            raise_on_error=False,
+    ):
+        if ok:
+            count += 1
+        else:
+            errors.append(result)
+    if len(errors) > 0:
+        raise ReindexException("Error during bulk insert: {errors}".format(
+            errors=errors
+        ))
+    return count
+
+
+def _index_actions(actions, *, indices, chunk_size=100):
+    """
+    Add/update records in several Elasticsearch indices at once with concurrent bulk requests,
+    without refreshing the indices
+
+    Args:
+        actions (list of dict):
+            List of serialized items, each one with the '_index' where it must be stored.
+            This is not a generator because it would be consumed by another thread.
+        indices (list of str): All the Elasticsearch indices targeted by the actions
+        chunk_size (int):
+            How many items to send in each bulk request
+
+    Returns:
+        int: Number of indexed items
+    """
+    conn = get_conn(verify_indices=indices)
+    count = 0
+    errors = []
+    for ok, result in parallel_bulk(
+            conn,
+            actions,
+            doc_type=GLOBAL_DOC_TYPE,
+            chunk_size=chunk_size,
+            thread_count=INDEXING_THREAD_COUNT,
+            raise_on_error=False,
+    ):
+        if ok:
+            count += 1
+        else:
+            errors.append(result)
+    if len(errors) > 0:
+        raise ReindexException("Error during bulk insert: {errors}".format(
+            errors=errors
+        ))
+    return count
+
+
+def start_bulk_indexing(index):
+    """
+    Disable the periodic refresh and the replicas of an index which is about to receive lots of documents
+    and which is not searched yet
+
+    Args:
+        index (str): An Elasticsearch index
+    """
+    get_conn(verify_indices=[index]).indices.put_settings(index=index, body={
+        'index': {
+            'refresh_interval': '-1',
+            'number_of_replicas': 0,
+        }
+    })
+
+
+def finish_bulk_indexing(index):
+    """
+    Restore the default refresh interval and replicas of an index changed by start_bulk_indexing
+    and refresh it once
+
+    Args:
+        index (str): An Elasticsearch index
+    """
+    get_conn(verify_indices=[index]).indices.put_settings(index=index, body={
+        'index': {
+            'refresh_interval': None,
+            'number_of_replicas': None,
+        }
+    })
+    refresh_index(index)
+
+
 def _delete_item(document_id, *, index):
     """
     Helper function to delete a document
@@ -355,18 +493,28 @@ def serialize_public_enrolled_user(serialized_enrolled_user):
     }
 
 
-def _get_public_documents(private_documents):
+def _get_enrollment_actions(private_documents, *, public_indices, private_indices, fingerprints):
     """
-    Generator for private documents to be indexed given a set of program enrollments
+    Generator for the bulk actions storing the documents of program enrollments in all the indices
+
     Args:
         private_documents (iterable of dict):
-            iterable of private documents to generate public documents for
+            iterable of private documents to index, along with their public version
+        public_indices (list of str): The indices to store public enrollment documents
+        private_indices (list of str): The indices to store private enrollment documents
+        fingerprints (dict): Filled with the fingerprints of the private documents, by program enrollment id
     Yields:
-        for each enrollment:
-            a public (learner-learner search) document
+        for each enrollment and index:
+            a public (learner-learner search) or private (staff-only search) document with its '_index'
     """
     for document in private_documents:
-        yield serialize_public_enrolled_user(document)
+        fingerprints[document['id']] = make_document_fingerprint(document)
+        if public_indices:
+            public_document = serialize_public_enrolled_user(document)
+            for index in public_indices:
+                yield {**public_document, '_index': index}
+        for index in private_indices:
+            yield {**document, '_index': index}
 
 
 def _get_private_documents(program_enrollments):
@@ -378,13 +526,11 @@ def _get_private_documents(program_enrollments):
     Yields:
         for each enrollment:
             a private (staff-only search) document
-            a public (learner-learner search) document
     """
-    for program_enrollment in program_enrollments:
-        document = serialize_program_enrolled_user(program_enrollment)
-        if document is None:
-            continue
-        yield document
+    for program_enrollments_chunk in chunks(program_enrollments, chunk_size=SERIALIZE_CHUNK_SIZE):
+        yield from serialize_program_enrolled_users(
+            [program_enrollment.id for program_enrollment in program_enrollments_chunk]
+        )
 
 
 def _get_percolate_documents(percolate_queries):
@@ -403,16 +549,19 @@ def _get_percolate_documents(percolate_queries):
 
 def index_program_enrolled_users(
         program_enrollments, *,
-        public_indices=None, private_indices=None, chunk_size=100
+        public_indices=None, private_indices=None, chunk_size=100, bulk_mode=False
 ):
     """
-    Bulk index an iterable of ProgramEnrollments
+    Bulk index an iterable of ProgramEnrollments.
+    The fingerprints of the documents are only stored if they were sent to the default private alias,
+    since get_enrollments_needing_update compares them with the documents served from it.
 
     Args:
         program_enrollments (iterable of ProgramEnrollment): An iterable of program enrollments
         public_indices (list of str): The indices to store public enrollment documents
         private_indices (list of str): The indices to store private enrollment documents
         chunk_size (int): The number of items per chunk to index
+        bulk_mode (bool): If true, don't refresh the indices, see _index_chunks
     """
     if public_indices is None:
         public_indices = get_aliases(PUBLIC_ENROLLMENT_INDEX_TYPE)
@@ -420,25 +569,27 @@ def index_program_enrolled_users(
     if private_indices is None:
         private_indices = get_aliases(PRIVATE_ENROLLMENT_INDEX_TYPE)
 
-    # Serialize to a temporary file so we don't serialize twice (serializing is expensive)
-    with open_json_stream() as json_stream:
-        json_stream.write_stream(
-            (document for document in _get_private_documents(program_enrollments))
-        )
-
-        for index in public_indices:
-            _index_chunks(
-                _get_public_documents(json_stream.read_stream()),
-                index=index,
-                chunk_size=chunk_size,
-            )
+    indices = list(public_indices) + list(private_indices)
+    if not indices:
+        return
+
+    # Each enrollment is serialized once and its documents are sent to all the indices in the same pass.
+    # The documents are serialized in this thread, then the bulk requests of each chunk are sent concurrently
+    fingerprints = {}
+    actions = _get_enrollment_actions(
+        _get_private_documents(program_enrollments),
+        public_indices=public_indices,
+        private_indices=private_indices,
+        fingerprints=fingerprints,
+    )
+    for actions_chunk in chunks(actions, chunk_size=SERIALIZE_CHUNK_SIZE * len(indices)):
+        _index_actions(actions_chunk, indices=indices, chunk_size=chunk_size * len(indices))
 
-        for index in private_indices:
-            _index_chunks(
-                json_stream.read_stream(),
-                index=index,
-                chunk_size=chunk_size,
-            )
+    if not bulk_mode:
+        for index in indices:
+            refresh_index(index)
+    if get_default_alias(PRIVATE_ENROLLMENT_INDEX_TYPE) in private_indices:
+        _store_document_fingerprints(fingerprints)
 
 
 def remove_program_enrolled_user(program_enrollment_id):
@@ -456,13 +607,81 @@ def remove_program_enrolled_user(program_enrollment_id):
     for index in private_indices:
         _delete_item(program_enrollment_id, index=index)
 
+    get_redis_connection("redis").hdel(CACHE_KEY_DOCUMENT_FINGERPRINTS, program_enrollment_id)
+
 
-def serialize_program_enrolled_user(program_enrollment):
+def make_document_fingerprint(document):
+    """
+    Computes a fingerprint of a private program-enrolled user document, which changes with its content
+
+    Args:
+        document (dict): A document built by serialize_program_enrolled_user
+
+    Returns:
+        str: The fingerprint of the document
+    """
+    return generate_md5(json.dumps(document, sort_keys=True).encode('utf-8'))
+
+
+def save_document_fingerprints(documents):
+    """
+    Stores the fingerprints of private program-enrolled user documents which have been indexed
+
+    Args:
+        documents (iterable of dict): Documents built by serialize_program_enrolled_user
+    """
+    _store_document_fingerprints({
+        document['id']: make_document_fingerprint(document) for document in documents
+    })
+
+
+def _store_document_fingerprints(fingerprints):
+    """
+    Stores fingerprints of private program-enrolled user documents
+
+    Args:
+        fingerprints (dict): A map of program enrollment ids to fingerprints
+    """
+    con = get_redis_connection("redis")
+    for enrollment_ids_chunk in chunks(fingerprints, chunk_size=1000):
+        con.hmset(CACHE_KEY_DOCUMENT_FINGERPRINTS, {
+            enrollment_id: fingerprints[enrollment_id] for enrollment_id in enrollment_ids_chunk
+        })
+
+
+def get_document_fingerprints(program_enrollment_ids):
+    """
+    Returns the fingerprints of the last private documents indexed for some program enrollments
+
+    Args:
+        program_enrollment_ids (list of int): The program enrollment ids
+
+    Returns:
+        dict: A map of program enrollment ids to fingerprints, enrollments without any are omitted
+    """
+    con = get_redis_connection("redis")
+    fingerprints = {}
+    for ids_chunk in chunks(program_enrollment_ids, chunk_size=1000):
+        for program_enrollment_id, fingerprint in zip(
+                ids_chunk, con.hmget(CACHE_KEY_DOCUMENT_FINGERPRINTS, ids_chunk)
+        ):
+            if fingerprint is not None:
+                fingerprints[program_enrollment_id] = fingerprint.decode('utf-8')
+    return fingerprints
+
+
+def serialize_program_enrolled_user(
+        program_enrollment, *, mmtrack=None, learner=None, total_courses=None, social_usernames=None
+):
     """
     Serializes a program-enrolled user for use with Elasticsearch.
 
     Args:
         program_enrollment (ProgramEnrollment): A program_enrollment to serialize
+        mmtrack (MMTrack): optional MMTrack of the user in the program, i.e. one built by a MMTrackBatch
+        learner (bool): optional precomputed result of is_learner for the user in the program
+        total_courses (int): optional precomputed number of courses in the program
+        social_usernames (dict): optional map of user ids to edX usernames, see get_social_usernames
     Returns:
         dict: The data to be sent to Elasticsearch or None if it shouldn't be indexed
     """
@@ -473,16 +692,79 @@ def serialize_program_enrolled_user(program_enrollment):
         'user_id': user.id,
         'email': user.email,
     }
+    context = {'social_usernames': social_usernames} if social_usernames is not None else {}
     try:
-        serialized['profile'] = filter_current_work(ProfileSerializer(user.profile).data)
+        serialized['profile'] = filter_current_work(ProfileSerializer(user.profile, context=context).data)
     except Profile.DoesNotExist:
         log.exception('User %s has no profile', user.username)
         return None
 
-    serialized['program'] = UserProgramSearchSerializer.serialize(program_enrollment)
+    serialized['program'] = UserProgramSearchSerializer.serialize(
+        program_enrollment, mmtrack=mmtrack, learner=learner, total_courses=total_courses
+    )
     return serialized
 
 
+def serialize_program_enrolled_users(program_enrollment_ids):
+    """
+    Serializes many program-enrolled users for use with Elasticsearch.
+
+    The profiles, the edX and grades data, the roles and the course runs are loaded with a fixed
+    number of set-based queries for each program, instead of several queries for each enrollment.
+    The documents are the same as the ones built by serialize_program_enrolled_user.
+
+    Args:
+        program_enrollment_ids (list of int): The ids of the program enrollments to serialize
+    Returns:
+        list of dict: The data to be sent to Elasticsearch, in the order of the ids.
+            Enrollments which shouldn't be indexed are skipped.
+    """
+    program_enrollments = {
+        program_enrollment.id: program_enrollment for program_enrollment in
+        ProgramEnrollment.prefetched_qset().filter(id__in=program_enrollment_ids).prefetch_related(
+            'user__profile__education', 'user__profile__work_history'
+        )
+    }
+    if not program_enrollments:
+        return []
+    user_ids = {program_enrollment.user_id for program_enrollment in program_enrollments.values()}
+    program_ids = {program_enrollment.program_id for program_enrollment in program_enrollments.values()}
+
+    social_usernames = get_social_usernames(user_ids)
+    non_learners = set(Role.objects.filter(
+        user_id__in=user_ids, program_id__in=program_ids, role__in=Role.NON_LEARNERS
+    ).values_list('user_id', 'program_id'))
+    total_courses = dict(
+        Course.objects.filter(program_id__in=program_ids).order_by().values('program_id').annotate(
+            count=Count('id')
+        ).values_list('program_id', 'count')
+    )
+    users_by_program = {}
+    for program_enrollment in program_enrollments.values():
+        program = program_enrollment.program
+        users_by_program.setdefault(program.id, (program, []))[1].append(program_enrollment.user)
+    mmtrack_batches = {
+        program_id: MMTrackBatch(program, users) for program_id, (program, users) in users_by_program.items()
+    }
+
+    documents = []
+    for program_enrollment_id in program_enrollment_ids:
+        program_enrollment = program_enrollments.get(program_enrollment_id)
+        if program_enrollment is None:
+            continue
+        user_id, program_id = program_enrollment.user_id, program_enrollment.program_id
+        document = serialize_program_enrolled_user(
+            program_enrollment,
+            mmtrack=mmtrack_batches[program_id].get_mmtrack(program_enrollment.user),
+            learner=(user_id, program_id) not in non_learners,
+            total_courses=total_courses.get(program_id, 0),
+            social_usernames=social_usernames,
+        )
+        if document is not None:
+            documents.append(document)
+    return documents
+
+
 def filter_current_work(profile):
     """
     Remove work_history objects that are not current
@@ -569,56 +851,299 @@ def delete_indices():
         for alias in aliases:
             if conn.indices.exists(alias):
                 conn.indices.delete_alias(index=INDEX_WILDCARD, name=alias)
+    clear_alias_cache()
+    get_redis_connection("redis").delete(CACHE_KEY_DOCUMENT_FINGERPRINTS)
+
+
+def _make_partition_key(start, end):
+    """
+    Make the key used to checkpoint the progress of a partition
+
+    Args:
+        start (int): The first program enrollment id of the partition
+        end (int): The program enrollment id right after the partition
+
+    Returns:
+        str: The key of the partition
+    """
+    return '{}:{}'.format(start, end)
+
+
+def _parse_partition_key(key):
+    """
+    Parse a key created by _make_partition_key
+
+    Args:
+        key (bytes or str): The key of the partition
+
+    Returns:
+        tuple of int: The start and the end of the partition
+    """
+    if isinstance(key, bytes):
+        key = key.decode()
+    start, end = key.split(':')
+    return int(start), int(end)
+
+
+def _make_enrollment_partitions(partition_size):
+    """
+    Split the program enrollments in ranges of ids
+
+    Args:
+        partition_size (int): The number of ids in each range
+
+    Returns:
+        list of tuple: The start and end of each partition, the end being excluded
+    """
+    bounds = ProgramEnrollment.objects.aggregate(min_id=Min('id'), max_id=Max('id'))
+    if bounds['min_id'] is None:
+        return []
+    return [
+        (start, min(start + partition_size, bounds['max_id'] + 1))
+        for start in range(bounds['min_id'], bounds['max_id'] + 1, partition_size)
+    ]
+
+
+def index_enrollment_partition(start, end, *, public_index, private_index, chunk_size=REINDEX_CHUNK_SIZE):
+    """
+    Index the program enrollments of a partition of recreate_index, resuming after the last checkpoint.
+    The progress is checkpointed in redis after every chunk.
+
+    Args:
+        start (int): The first program enrollment id of the partition
+        end (int): The program enrollment id right after the partition
+        public_index (str): The index to store public enrollment documents
+        private_index (str): The index to store private enrollment documents
+        chunk_size (int): The number of program enrollments to index at once
+
+    Returns:
+        int: The number of program enrollments indexed
+    """
+    con = get_redis_connection("redis")
+    partition_key = _make_partition_key(start, end)
+    checkpoint = con.hget(CACHE_KEY_REINDEX_PARTITIONS, partition_key)
+    if checkpoint == REINDEX_PARTITION_DONE.encode():
+        return 0
+    last_id = int(checkpoint) if checkpoint is not None else start - 1
+
+    count = 0
+    while True:
+        program_enrollments = list(
+            ProgramEnrollment.prefetched_qset().filter(id__gt=last_id, id__lt=end).order_by('id')[:chunk_size]
+        )
+        if not program_enrollments:
+            break
+        index_program_enrolled_users(
+            program_enrollments,
+            public_indices=[public_index],
+            private_indices=[private_index],
+            chunk_size=chunk_size,
+            bulk_mode=True,
+        )
+        last_id = program_enrollments[-1].id
+        con.hset(CACHE_KEY_REINDEX_PARTITIONS, partition_key, last_id)
+        count += len(program_enrollments)
+    con.hset(CACHE_KEY_REINDEX_PARTITIONS, partition_key, REINDEX_PARTITION_DONE)
+    return count
+
+
+def _init_reindex_worker():
+    """
+    Make sure a worker process of recreate_index doesn't reuse the connections of the parent process
+    """
+    connections.close_all()
+    reset_conn()
+
+
+def _index_enrollment_partitions(partitions, *, public_index, private_index, workers, chunk_size):
+    """
+    Index the program enrollments of all partitions, in parallel if there is more than one worker
+
+    Args:
+        partitions (list of tuple): The start and end of each partition
+        public_index (str): The index to store public enrollment documents
+        private_index (str): The index to store private enrollment documents
+        workers (int): The number of processes indexing the partitions
+        chunk_size (int): The number of program enrollments to index at once
+
+    Returns:
+        list of Exception: The errors of the partitions which failed
+    """
+    errors = []
+    if workers > 1:
+        # the forked processes must open their own database connections
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_reindex_worker) as executor:
+            futures = {
+                executor.submit(
+                    index_enrollment_partition, start, end,
+                    public_index=public_index, private_index=private_index, chunk_size=chunk_size,
+                ): (start, end)
+                for start, end in partitions
+            }
+            for future, (start, end) in futures.items():
+                try:
+                    log.info("Indexed %d program enrollments of partition %d-%d", future.result(), start, end)
+                except Exception as ex:  # pylint: disable=broad-except
+                    log.exception("Unable to index the program enrollments of partition %d-%d", start, end)
+                    errors.append(ex)
+    else:
+        for start, end in partitions:
+            try:
+                count = index_enrollment_partition(
+                    start, end, public_index=public_index, private_index=private_index, chunk_size=chunk_size,
+                )
+                log.info("Indexed %d program enrollments of partition %d-%d", count, start, end)
+            except Exception as ex:  # pylint: disable=broad-except
+                log.exception("Unable to index the program enrollments of partition %d-%d", start, end)
+                errors.append(ex)
+    return errors
+
+
+def _get_resumable_backing_indexes(conn):
+    """
+    Get the backing indexes of an interrupted recreate_index run, if they can still be used
+
+    Args:
+        conn (elasticsearch.client.Elasticsearch): An Elasticsearch client
+
+    Returns:
+        dict: A map of index types to backing indexes, or None if there is nothing to resume
+    """
+    con = get_redis_connection("redis")
+    backing_indexes = {
+        index_type.decode(): backing_index.decode()
+        for index_type, backing_index in con.hgetall(CACHE_KEY_REINDEX_BACKING_INDEXES).items()
+    }
+    if sorted(backing_indexes) != sorted(ALL_INDEX_TYPES):
+        return None
+    for index_type, backing_index in backing_indexes.items():
+        temp_alias = make_alias_name(index_type, is_reindexing=True)
+        if not conn.indices.exists_alias(name=temp_alias, index=backing_index):
+            return None
+    return backing_indexes
+
+
+def _clear_reindex_checkpoints(conn):
+    """
+    Forget the checkpoints of an interrupted recreate_index run and delete its backing indexes
+
+    Args:
+        conn (elasticsearch.client.Elasticsearch): An Elasticsearch client
+    """
+    con = get_redis_connection("redis")
+    for backing_index in con.hvals(CACHE_KEY_REINDEX_BACKING_INDEXES):
+        backing_index = backing_index.decode()
+        if conn.indices.exists(backing_index) and not conn.indices.exists_alias(
+                name=[make_alias_name(index_type, is_reindexing=False) for index_type in ALL_INDEX_TYPES],
+                index=backing_index,
+        ):
+            conn.indices.delete(backing_index)
+    con.delete(CACHE_KEY_REINDEX_BACKING_INDEXES, CACHE_KEY_REINDEX_PARTITIONS)
 
 
 # pylint: disable=too-many-locals
-def recreate_index():
+def recreate_index(*, workers=1, resume=False, partition_size=REINDEX_PARTITION_SIZE, chunk_size=REINDEX_CHUNK_SIZE):
     """
     Wipe and recreate index and mapping, and index all items.
+
+    The program enrollments are split in partitions of ids, indexed by a pool of processes.
+    The progress of each partition is checkpointed in redis: if some partition fails the default aliases
+    are left untouched and a later run with resume=True continues where the previous one stopped.
+    While the new backing indexes are filled their refresh and replicas are disabled, and they are
+    restored and refreshed once right before the default aliases are switched.
+    The document fingerprints are forgotten once the default aliases may have been switched, since they
+    describe the documents of the old backing indexes.
+
+    Args:
+        workers (int): The number of processes indexing the program enrollments
+        resume (bool): If true, continue an interrupted run instead of starting from scratch
+        partition_size (int): The number of program enrollment ids in each partition
+        chunk_size (int): The number of documents sent to Elasticsearch in each bulk request
     """
     conn = get_conn(verify=False)
+    con = get_redis_connection("redis")
 
-    # Create new backing index for reindex
-    new_backing_public_index = make_backing_index_name()
-    new_backing_private_index = make_backing_index_name()
-    new_backing_percolate_index = make_backing_index_name()
-    backing_index_tuples = [
-        (new_backing_public_index, PUBLIC_ENROLLMENT_INDEX_TYPE),
-        (new_backing_private_index, PRIVATE_ENROLLMENT_INDEX_TYPE),
-        (new_backing_percolate_index, PERCOLATE_INDEX_TYPE),
-    ]
-    for backing_index, index_type in backing_index_tuples:
-        # Clear away temp alias so we can reuse it, and create mappings
-        clear_and_create_index(backing_index, index_type=index_type)
-        temp_alias = make_alias_name(index_type, is_reindexing=True)
-        if conn.indices.exists_alias(name=temp_alias):
-            # Deletes both alias and backing indexes
-            conn.indices.delete_alias(index=INDEX_WILDCARD, name=temp_alias)
+    backing_indexes = _get_resumable_backing_indexes(conn) if resume else None
+    if backing_indexes is not None:
+        log.info("Resuming the interrupted reindexing...")
+        backing_index_tuples = [
+            (backing_indexes[index_type], index_type) for index_type in ALL_INDEX_TYPES
+        ]
+        partitions = sorted(
+            _parse_partition_key(key) for key in con.hkeys(CACHE_KEY_REINDEX_PARTITIONS)
+        )
+    else:
+        if resume:
+            log.info("There is no reindexing to resume, starting from scratch...")
+        _clear_reindex_checkpoints(conn)
 
-        # Point temp_alias toward new backing index
-        conn.indices.put_alias(index=backing_index, name=temp_alias)
+        # Create new backing index for reindex
+        backing_index_tuples = [
+            (make_backing_index_name(), index_type) for index_type in ALL_INDEX_TYPES
+        ]
+        for backing_index, index_type in backing_index_tuples:
+            # Clear away temp alias so we can reuse it, and create mappings
+            clear_and_create_index(backing_index, index_type=index_type)
+            temp_alias = make_alias_name(index_type, is_reindexing=True)
+            if conn.indices.exists_alias(name=temp_alias):
+                # Deletes both alias and backing indexes
+                conn.indices.delete_alias(index=INDEX_WILDCARD, name=temp_alias)
+
+            # Point temp_alias toward new backing index
+            conn.indices.put_alias(index=backing_index, name=temp_alias)
+            start_bulk_indexing(backing_index)
+
+        # Other processes may still use cached aliases without the temp aliases,
+        # wait for them to expire so that their updates reach the new backing indexes too
+        clear_alias_cache()
+        time.sleep(settings.ELASTICSEARCH_ALIAS_CACHE_SECONDS)
+
+        partitions = _make_enrollment_partitions(partition_size)
+        con.hmset(CACHE_KEY_REINDEX_BACKING_INDEXES, {
+            index_type: backing_index for backing_index, index_type in backing_index_tuples
+        })
+        if partitions:
+            con.hmset(CACHE_KEY_REINDEX_PARTITIONS, {
+                _make_partition_key(start, end): start - 1 for start, end in partitions
+            })
+    new_backing_indexes = {index_type: backing_index for backing_index, index_type in backing_index_tuples}
 
     # Do the indexing on the temp index
     start = now_in_utc()
-    try:
-        enrollment_count = ProgramEnrollment.objects.count()
-        log.info("Indexing %d program enrollments...", enrollment_count)
-        index_program_enrolled_users(
-            ProgramEnrollment.objects.iterator(),
-            public_indices=[new_backing_public_index],
-            private_indices=[new_backing_private_index],
-        )
+    enrollment_count = ProgramEnrollment.objects.count()
+    log.info(
+        "Indexing %d program enrollments in %d partitions with %d workers...",
+        enrollment_count, len(partitions), workers
+    )
+    errors = _index_enrollment_partitions(
+        partitions,
+        public_index=new_backing_indexes[PUBLIC_ENROLLMENT_INDEX_TYPE],
+        private_index=new_backing_indexes[PRIVATE_ENROLLMENT_INDEX_TYPE],
+        workers=workers,
+        chunk_size=chunk_size,
+    )
+    if errors:
+        # the temp aliases are kept, so the backing indexes are kept up to date until the run is resumed
+        raise ReindexException(
+            "Unable to index {count} of {total} partitions, run recreate_index again with resume "
+            "to index them".format(count=len(errors), total=len(partitions))
+        ) from errors[0]
 
+    try:
         log.info("Indexing %d percolator queries...", PercolateQuery.objects.exclude(is_deleted=True).count())
         _index_chunks(
             _get_percolate_documents(PercolateQuery.objects.exclude(is_deleted=True).iterator()),
-            index=new_backing_percolate_index,
+            index=new_backing_indexes[PERCOLATE_INDEX_TYPE],
+            chunk_size=chunk_size,
+            bulk_mode=True,
         )
 
         # Point default alias to new index and delete the old backing index, if any
         log.info("Done with temporary index. Pointing default aliases to newly created backing indexes...")
 
         for new_backing_index, index_type in backing_index_tuples:
+            finish_bulk_indexing(new_backing_index)
             actions = []
             old_backing_indexes = []
             default_alias = make_alias_name(index_type, is_reindexing=False)
@@ -642,13 +1167,14 @@ def recreate_index():
                 "actions": actions
             })
 
-            refresh_index(new_backing_index)
             for index in old_backing_indexes:
                 conn.indices.delete(index)
     finally:
         for new_backing_index, index_type in backing_index_tuples:
             temp_alias = make_alias_name(index_type, is_reindexing=True)
             conn.indices.delete_alias(name=temp_alias, index=new_backing_index)
+        clear_alias_cache()
+        con.delete(CACHE_KEY_REINDEX_BACKING_INDEXES, CACHE_KEY_REINDEX_PARTITIONS, CACHE_KEY_DOCUMENT_FINGERPRINTS)
     end = now_in_utc()
     log.info("recreate_index took %d seconds", (end - start).total_seconds())
 
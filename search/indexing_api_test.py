@@ -2,7 +2,8 @@
 Tests for search API functions.
 """
 import itertools
-from unittest.mock import patch
+import json
+from unittest.mock import ANY, patch
 
 from ddt import (
     data,
@@ -10,7 +11,9 @@ from ddt import (
     unpack,
 )
 from django.conf import settings
+from django.db import connection
 from django.db.models.signals import post_save
+from django.test.utils import CaptureQueriesContext
 from elasticsearch.exceptions import NotFoundError
 from factory.django import mute_signals
 
@@ -27,10 +30,12 @@ from courses.factories import (
     CourseFactory,
     CourseRunFactory,
 )
+from grades.factories import FinalGradeFactory
 from profiles.factories import (
     EducationFactory,
     EmploymentFactory,
     ProfileFactory,
+    SocialProfileFactory,
 )
 from profiles.serializers import (
     ProfileSerializer
@@ -58,11 +63,13 @@ from search.indexing_api import (
     clear_and_create_index,
     delete_indices,
     get_conn,
+    get_document_fingerprints,
     recreate_index,
     refresh_index,
     index_program_enrolled_users,
     remove_program_enrolled_user,
     serialize_program_enrolled_user,
+    serialize_program_enrolled_users,
     serialize_public_enrolled_user,
     filter_current_work,
     index_percolate_queries,
@@ -311,36 +318,65 @@ class IndexTests(ESTestCase):
         public = [serialize_public_enrolled_user(serialized) for serialized in private]
         public_dicts = {serialized['id']: serialized for serialized in public}
 
+        public_index = make_alias_name(PUBLIC_ENROLLMENT_INDEX_TYPE, is_reindexing=False)
+        private_index = make_alias_name(PRIVATE_ENROLLMENT_INDEX_TYPE, is_reindexing=False)
         with patch(
-            'search.indexing_api._index_chunk', autospec=True, return_value=0
-        ) as index_chunk, patch(
-            'search.indexing_api.serialize_program_enrolled_user', autospec=True,
-            side_effect=lambda x: private_dicts[x.id]
+            'search.indexing_api._index_actions', autospec=True, return_value=0
+        ) as index_actions, patch(
+            'search.indexing_api.serialize_program_enrolled_users', autospec=True,
+            side_effect=lambda ids: [private_dicts[enrollment_id] for enrollment_id in ids]
         ) as serialize_mock, patch(
             'search.indexing_api.serialize_public_enrolled_user', autospec=True,
             side_effect=lambda x: public_dicts[x['id']]
-        ) as serialize_public_mock:
+        ) as serialize_public_mock, patch(
+            'search.indexing_api.SERIALIZE_CHUNK_SIZE', chunk_size
+        ), patch(
+            'search.indexing_api.refresh_index', autospec=True
+        ) as refresh_index_mock:
             index_program_enrolled_users(program_enrollments, chunk_size=chunk_size)
-            assert index_chunk.call_count == 6  # 10 enrollments divided in chunks of 4, times the number of types (2)
+            assert index_actions.call_count == 3  # 10 enrollments divided in chunks of 4
 
-            public_index = make_alias_name(PUBLIC_ENROLLMENT_INDEX_TYPE, is_reindexing=False)
-            private_index = make_alias_name(PRIVATE_ENROLLMENT_INDEX_TYPE, is_reindexing=False)
             for offset in range(0, num_enrollments, chunk_size):
                 # each enrollment should get yielded twice to account for each doctype
-                index_chunk.assert_any_call(
-                    public[offset:offset+4],  # ordered dicts FTW
-                    index=public_index
+                actions = []
+                for public_document, private_document in zip(
+                        public[offset:offset+chunk_size], private[offset:offset+chunk_size]
+                ):
+                    actions.append({**public_document, '_index': public_index})
+                    actions.append({**private_document, '_index': private_index})
+                index_actions.assert_any_call(
+                    actions, indices=[public_index, private_index], chunk_size=chunk_size * 2
                 )
-                index_chunk.assert_any_call(
-                    private[offset:offset+4],
-                    index=private_index
+                serialize_mock.assert_any_call(
+                    [enrollment.id for enrollment in program_enrollments[offset:offset+chunk_size]]
                 )
 
-            assert serialize_mock.call_count == len(program_enrollments)
+            assert serialize_mock.call_count == 3
             assert serialize_public_mock.call_count == len(program_enrollments)
             for enrollment in program_enrollments:
-                serialize_mock.assert_any_call(enrollment)
                 serialize_public_mock.assert_any_call(private_dicts[enrollment.id])
+            assert refresh_index_mock.call_count == 2
+
+    def test_index_program_enrolled_users_fingerprints(self, mock_on_commit):
+        """
+        The fingerprints of the documents should only be stored if they were sent to the default private alias
+        """
+        with mute_signals(post_save):
+            program_enrollment = ProgramEnrollmentFactory.create()
+        backing_indexes = {
+            index_type: list(get_conn().indices.get_alias(name=get_default_alias(index_type)).keys())
+            for index_type in (PUBLIC_ENROLLMENT_INDEX_TYPE, PRIVATE_ENROLLMENT_INDEX_TYPE)
+        }
+
+        index_program_enrolled_users(
+            [program_enrollment],
+            public_indices=backing_indexes[PUBLIC_ENROLLMENT_INDEX_TYPE],
+            private_indices=backing_indexes[PRIVATE_ENROLLMENT_INDEX_TYPE],
+        )
+        assert get_document_fingerprints([program_enrollment.id]) == {}
+
+        index_program_enrolled_users([program_enrollment])
+        assert list(get_document_fingerprints([program_enrollment.id])) == [program_enrollment.id]
 
     def test_index_program_enrolled_users_missing_profiles(self, mock_on_commit):
         """
@@ -349,18 +385,18 @@ class IndexTests(ESTestCase):
         with mute_signals(post_save):
             program_enrollments = [ProgramEnrollmentFactory.build() for _ in range(10)]
         with patch(
-            'search.indexing_api._index_chunk', autospec=True, return_value=0
-        ) as index_chunk, patch(
-            'search.indexing_api.serialize_program_enrolled_user',
+            'search.indexing_api._index_actions', autospec=True, return_value=0
+        ) as index_actions, patch(
+            'search.indexing_api.serialize_program_enrolled_users',
             autospec=True,
-            side_effect=lambda x: None  # simulate a missing profile
+            side_effect=lambda ids: []  # simulate missing profiles
         ) as serialize_mock, patch(
             'search.indexing_api.serialize_public_enrolled_user', autospec=True, side_effect=lambda x: x
         ) as serialize_public_mock:
             index_program_enrolled_users(program_enrollments)
-            assert index_chunk.call_count == 0
+            assert index_actions.call_count == 0
             assert serialize_public_mock.call_count == 0
-            assert serialize_mock.call_count == len(program_enrollments)
+            serialize_mock.assert_called_once_with([enrollment.id for enrollment in program_enrollments])
 
     @data(PRIVATE_ENROLLMENT_INDEX_TYPE, PUBLIC_ENROLLMENT_INDEX_TYPE)
     def test_add_edx_record(self, index_type, mock_on_commit):
@@ -531,6 +567,28 @@ class SerializerTests(ESTestCase):
             CachedCertificateFactory.create(user=cls.profile.user, course_run=course_run)
             CachedEnrollmentFactory.create(user=cls.profile.user, course_run=course_run)
         cls.program_enrollment = ProgramEnrollment.objects.create(user=cls.profile.user, program=program)
+        cls.course_runs = course_runs
+
+    @staticmethod
+    def _create_program_enrollment(course_runs, *, role=None, has_profile=True):
+        """
+        Creates an user with a social account, education, employment, edX data and final grades
+        in the given course runs and enrolls the user in their program
+        """
+        program = course_runs[0].course.program
+        with mute_signals(post_save):
+            if not has_profile:
+                return ProgramEnrollmentFactory.create(program=program)
+            profile = SocialProfileFactory.create()
+            EducationFactory.create(profile=profile)
+            EmploymentFactory.create(profile=profile, end_date=None)
+            for course_run in course_runs:
+                CachedEnrollmentFactory.create(user=profile.user, course_run=course_run)
+                CachedCertificateFactory.create(user=profile.user, course_run=course_run)
+                FinalGradeFactory.create(user=profile.user, course_run=course_run, grade=0.8, passed=True)
+            if role is not None:
+                Role.objects.create(user=profile.user, program=program, role=role)
+            return ProgramEnrollment.objects.create(user=profile.user, program=program)
 
     def test_program_enrolled_user_serializer(self):
         """
@@ -547,6 +605,43 @@ class SerializerTests(ESTestCase):
             'program': UserProgramSearchSerializer.serialize(program_enrollment)
         }
 
+    def test_program_enrolled_users_serializer(self):
+        """
+        The documents built in bulk should be identical to the ones built one enrollment at a time
+        """
+        other_course = CourseFactory.create()
+        other_course_runs = [CourseRunFactory.create(course=other_course) for _ in range(3)]
+        program_enrollments = [
+            self.program_enrollment,
+            self._create_program_enrollment(self.course_runs),
+            self._create_program_enrollment(self.course_runs[:1], role=Staff.ROLE_ID),
+            self._create_program_enrollment(other_course_runs),
+            self._create_program_enrollment(other_course_runs[1:], role=Instructor.ROLE_ID),
+            self._create_program_enrollment(other_course_runs, has_profile=False),
+        ]
+        program_enrollment_ids = [program_enrollment.id for program_enrollment in reversed(program_enrollments)]
+
+        expected = [
+            serialize_program_enrolled_user(ProgramEnrollment.objects.get(id=program_enrollment_id))
+            for program_enrollment_id in program_enrollment_ids
+        ]
+        documents = serialize_program_enrolled_users(program_enrollment_ids)
+        assert len(documents) == len(program_enrollments) - 1
+        assert json.dumps(documents) == json.dumps([document for document in expected if document is not None])
+
+    def test_program_enrolled_users_serializer_queries(self):
+        """
+        The number of queries to build the documents in bulk should not depend on the number of enrollments
+        """
+        program_enrollment_ids = [
+            self._create_program_enrollment(self.course_runs).id for _ in range(6)
+        ]
+        with CaptureQueriesContext(connection) as few_queries:
+            serialize_program_enrolled_users(program_enrollment_ids[:2])
+        with CaptureQueriesContext(connection) as many_queries:
+            assert len(serialize_program_enrolled_users(program_enrollment_ids)) == 6
+        assert len(many_queries) == len(few_queries)
+
     def test_public_enrolled_user_serializer(self):
         """
         Asserts the output of the public serializer for program-enrolled users (ProgramEnrollments)
@@ -769,6 +864,91 @@ class RecreateIndexTests(ESTestCase):
             assert_search(temp_hits, [program_enrollment], index_type=index_type)
 
 
+    @data(PUBLIC_ENROLLMENT_INDEX_TYPE, PRIVATE_ENROLLMENT_INDEX_TYPE)
+    def test_resume_recreate_index(self, index_type):
+        """
+        If a partition fails recreate_index should keep the current index, and resuming should index
+        only the partitions which were not done
+        """
+        conn = get_conn(verify=False)
+        program_enrollments = sorted(ProgramEnrollmentFactory.create_batch(3), key=lambda enrollment: enrollment.id)
+        old_backing_indexes = list(conn.indices.get_alias(name=get_default_alias(index_type)).keys())
+        failing_id = program_enrollments[1].id
+
+        def _index_or_fail(enrollments, **kwargs):
+            """Fail to index one of the program enrollments"""
+            if any(enrollment.id == failing_id for enrollment in enrollments):
+                raise ConnectionError()
+            return index_program_enrolled_users(enrollments, **kwargs)
+
+        with patch('search.indexing_api.index_program_enrolled_users', side_effect=_index_or_fail):
+            with self.assertRaises(ReindexException):
+                recreate_index(partition_size=1)
+        assert list(conn.indices.get_alias(name=get_default_alias(index_type)).keys()) == old_backing_indexes
+        assert conn.indices.exists_alias(name=make_alias_name(index_type, is_reindexing=True)) is True
+
+        with patch(
+            'search.indexing_api.index_program_enrolled_users', side_effect=index_program_enrolled_users
+        ) as index_mock:
+            recreate_index(resume=True)
+        index_mock.assert_called_once_with(
+            [program_enrollments[1]], public_indices=ANY, private_indices=ANY, chunk_size=ANY, bulk_mode=True,
+        )
+        assert list(conn.indices.get_alias(name=get_default_alias(index_type)).keys()) != old_backing_indexes
+        assert conn.indices.exists_alias(name=make_alias_name(index_type, is_reindexing=True)) is False
+        assert_search(es.search(index_type), program_enrollments, index_type=index_type)
+
+    def test_recreate_index_fingerprints(self):
+        """
+        recreate_index should not store the fingerprints of the documents of the new backing indexes,
+        and should forget the fingerprints of the old ones once the default aliases are switched
+        """
+        with mute_signals(post_save):
+            program_enrollments = sorted(
+                ProgramEnrollmentFactory.create_batch(2), key=lambda enrollment: enrollment.id
+            )
+        failing_id = program_enrollments[1].id
+
+        def _index_or_fail(enrollments, **kwargs):
+            """Fail to index one of the program enrollments"""
+            if any(enrollment.id == failing_id for enrollment in enrollments):
+                raise ConnectionError()
+            return index_program_enrolled_users(enrollments, **kwargs)
+
+        with patch('search.indexing_api.index_program_enrolled_users', side_effect=_index_or_fail):
+            with self.assertRaises(ReindexException):
+                recreate_index(partition_size=1)
+        enrollment_ids = [enrollment.id for enrollment in program_enrollments]
+        assert get_document_fingerprints(enrollment_ids) == {}
+
+        index_program_enrolled_users(program_enrollments)
+        assert sorted(get_document_fingerprints(enrollment_ids)) == enrollment_ids
+        recreate_index(resume=True)
+        assert get_document_fingerprints(enrollment_ids) == {}
+
+    def test_recreate_index_bulk_mode(self):
+        """
+        recreate_index should refresh each new backing index only once and restore its settings
+        """
+        ProgramEnrollmentFactory.create_batch(3)
+        with patch('search.indexing_api.refresh_index', side_effect=refresh_index) as refresh_mock:
+            recreate_index(partition_size=1, chunk_size=1)
+        assert refresh_mock.call_count == len(ALL_INDEX_TYPES)
+
+        conn = get_conn(verify=False)
+        for index_type in ALL_INDEX_TYPES:
+            index_settings = conn.indices.get_settings(index=get_default_alias(index_type))
+            for backing_index_settings in index_settings.values():
+                assert 'refresh_interval' not in backing_index_settings['settings']['index']
+                assert backing_index_settings['settings']['index']['number_of_replicas'] != '0'
+
+    def test_recreate_index_without_enrollments(self):
+        """recreate_index should work if there is nothing to partition"""
+        ProgramEnrollment.objects.all().delete()
+        recreate_index(partition_size=1)
+        assert es.search(PRIVATE_ENROLLMENT_INDEX_TYPE)['total'] == 0
+
+
 class PercolateQueryTests(ESTestCase):
     """
     Tests for indexing of percolate queries
@@ -7,6 +7,8 @@ from django.core.management.base import BaseCommand
 
 from search.indexing_api import (
     recreate_index,
+    REINDEX_CHUNK_SIZE,
+    REINDEX_PARTITION_SIZE,
     __name__ as indexing_api_name,
 )
 
@@ -25,6 +27,34 @@ class Command(BaseCommand):
             dest='profile',
             default=False,
         )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            dest='workers',
+            default=1,
+            help='Number of processes indexing the program enrollments',
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            dest='resume',
+            default=False,
+            help='Continue an interrupted reindexing instead of starting from scratch',
+        )
+        parser.add_argument(
+            '--partition-size',
+            type=int,
+            dest='partition_size',
+            default=REINDEX_PARTITION_SIZE,
+            help='Number of program enrollment ids in each partition',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            dest='chunk_size',
+            default=REINDEX_CHUNK_SIZE,
+            help='Number of documents sent to Elasticsearch in each bulk request',
+        )
 
     def handle(self, *args, **kwargs):  # pylint: disable=unused-argument
         """
@@ -35,16 +65,22 @@ class Command(BaseCommand):
         console.setLevel(logging.DEBUG)
         log.addHandler(console)
         log.level = logging.INFO
+        options = dict(
+            workers=kwargs['workers'],
+            resume=kwargs['resume'],
+            partition_size=kwargs['partition_size'],
+            chunk_size=kwargs['chunk_size'],
+        )
 
         if kwargs['profile']:
             import cProfile
             import uuid
             profile = cProfile.Profile()
             profile.enable()
-            recreate_index()
+            recreate_index(**options)
             profile.disable()
             filename = 'recreate_index_{}.profile'.format(uuid.uuid4())
             profile.dump_stats(filename)
             self.stdout.write('Output profiling data to: {}'.format(filename))
         else:
-            recreate_index()
+            recreate_index(**options)
@@ -15,7 +15,7 @@ from profiles.models import (
 )
 from search.models import PercolateQuery
 from search.tasks import (
-    index_users,
+    index_users_debounced,
     index_percolate_queries,
     delete_percolate_query,
 )
@@ -33,31 +33,31 @@ log = logging.getLogger(__name__)
 @receiver(post_save, sender=Profile, dispatch_uid="profile_post_save_index")
 def handle_update_profile(sender, instance, **kwargs):
     """Update index when Profile model is updated."""
-    transaction.on_commit(lambda: index_users.delay([instance.user.id], check_if_changed=True))
+    transaction.on_commit(lambda: index_users_debounced([instance.user.id], check_if_changed=True))
 
 
 @receiver(post_save, sender=Education, dispatch_uid="education_post_save_index")
 def handle_update_education(sender, instance, **kwargs):
     """Update index when Education model is updated."""
-    transaction.on_commit(lambda: index_users.delay([instance.profile.user.id], check_if_changed=True))
+    transaction.on_commit(lambda: index_users_debounced([instance.profile.user.id], check_if_changed=True))
 
 
 @receiver(post_save, sender=Employment, dispatch_uid="employment_post_save_index")
 def handle_update_employment(sender, instance, **kwargs):
     """Update index when Employment model is updated."""
-    transaction.on_commit(lambda: index_users.delay([instance.profile.user.id], check_if_changed=True))
+    transaction.on_commit(lambda: index_users_debounced([instance.profile.user.id], check_if_changed=True))
 
 
 @receiver(post_delete, sender=Education, dispatch_uid="education_post_delete_index")
 def handle_delete_education(sender, instance, **kwargs):
     """Update index when Education model instance is deleted."""
-    transaction.on_commit(lambda: index_users.delay([instance.profile.user.id]))
+    transaction.on_commit(lambda: index_users_debounced([instance.profile.user.id]))
 
 
 @receiver(post_delete, sender=Employment, dispatch_uid="employment_post_delete_index")
 def handle_delete_employment(sender, instance, **kwargs):
     """Update index when Employment model instance is deleted."""
-    transaction.on_commit(lambda: index_users.delay([instance.profile.user.id]))
+    transaction.on_commit(lambda: index_users_debounced([instance.profile.user.id]))
 
 
 @receiver(post_save, sender=PercolateQuery, dispatch_uid="percolate_query_save")
@@ -75,10 +75,10 @@ def handle_delete_percolate(sender, instance, **kwargs):
 @receiver(post_save, sender=Role, dispatch_uid="role_post_create_index")
 def handle_create_role(sender, instance, **kwargs):
     """Update index when Role model instance is created."""
-    transaction.on_commit(lambda: index_users.delay([instance.user.id]))
+    transaction.on_commit(lambda: index_users_debounced([instance.user.id]))
 
 
 @receiver(post_delete, sender=Role, dispatch_uid="role_post_remove_index")
 def handle_remove_role(sender, instance, **kwargs):
     """Update index when Role model instance is deleted."""
-    transaction.on_commit(lambda: index_users.delay([instance.user.id]))
+    transaction.on_commit(lambda: index_users_debounced([instance.user.id]))
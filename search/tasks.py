@@ -9,11 +9,14 @@ from django.conf import settings
 from dashboard.models import ProgramEnrollment
 from mail.api import send_automatic_emails as _send_automatic_emails
 from micromasters.celery import app
+from micromasters.utils import chunks
 from search import api
 from search.api import (
-    document_needs_updating as _document_needs_updating,
+    get_enrollments_needing_update as _get_enrollments_needing_update,
+    percolate_program_enrollments as _percolate_program_enrollments,
     update_percolate_memberships as _update_percolate_memberships,
 )
+from search.index_queue import enqueue_users, pop_due_users
 from search.indexing_api import (
     refresh_all_default_indices as _refresh_all_default_indices,
     index_program_enrolled_users as _index_program_enrolled_users,
@@ -40,17 +43,33 @@ def post_indexing_handler(program_enrollments):
         log.debug('OPEN_DISCUSSIONS_USER_SYNC is set to False (so disabled) in the settings')
 
     _refresh_all_default_indices()
-    for program_enrollment in program_enrollments:
-        try:
-            _send_automatic_emails(program_enrollment)
-        except:  # pylint: disable=bare-except
-            log.exception("Error sending automatic email for enrollment %s", program_enrollment)
 
-        # only update for discussion queries for now
+    # Percolate all the enrollments of the users at once, the results are shared by the automatic emails
+    # and the discussion channel memberships. If this fails each of them percolates on its own.
+    users = {}
+    for program_enrollment in program_enrollments:
+        users.setdefault(program_enrollment.user_id, program_enrollment.user)
+    try:
+        percolate_matches = _percolate_program_enrollments(
+            ProgramEnrollment.objects.filter(user_id__in=list(users))
+        )
+    except:  # pylint: disable=bare-except
+        log.exception("Error percolating the enrollments of users %s", list(users))
+        percolate_matches = None
+
+    try:
+        _send_automatic_emails(program_enrollments, percolate_matches=percolate_matches)
+    except:  # pylint: disable=bare-except
+        log.exception("Error sending automatic emails for the enrollments of users %s", list(users))
+
+    # only update for discussion queries for now
+    for user in users.values():
         try:
-            _update_percolate_memberships(program_enrollment.user, PercolateQuery.DISCUSSION_CHANNEL_TYPE)
+            _update_percolate_memberships(
+                user, PercolateQuery.DISCUSSION_CHANNEL_TYPE, percolate_matches=percolate_matches
+            )
         except:  # pylint: disable=bare-except
-            log.exception("Error syncing %s to channels", program_enrollment.user)
+            log.exception("Error syncing %s to channels", user)
 
 
 @app.task
@@ -87,15 +106,13 @@ def index_users(user_ids, check_if_changed=False):
     Args:
         user_ids (list of int): Ids of users to update in the Elasticsearch index
         check_if_changed (bool):
-            If true, read the document from elasticsearch before indexing and
-            check if the serialized value would be different.
+            If true, only index the documents whose serialized value would be different
+            from the one in elasticsearch, see get_enrollments_needing_update.
     """
     enrollments = list(ProgramEnrollment.objects.filter(user__in=user_ids))
 
     if check_if_changed:
-        enrollments = [
-            enrollment for enrollment in enrollments if _document_needs_updating(enrollment)
-        ]
+        enrollments = _get_enrollments_needing_update(enrollments)
 
     if len(enrollments) > 0:
         _index_program_enrolled_users(enrollments)
@@ -104,6 +121,36 @@ def index_users(user_ids, check_if_changed=False):
         post_indexing_handler(enrollments)
 
 
+def index_users_debounced(user_ids, check_if_changed=False):
+    """
+    Queue users to be indexed by drain_index_queue, so that many changes to the same user
+    in a short time result in a single indexing. If SEARCH_INDEX_QUEUE_SYNC is set the users
+    are indexed right away.
+
+    Args:
+        user_ids (list of int): Ids of users to update in the Elasticsearch index
+        check_if_changed (bool): See index_users
+    """
+    if settings.SEARCH_INDEX_QUEUE_SYNC:
+        index_users.delay(user_ids, check_if_changed=check_if_changed)
+    else:
+        enqueue_users(user_ids, check_if_changed=check_if_changed)
+
+
+@app.task
+def drain_index_queue():
+    """
+    Index in batches the users queued by index_users_debounced whose debounce window is over
+    """
+    users_to_check, users_to_index = pop_due_users(settings.SEARCH_INDEX_DEBOUNCE_SECONDS)
+    for user_ids in chunks(users_to_index, chunk_size=settings.SEARCH_INDEX_QUEUE_BATCH_SIZE):
+        index_users.delay(user_ids)
+    for user_ids in chunks(users_to_check, chunk_size=settings.SEARCH_INDEX_QUEUE_BATCH_SIZE):
+        index_users.delay(user_ids, check_if_changed=True)
+    if users_to_check or users_to_index:
+        log.info("Queued the indexing of %d users", len(users_to_check) + len(users_to_index))
+
+
 @app.task
 def index_percolate_queries(percolate_query_ids):
     """
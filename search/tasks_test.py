@@ -4,13 +4,17 @@ from ddt import (
     ddt,
     unpack,
 )
+from unittest.mock import call, patch
+
 from django.test import override_settings
 
 from dashboard.factories import ProgramEnrollmentFactory
 from search.base import MockedESTestCase
 from search.models import PercolateQuery
 from search.tasks import (
+    drain_index_queue,
     index_users,
+    index_users_debounced,
     index_program_enrolled_users,
 )
 
@@ -49,14 +53,26 @@ class SearchTasksTests(MockedESTestCase):
         for mock in self.patcher_mocks:
             if mock.name == "_index_program_enrolled_users":
                 self.index_program_enrolled_users_mock = mock
-            elif mock.name == "_document_needs_updating":
-                self.document_needs_updating_mock = mock
+            elif mock.name == "_get_enrollments_needing_update":
+                self.get_enrollments_needing_update_mock = mock
             elif mock.name == "_send_automatic_emails":
                 self.send_automatic_emails_mock = mock
             elif mock.name == "_refresh_all_default_indices":
                 self.refresh_index_mock = mock
             elif mock.name == "_update_percolate_memberships":
                 self.update_percolate_memberships_mock = mock
+            elif mock.name == "_percolate_program_enrollments":
+                self.percolate_program_enrollments_mock = mock
+        self.percolate_matches = self.percolate_program_enrollments_mock.return_value
+
+    def assert_automatic_emails_sent(self, enrollments, percolate_matches):
+        """Assert that the automatic emails were sent once for all of the enrollments"""
+        assert self.send_automatic_emails_mock.call_count == 1
+        args, kwargs = self.send_automatic_emails_mock.call_args
+        assert sorted(args[0], key=lambda enrollment: enrollment.id) == sorted(
+            enrollments, key=lambda enrollment: enrollment.id
+        )
+        assert kwargs == {'percolate_matches': percolate_matches}
 
     def test_index_users(self):
         """
@@ -73,10 +89,16 @@ class SearchTasksTests(MockedESTestCase):
             [enrollment1, enrollment2],
             key=lambda _enrollment: _enrollment.id
         )
+        # both enrollments of the user are percolated together once
+        assert self.percolate_program_enrollments_mock.call_count == 1
+        assert sorted(
+            self.percolate_program_enrollments_mock.call_args[0][0], key=lambda enrollment: enrollment.id
+        ) == [enrollment1, enrollment2]
+        assert self.update_percolate_memberships_mock.call_count == 1
+        self.assert_automatic_emails_sent([enrollment1, enrollment2], self.percolate_matches)
         for enrollment in [enrollment1, enrollment2]:
-            self.send_automatic_emails_mock.assert_any_call(enrollment)
             self.update_percolate_memberships_mock.assert_any_call(
-                enrollment.user, PercolateQuery.DISCUSSION_CHANNEL_TYPE)
+                enrollment.user, PercolateQuery.DISCUSSION_CHANNEL_TYPE, percolate_matches=self.percolate_matches)
         self.refresh_index_mock.assert_called_with()
 
     @data(*[
@@ -99,11 +121,11 @@ class SearchTasksTests(MockedESTestCase):
         if enrollment2_needs_update:
             needs_update_list.append(enrollment2)
 
-        def fake_needs_updating(_enrollment):
-            """Fake document_needs_update to conform to test data"""
-            return _enrollment in needs_update_list
+        def fake_needs_updating(_enrollments):
+            """Fake get_enrollments_needing_update to conform to test data"""
+            return [_enrollment for _enrollment in _enrollments if _enrollment in needs_update_list]
 
-        self.document_needs_updating_mock.side_effect = fake_needs_updating
+        self.get_enrollments_needing_update_mock.side_effect = fake_needs_updating
         index_users([enrollment1.user.id, enrollment2.user.id], check_if_changed=True)
 
         expected_enrollments = []
@@ -112,14 +134,16 @@ class SearchTasksTests(MockedESTestCase):
         if enrollment2_needs_update:
             expected_enrollments.append(enrollment2)
 
-        self.document_needs_updating_mock.assert_any_call(enrollment1)
-        self.document_needs_updating_mock.assert_any_call(enrollment2)
+        assert self.get_enrollments_needing_update_mock.call_count == 1
+        assert sorted(
+            self.get_enrollments_needing_update_mock.call_args[0][0], key=lambda enrollment: enrollment.id
+        ) == [enrollment1, enrollment2]
         if len(needs_update_list) > 0:
             self.index_program_enrolled_users_mock.assert_called_once_with(needs_update_list)
+            self.assert_automatic_emails_sent(needs_update_list, self.percolate_matches)
             for enrollment in needs_update_list:
-                self.send_automatic_emails_mock.assert_any_call(enrollment)
                 self.update_percolate_memberships_mock.assert_any_call(
-                    enrollment.user, PercolateQuery.DISCUSSION_CHANNEL_TYPE)
+                    enrollment.user, PercolateQuery.DISCUSSION_CHANNEL_TYPE, percolate_matches=self.percolate_matches)
         else:
             assert self.index_program_enrolled_users_mock.called is False
             assert self.send_automatic_emails_mock.called is False
@@ -135,15 +159,15 @@ class SearchTasksTests(MockedESTestCase):
         assert list(
             self.index_program_enrolled_users_mock.call_args[0][0].values_list('id', flat=True)
         ) == enrollment_ids
+        self.assert_automatic_emails_sent(enrollments, self.percolate_matches)
         for enrollment in enrollments:
-            self.send_automatic_emails_mock.assert_any_call(enrollment)
             self.update_percolate_memberships_mock.assert_any_call(
-                enrollment.user, PercolateQuery.DISCUSSION_CHANNEL_TYPE)
+                enrollment.user, PercolateQuery.DISCUSSION_CHANNEL_TYPE, percolate_matches=self.percolate_matches)
         self.refresh_index_mock.assert_called_with()
 
     def test_failed_automatic_email(self):
         """
-        If we fail to send automatic email for one enrollment we should still send them for other enrollments
+        If we fail to send the automatic emails we should still update the percolate memberships
         """
         enrollments = [ProgramEnrollmentFactory.create() for _ in range(2)]
         enrollment_ids = [enrollment.id for enrollment in enrollments]
@@ -154,15 +178,28 @@ class SearchTasksTests(MockedESTestCase):
         assert list(
             self.index_program_enrolled_users_mock.call_args[0][0].values_list('id', flat=True)
         ) == enrollment_ids
+        self.assert_automatic_emails_sent(enrollments, self.percolate_matches)
         for enrollment in enrollments:
-            self.send_automatic_emails_mock.assert_any_call(enrollment)
             self.update_percolate_memberships_mock.assert_any_call(
-                enrollment.user, PercolateQuery.DISCUSSION_CHANNEL_TYPE
+                enrollment.user, PercolateQuery.DISCUSSION_CHANNEL_TYPE, percolate_matches=self.percolate_matches
             )
-        assert self.send_automatic_emails_mock.call_count == len(enrollments)
         assert self.update_percolate_memberships_mock.call_count == len(enrollments)
         self.refresh_index_mock.assert_called_with()
 
+    def test_failed_percolation(self):
+        """
+        If the enrollments can't be percolated together, the automatic emails and the memberships
+        should percolate them on their own
+        """
+        enrollment = ProgramEnrollmentFactory.create()
+        self.percolate_program_enrollments_mock.side_effect = KeyError()
+
+        index_program_enrolled_users([enrollment.id])
+        self.assert_automatic_emails_sent([enrollment], None)
+        self.update_percolate_memberships_mock.assert_called_once_with(
+            enrollment.user, PercolateQuery.DISCUSSION_CHANNEL_TYPE, percolate_matches=None
+        )
+
     def test_failed_update_percolate_memberships(self):
         """
         If we fail to update percolate memberships for one enrollment we should still update it for other enrollments
@@ -177,11 +214,42 @@ class SearchTasksTests(MockedESTestCase):
             self.index_program_enrolled_users_mock.call_args[0][0].values_list('id', flat=True)
         ) == enrollment_ids
 
+        self.assert_automatic_emails_sent(enrollments, self.percolate_matches)
         for enrollment in enrollments:
-            self.send_automatic_emails_mock.assert_any_call(enrollment)
             self.update_percolate_memberships_mock.assert_any_call(
-                enrollment.user, PercolateQuery.DISCUSSION_CHANNEL_TYPE
+                enrollment.user, PercolateQuery.DISCUSSION_CHANNEL_TYPE, percolate_matches=self.percolate_matches
             )
-        assert self.send_automatic_emails_mock.call_count == len(enrollments)
         assert self.update_percolate_memberships_mock.call_count == len(enrollments)
         self.refresh_index_mock.assert_called_with()
+
+    @data(True, False)
+    def test_index_users_debounced(self, sync):
+        """
+        Users should be queued unless SEARCH_INDEX_QUEUE_SYNC is set
+        """
+        with override_settings(SEARCH_INDEX_QUEUE_SYNC=sync), patch(
+            'search.tasks.enqueue_users', autospec=True
+        ) as enqueue_mock, patch('search.tasks.index_users', autospec=True) as index_users_mock:
+            index_users_debounced([1, 2], check_if_changed=True)
+        if sync:
+            index_users_mock.delay.assert_called_once_with([1, 2], check_if_changed=True)
+            assert enqueue_mock.called is False
+        else:
+            enqueue_mock.assert_called_once_with([1, 2], check_if_changed=True)
+            assert index_users_mock.delay.called is False
+
+    @override_settings(SEARCH_INDEX_DEBOUNCE_SECONDS=30, SEARCH_INDEX_QUEUE_BATCH_SIZE=2)
+    def test_drain_index_queue(self):
+        """
+        drain_index_queue should index the due users in batches
+        """
+        with patch(
+            'search.tasks.pop_due_users', autospec=True, return_value=([1, 2, 3], [4])
+        ) as pop_mock, patch('search.tasks.index_users', autospec=True) as index_users_mock:
+            drain_index_queue()
+        pop_mock.assert_called_once_with(30)
+        assert index_users_mock.delay.call_args_list == [
+            call([4]),
+            call([1, 2], check_if_changed=True),
+            call([3], check_if_changed=True),
+        ]
@@ -3,10 +3,7 @@ Tests for utilty functions
 """
 from collections import OrderedDict
 
-from search.util import (
-    open_json_stream,
-    traverse_mapping,
-)
+from search.util import traverse_mapping
 
 
 def test_traverse_mapping():
@@ -40,18 +37,3 @@ def test_traverse_mapping():
         ('string_field', data['user']['properties']['string_field']),
     ]
 
-
-def test_json_stream():
-    """
-    We should be able to store and read an arbitrary number of JSON objects
-    """
-    objs = [1, "2", False, None, {}, {"x": {"y": ["z\n\n"]}}]
-    with open_json_stream() as stream:
-        assert list(stream.read_stream()) == []
-
-        stream.write_stream(objs)
-
-        assert list(stream.read_stream()) == objs
-        assert list(stream.read_stream()) == objs
-
-        stream.write_stream([])